@@ -17,6 +17,7 @@ if sys.stdout.encoding != "utf-8":
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from server.config import Settings
+from server.rag.index import evaluate_index, is_quantized
 from server.rag.ingest import PDFIngestor
 
 console = Console(force_terminal=True)
@@ -25,7 +26,10 @@ console = Console(force_terminal=True)
 @click.command()
 @click.option("--kb-dir", default="./knowledge_base", help="Directory containing PDF files")
 @click.option("--clear", is_flag=True, help="Clear existing vector store before ingesting")
-def main(kb_dir: str, clear: bool):
+@click.option("--prune", is_flag=True, help="Remove indexed PDFs that are not in --kb-dir")
+@click.option("--jobs", type=int, default=None, help="Worker processes for PDF extraction and chunking")
+@click.option("--compare", is_flag=True, help="Report recall@k and latency of the index against exact search")
+def main(kb_dir: str, clear: bool, prune: bool, jobs: int | None, compare: bool):
     settings = Settings()
     console.print("[bold]Ask Michal - Knowledge Base Ingestion[/bold]\n")
 
@@ -49,21 +53,60 @@ def main(kb_dir: str, clear: bool):
     console.print(f"Found [bold]{len(pdfs)}[/bold] PDF files to process.\n")
 
     total_chunks = 0
+    embed_seconds = 0.0
     with Progress() as progress:
         task = progress.add_task("Processing PDFs...", total=len(pdfs))
-        for pdf_file in pdfs:
-            path = os.path.join(kb_dir, pdf_file)
-            chunks = ingestor.ingest_pdf(path)
-            console.print(f"  [green]{pdf_file}[/green]: {chunks} new chunks")
+
+        def on_file(pdf_file: str, chunks: int):
+            nonlocal total_chunks, embed_seconds
+            stats = ingestor.last_ingest_stats
+            if stats["skipped"]:
+                console.print(f"  [dim]{pdf_file}: unchanged, skipped[/dim]")
+            else:
+                console.print(
+                    f"  [green]{pdf_file}[/green]: {chunks} new chunks, "
+                    f"{stats['removed']} removed ({stats['chunks_per_second']:.1f} chunks/s)"
+                )
             total_chunks += chunks
+            embed_seconds += stats["seconds"]
             progress.update(task, advance=1)
 
+        ingestor.ingest_directory(kb_dir, jobs=jobs, on_file=on_file, prune=prune)
+
+    if ingestor.compact():
+        console.print("[dim]Merged chunk store segments.[/dim]")
+
     console.print(
         f"\n[bold green]Done![/bold green] "
         f"Added {total_chunks} new chunks. "
-        f"Total chunks in store: {len(ingestor.metadata['chunks'])}"
+        f"Embedding throughput: {total_chunks / embed_seconds if embed_seconds else 0.0:.1f} chunks/s. "
+        f"Total chunks in store: {len(ingestor.store)}"
     )
 
+    if compare:
+        report = evaluate_index(
+            ingestor.index,
+            *ingestor.store.live_vectors(),
+            k=settings.retrieval_top_k,
+            rerank_factor=settings.faiss_rerank_factor if is_quantized(ingestor.index) else 1,
+        )
+        if report["queries"]:
+            recall_line = f"  recall@{report['k']}: {report['recall_at_k']:.3f}"
+            if "raw_recall_at_k" in report:
+                recall_line += (
+                    f" after exact re-ranking ({report['raw_recall_at_k']:.3f} before, "
+                    f"recall loss {1 - report['recall_at_k']:.3f})"
+                )
+            console.print(
+                f"\n[bold]Index comparison[/bold] ({report['index_type']} vs exact flat, "
+                f"{report['vectors']} vectors, {report['queries']} queries)\n"
+                f"{recall_line}\n"
+                f"  latency: {report['latency_ms']:.3f} ms/query "
+                f"(flat: {report['flat_latency_ms']:.3f} ms/query)\n"
+                f"  size: {report['bytes_per_vector']:.0f} bytes/vector "
+                f"(flat: {report['flat_bytes_per_vector']:.0f} bytes/vector)"
+            )
+
 
 if __name__ == "__main__":
     main()
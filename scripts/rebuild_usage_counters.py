@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""Recount the users' queries_used / total_tokens counters from query_logs.
+
+Run it with the server stopped: answers in progress are counted in
+queries_used before their query log is written.
+"""
+import os
+import sys
+
+import click
+
+# Allow imports from project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.database import init_db, rebuild_usage_counters
+
+
+@click.command()
+def main():
+    init_db()
+    repaired = rebuild_usage_counters()
+    click.echo(f"Corrected the usage counters of {repaired} users.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class CachedAnswer:
+    vector: np.ndarray
+    result: dict
+    created_at: float
+
+
+class AnswerCache:
+    """In-memory semantic cache of answered questions.
+
+    A question is a hit when its normalized embedding has cosine similarity
+    of at least ``threshold`` with a cached question. Entries expire after
+    ``ttl_seconds``; beyond ``max_size`` the oldest entry is evicted. All
+    entries are dropped when the knowledge base version changes.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float, threshold: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self._entries: list[CachedAnswer] = []  # oldest first
+        self._matrix: np.ndarray | None = None
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _sync(self, version):
+        """Drop entries from another knowledge base version or past their TTL."""
+        if version != self._version:
+            self._entries = []
+            self._version = version
+            self._matrix = None
+        cutoff = time.monotonic() - self.ttl_seconds
+        if self._entries and self._entries[0].created_at < cutoff:
+            self._entries = [e for e in self._entries if e.created_at >= cutoff]
+            self._matrix = None
+
+    def get(self, vector: np.ndarray, version) -> dict | None:
+        with self._lock:
+            self._sync(version)
+            if not self._entries:
+                self.misses += 1
+                return None
+            if self._matrix is None:
+                self._matrix = np.stack([e.vector for e in self._entries])
+            scores = self._matrix @ vector.ravel()
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._entries[best].result
+
+    def put(self, vector: np.ndarray, result: dict, version):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._sync(version)
+            self._entries.append(CachedAnswer(vector.ravel(), result, time.monotonic()))
+            del self._entries[: max(0, len(self._entries) - self.max_size)]
+            self._matrix = None
+
+    def clear(self):
+        with self._lock:
+            self._entries = []
+            self._matrix = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
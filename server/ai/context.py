@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import math
+
+# Rough size of a Claude token in Hebrew text. Only used to keep prompts
+# within a budget, so it errs on the side of counting too many tokens.
+CHARS_PER_TOKEN = 2.0
+
+# Shortest shared text treated as chunk overlap rather than coincidence
+MIN_OVERLAP_CHARS = 20
+
+# Context the top chunk keeps even when the conversation has used up the
+# budget, so there is always something to answer from
+MIN_TOP_CHUNK_TOKENS = 100
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _overlap(first: str, second: str) -> int:
+    """Length of the longest end of ``first`` that ``second`` starts with."""
+    probe = second[:MIN_OVERLAP_CHARS]
+    if len(probe) < MIN_OVERLAP_CHARS:
+        return 0
+    pos = first.find(probe)
+    while pos != -1:
+        if second.startswith(first[pos:]):
+            return len(first) - pos
+        pos = first.find(probe, pos + 1)
+    return 0
+
+
+class ContextAssembler:
+    """Pick the retrieved chunks that go into the prompt, within a token budget.
+
+    Chunks come in retrieval rank order. Chunks that are not relevant are
+    dropped, text a chunk shares with a neighbouring chunk of the same
+    source already included (the chunker's overlap) is cut from it, and
+    chunks stop being added once the budget is spent. The top chunk is
+    always kept, shortened if it alone is over the budget, but to no less
+    than ``MIN_TOP_CHUNK_TOKENS`` even when the budget is already spent.
+    """
+
+    def __init__(self, min_score: float, min_lexical_coverage: float):
+        self.min_score = min_score
+        self.min_lexical_coverage = min_lexical_coverage
+
+    def is_relevant(self, result: dict) -> bool:
+        return (
+            result["score"] >= self.min_score
+            or result.get("lexical_score", 0.0) >= self.min_lexical_coverage
+        )
+
+    def _trim(self, result: dict, selected: list[dict]) -> str:
+        """The chunk's text without what it shares with the selected chunks."""
+        text = result["text"]
+        for other in selected:
+            if other["source"] != result["source"]:
+                continue
+            text = text[_overlap(other["text"], text):]
+            cut = _overlap(text, other["text"])
+            if cut:
+                text = text[:-cut]
+        return text.strip()
+
+    def assemble(self, results: list[dict], budget_tokens: int) -> list[dict]:
+        selected = []
+        remaining = budget_tokens
+        for result in results:
+            if not self.is_relevant(result):
+                continue
+            text = self._trim(result, selected)
+            if not text:
+                continue
+            tokens = estimate_tokens(text)
+            if tokens > remaining:
+                if selected:
+                    break
+                text = text[: int(max(remaining, MIN_TOP_CHUNK_TOKENS) * CHARS_PER_TOKEN)].strip()
+                tokens = estimate_tokens(text)
+            selected.append({**result, "text": text})
+            remaining -= tokens
+        return selected
@@ -1,47 +1,163 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import AsyncIterator
+
 import anthropic
+import numpy as np
 
 from server.config import Settings
-from server.ai.prompts import SYSTEM_PROMPT, REFUSAL_NO_KNOWLEDGE
+from server.ai.cache import AnswerCache
+from server.ai.context import ContextAssembler, estimate_tokens
+from server.ai.prompts import CONTEXT_PROMPT, SYSTEM_PROMPT, REFUSAL_NO_KNOWLEDGE
+from server.ai.router import ModelRouter
 from server.rag.retriever import KnowledgeRetriever
-from server.security.filters import InputFilter, OutputFilter
+from server.security.filters import InputFilter, OutputFilter, StreamingOutputFilter
+
+logger = logging.getLogger("ask-michal")
+
+
+@dataclass
+class PreparedQuestion:
+    """Everything needed to call Claude for a question that passed retrieval."""
+
+    retrieved: list[dict]
+    system: list[dict]
+    messages: list[dict]
+    query_vector: np.ndarray | None
+    kb_version: int
+    model: str
+
+
+# Usage of an answer that did not call Claude
+NO_USAGE = {"tokens_used": 0, "cache_read_tokens": 0, "cache_write_tokens": 0, "model": None}
+
+
+def _page_label(result: dict) -> str:
+    """Hebrew page reference of a retrieved chunk, a range if it spans pages."""
+    page, page_end = result["page"], result.get("page_end", result["page"])
+    return f"עמוד {page}" if page_end == page else f"עמודים {page}-{page_end}"
 
 
 class MichalEngine:
     def __init__(self, settings: Settings, retriever: KnowledgeRetriever):
         self.client = anthropic.Anthropic(api_key=settings.anthropic_api_key)
+        self.async_client = anthropic.AsyncAnthropic(api_key=settings.anthropic_api_key)
         self.model = settings.anthropic_model
         self.retriever = retriever
         self.input_filter = InputFilter()
         self.output_filter = OutputFilter()
         self.min_relevance_score = 0.3  # Minimum cosine similarity for FAISS IP
+        self.min_lexical_coverage = settings.lexical_min_coverage
+        self.context_assembler = ContextAssembler(
+            self.min_relevance_score, self.min_lexical_coverage
+        )
+        self.router = ModelRouter(settings)
+        self.max_input_tokens = settings.max_input_tokens
+        self.answer_cache = AnswerCache(
+            max_size=settings.answer_cache_size,
+            ttl_seconds=settings.answer_cache_ttl_seconds,
+            threshold=settings.answer_cache_threshold,
+        )
+        # Embedding and FAISS search are CPU-bound; the async path runs them
+        # here so they never block the event loop.
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.rag_worker_threads, thread_name_prefix="michal-rag"
+        )
 
     def ask(self, question: str, conversation_history: list[dict] | None = None) -> dict:
         """Process a question through the full RAG + security pipeline."""
+        prepared = self._prepare(question, conversation_history)
+        if isinstance(prepared, dict):
+            return prepared
+
+        response = self.client.messages.create(**self._request_kwargs(prepared))
+        return self._finish(prepared, response.content[0].text, response.usage)
+
+    async def aask(self, question: str, conversation_history: list[dict] | None = None) -> dict:
+        """Async ``ask``: retrieval runs in the worker pool, Claude is awaited."""
+        loop = asyncio.get_running_loop()
+        prepared = await loop.run_in_executor(
+            self.executor, self._prepare, question, conversation_history
+        )
+        if isinstance(prepared, dict):
+            return prepared
+
+        response = await self.async_client.messages.create(**self._request_kwargs(prepared))
+        return self._finish(prepared, response.content[0].text, response.usage)
+
+    async def astream(
+        self, question: str, conversation_history: list[dict] | None = None
+    ) -> AsyncIterator[tuple[str, dict]]:
+        """Stream an answer as ``(event, data)`` pairs.
+
+        Emits ``sources`` first, then ``delta`` events with sanitized answer
+        text, and finally ``done`` with ``tokens_used``. Answers produced
+        without Claude arrive as a single delta.
+        """
+        loop = asyncio.get_running_loop()
+        prepared = await loop.run_in_executor(
+            self.executor, self._prepare, question, conversation_history
+        )
+        if isinstance(prepared, dict):
+            yield "sources", {"sources": prepared["sources"]}
+            yield "delta", {"text": prepared["answer"]}
+            yield "done", {key: prepared[key] for key in NO_USAGE}
+            return
+
+        yield "sources", {"sources": self.source_references(prepared.retrieved)}
+
+        # Step 8 runs on the fly: PII is stripped before any text leaves
+        sanitizer = StreamingOutputFilter(self.output_filter)
+        parts = []
+        async with self.async_client.messages.stream(**self._request_kwargs(prepared)) as stream:
+            async for text in stream.text_stream:
+                parts.append(text)
+                safe = sanitizer.feed(text)
+                if safe:
+                    yield "delta", {"text": safe}
+            final = await stream.get_final_message()
+        safe = sanitizer.flush()
+        if safe:
+            yield "delta", {"text": safe}
+
+        result = self._finish(prepared, "".join(parts), final.usage)
+        yield "done", {key: result[key] for key in NO_USAGE}
+
+    def _prepare(
+        self, question: str, conversation_history: list[dict] | None
+    ) -> dict | PreparedQuestion:
+        """Run the steps before the Claude call.
+
+        Returns a final result dict when the question is answered without
+        Claude (blocked, cached or nothing relevant found).
+        """
 
         # Step 1: Input security filter
         filter_result = self.input_filter.check(question)
         if filter_result.blocked:
-            return {
-                "answer": filter_result.refusal_message,
-                "sources": [],
-                "tokens_used": 0,
-            }
-
-        # Step 2: Retrieve relevant context
-        retrieved = self.retriever.retrieve(question)
-
-        # Step 3: Check if we found relevant context
-        if not retrieved or all(r["score"] < self.min_relevance_score for r in retrieved):
-            return {
-                "answer": REFUSAL_NO_KNOWLEDGE,
-                "sources": [],
-                "tokens_used": 0,
-            }
-
-        # Step 4: Build prompt with context
-        context = self.retriever.format_context(retrieved)
-        system_prompt = SYSTEM_PROMPT.replace("{context}", context)
+            return {"answer": filter_result.refusal_message, "sources": [], **NO_USAGE}
+
+        # Step 2: Answer from cache if a near-identical question was answered
+        # recently. Follow-ups depend on the conversation, so they never hit.
+        # One snapshot for the whole question, even if the index is reloaded
+        snapshot = self.retriever.snapshot
+        kb_version = snapshot.version
+        query_vector = None
+        if not conversation_history and snapshot.is_ready():
+            query_vector = self.retriever.embed_query(question)
+            cached = self.answer_cache.get(query_vector, kb_version)
+            if cached is not None:
+                return {**cached, **NO_USAGE}
+
+        # Step 3: Retrieve relevant context
+        retrieved = self.retriever.retrieve(question, snapshot=snapshot)
+
+        # Step 4: Check if we found relevant context, by meaning or by exact terms
+        if not retrieved or not any(self._is_relevant(r) for r in retrieved):
+            return {"answer": REFUSAL_NO_KNOWLEDGE, "sources": [], **NO_USAGE}
 
         # Step 5: Build messages (include recent conversation history)
         messages = []
@@ -50,29 +166,65 @@ class MichalEngine:
                 messages.append(msg)
         messages.append({"role": "user", "content": question})
 
-        # Step 6: Call Claude API
-        response = self.client.messages.create(
-            model=self.model,
-            max_tokens=2048,
-            system=system_prompt,
-            messages=messages,
-        )
+        # Step 6: Fit the best chunks into what is left of the token budget
+        # and build the prompt with them
+        budget = self.max_input_tokens - estimate_tokens(SYSTEM_PROMPT + CONTEXT_PROMPT)
+        budget -= sum(estimate_tokens(str(m["content"])) for m in messages)
+        selected = self.context_assembler.assemble(retrieved, budget)
+        if not selected:
+            return {"answer": REFUSAL_NO_KNOWLEDGE, "sources": [], **NO_USAGE}
+        context = self.retriever.format_context(selected)
+        system = self._system_blocks(context)
 
-        answer_text = response.content[0].text
-        tokens_used = response.usage.input_tokens + response.usage.output_tokens
+        model, reason = self.router.choose(question, selected, conversation_history)
+        logger.info(f"Answering with {model} ({reason}, {len(selected)}/{len(retrieved)} chunks)")
 
-        # Step 7: Output security filter
-        answer_text = self.output_filter.sanitize(answer_text)
+        return PreparedQuestion(selected, system, messages, query_vector, kb_version, model)
 
-        # Step 8: Extract source references
-        sources = list(
-            dict.fromkeys(
-                f"{r['source']} (עמוד {r['page']})" for r in retrieved
-            )
-        )
+    def _system_blocks(self, context: str) -> list[dict]:
+        """The fixed instructions and the retrieved context as two system blocks."""
+        return [
+            {"type": "text", "text": SYSTEM_PROMPT},
+            {"type": "text", "text": CONTEXT_PROMPT.replace("{context}", context)},
+        ]
+
+    def _is_relevant(self, result: dict) -> bool:
+        return self.context_assembler.is_relevant(result)
 
+    def _request_kwargs(self, prepared: PreparedQuestion) -> dict:
+        # Step 7: Call Claude API
         return {
+            "model": prepared.model,
+            "max_tokens": 2048,
+            "system": prepared.system,
+            "messages": prepared.messages,
+        }
+
+    def _finish(self, prepared: PreparedQuestion, answer_text: str, usage) -> dict:
+        # input_tokens leaves out the tokens read from or written to the cache
+        cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+        cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+        tokens_used = usage.input_tokens + cache_read + cache_write + usage.output_tokens
+
+        # Step 8: Output security filter
+        answer_text = self.output_filter.sanitize(answer_text)
+
+        result = {
             "answer": answer_text,
-            "sources": sources,
+            "sources": self.source_references(prepared.retrieved),
             "tokens_used": tokens_used,
+            "cache_read_tokens": cache_read,
+            "cache_write_tokens": cache_write,
+            "model": prepared.model,
         }
+        if prepared.query_vector is not None:
+            self.answer_cache.put(prepared.query_vector, result, prepared.kb_version)
+        return result
+
+    @staticmethod
+    def source_references(retrieved: list[dict]) -> list[str]:
+        # Step 9: Extract source references
+        return list(dict.fromkeys(f"{r['source']} ({_page_label(r)})" for r in retrieved))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -23,8 +23,10 @@ SYSTEM_PROMPT = """את "מיכל", משקית שלישות (HR NCO) של אגף
 - במקום "לפי מסמך X" כתבי "לפי הנוהל", "בהתאם לפקודה", "על פי ההנחיות" וכדומה.
 - השתמשי בתבליטים ובמבנה ברור.
 - אם השאלה עמומה, בקשי הבהרה.
+"""
 
-## מידע רלוונטי
+# Sent as a separate system block after SYSTEM_PROMPT
+CONTEXT_PROMPT = """## מידע רלוונטי
 {context}
 """
 
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from server.config import Settings
+
+
+class ModelRouter:
+    """Choose the Claude model for a question.
+
+    Short, single questions whose answer is clearly in the retrieved
+    context go to the fast model. Anything else - follow-ups, long or
+    multi-part questions, or only loosely matching context - goes to the
+    main model.
+    """
+
+    def __init__(self, settings: Settings):
+        self.model = settings.anthropic_model
+        self.fast_model = settings.anthropic_fast_model
+        self.enabled = settings.model_routing and bool(self.fast_model)
+        self.max_words = settings.route_fast_max_words
+        self.min_score = settings.route_fast_min_score
+        self.min_lexical_coverage = settings.lexical_shortcut_coverage
+
+    def choose(
+        self, question: str, context: list[dict], conversation_history: list[dict] | None
+    ) -> tuple[str, str]:
+        """The model to use and the reason, for logging."""
+        if not self.enabled:
+            return self.model, "routing off"
+        if conversation_history:
+            return self.model, "follow-up"
+        if len(question.split()) > self.max_words or question.count("?") > 1:
+            return self.model, "complex question"
+        top = context[0]
+        if top["score"] < self.min_score and top.get("lexical_score", 0.0) < self.min_lexical_coverage:
+            return self.model, "weak context"
+        return self.fast_model, "simple question"
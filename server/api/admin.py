@@ -2,13 +2,22 @@
 import os
 import logging
 
+import numpy as np
 from fastapi import APIRouter, Depends, HTTPException, Query, Request, UploadFile, File
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from server.auth.jwt import require_admin
-from server.database import get_db
+from server.api import quota
+from server.auth.jwt import arequire_admin, require_admin
+from server.database import aget_db, get_db, get_read_db
 from server.models import User, QueryLog
-from server.api.schemas import UserResponse, ReloadQuotaRequest, RatingsListResponse, RatingItem
+from server.api.schemas import (
+    IngestJobResponse,
+    UserResponse,
+    ReloadQuotaRequest,
+    RatingsListResponse,
+    RatingItem,
+)
 
 logger = logging.getLogger("ask-michal")
 
@@ -16,12 +25,13 @@ router = APIRouter(prefix="/admin", tags=["admin"])
 
 MSG_USER_NOT_FOUND = "משתמש לא נמצא"
 MSG_CANNOT_CHANGE_SELF = "לא ניתן לשנות הרשאות עצמיות"
+MSG_JOB_NOT_FOUND = "משימת עיבוד לא נמצאה"
 
 
 @router.get("/users", response_model=list[UserResponse])
 async def list_users(
     admin: User = Depends(require_admin),
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
 ):
     return db.query(User).all()
 
@@ -30,19 +40,18 @@ async def list_users(
 async def reload_quota(
     user_id: int,
     body: ReloadQuotaRequest,
-    admin: User = Depends(require_admin),
-    db: Session = Depends(get_db),
+    admin: User = Depends(arequire_admin),
+    db: AsyncSession = Depends(aget_db),
 ):
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail=MSG_USER_NOT_FOUND)
 
-    user.queries_remaining += body.amount
-    db.commit()
+    new_balance = await quota.credit(db, user.id, body.amount)
 
     return {
         "message": f"נטענו {body.amount} שאילתות למשתמש {user.email}",
-        "new_balance": user.queries_remaining,
+        "new_balance": new_balance,
     }
 
 
@@ -87,39 +96,60 @@ async def upload_pdf(
     return {"message": f"Uploaded {file.filename}", "size_bytes": len(content)}
 
 
-@router.post("/ingest")
+@router.post("/ingest", response_model=IngestJobResponse, status_code=202)
 async def ingest_knowledge_base(
     request: Request,
     clear: bool = Query(False),
+    prune: bool = Query(False),
     admin: User = Depends(require_admin),
 ):
-    from server.rag.ingest import PDFIngestor
-    from server.config import Settings
-
-    settings = Settings()
     kb_dir = "./data/knowledge_base"
 
-    pdfs = [f for f in os.listdir(kb_dir) if f.lower().endswith(".pdf")] if os.path.isdir(kb_dir) else []
+    pdfs = sorted(f for f in os.listdir(kb_dir) if f.lower().endswith(".pdf")) if os.path.isdir(kb_dir) else []
     if not pdfs:
         raise HTTPException(status_code=404, detail="No PDF files found in knowledge_base/")
 
-    logger.info(f"Ingesting {len(pdfs)} PDFs (clear={clear})...")
-    ingestor = PDFIngestor(settings)
+    logger.info(f"Ingesting {len(pdfs)} PDFs (clear={clear}, prune={prune})...")
+    # prune also removes every indexed PDF not in kb_dir, including CLI-ingested ones
+    job = request.app.state.ingest_jobs.submit(
+        [os.path.join(kb_dir, f) for f in pdfs],
+        clear=clear,
+        user_id=admin.id,
+        prune_directory=kb_dir if prune else None,
+    )
+    return IngestJobResponse.from_job(job)
 
-    if clear:
-        ingestor.clear()
 
-    results = ingestor.ingest_directory(kb_dir)
+@router.get("/jobs", response_model=list[IngestJobResponse])
+async def list_ingest_jobs(
+    request: Request,
+    admin: User = Depends(require_admin),
+):
+    return [IngestJobResponse.from_job(job) for job in request.app.state.ingest_jobs.all_jobs()]
 
-    # Reload the engine's retriever with the new index
-    request.app.state.engine.retriever._load_index()
 
-    total = sum(results.values())
-    return {
-        "message": f"Ingested {total} chunks from {len(results)} files",
-        "files": results,
-        "total_chunks": len(ingestor.metadata["chunks"]),
-    }
+@router.get("/jobs/{job_id}", response_model=IngestJobResponse)
+async def get_ingest_job(
+    job_id: str,
+    request: Request,
+    admin: User = Depends(require_admin),
+):
+    job = request.app.state.ingest_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=MSG_JOB_NOT_FOUND)
+    return IngestJobResponse.from_job(job)
+
+
+@router.post("/jobs/{job_id}/cancel", response_model=IngestJobResponse)
+async def cancel_ingest_job(
+    job_id: str,
+    request: Request,
+    admin: User = Depends(require_admin),
+):
+    job = request.app.state.ingest_jobs.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=MSG_JOB_NOT_FOUND)
+    return IngestJobResponse.from_job(job)
 
 
 @router.get("/ratings", response_model=RatingsListResponse)
@@ -129,7 +159,7 @@ async def list_ratings(
     skip: int = Query(0, ge=0),
     limit: int = Query(50, ge=1, le=200),
     admin: User = Depends(require_admin),
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
 ):
     query = db.query(QueryLog).filter(QueryLog.rating.isnot(None))
 
@@ -165,37 +195,63 @@ async def debug_knowledge_base(
 ):
     engine = request.app.state.engine
     retriever = engine.retriever
-    chunks = retriever.metadata.get("chunks", [])
-    sources = list({c["source"] for c in chunks})
-    pages = sorted({c["page"] for c in chunks})
-    samples = [
-        {"page": c["page"], "source": c["source"], "text_preview": c["text"][:300]}
-        for c in chunks[:sample]
-    ]
+    snapshot = retriever.snapshot
+    store = snapshot.store if snapshot.is_ready() else None
+    total = len(store) if store else 0
+    samples = []
+    row_ids = store.live_row_ids()[:sample] if store else []
+    for row_id in row_ids:
+        c = store.get(int(row_id))
+        samples.append(
+            {
+                "page": c["page"],
+                "page_end": c["page_end"],
+                "source": c["source"],
+                "text_preview": c["text"][:300],
+            }
+        )
     return {
-        "total_chunks": len(chunks),
-        "sources": sources,
-        "pages_covered": pages,
-        "index_vectors": retriever.index.ntotal if retriever.index else 0,
+        "total_chunks": total,
+        "sources": list(store.sources) if store else [],
+        "pages_covered": np.unique(store.pages()).tolist() if store else [],
+        "index_vectors": snapshot.index.ntotal if snapshot.index else 0,
+        "kb_version": snapshot.version,
+        "lexical_terms": snapshot.lexical.term_count() if snapshot.lexical else 0,
+        "query_cache": retriever.query_cache.stats(),
+        "answer_cache": engine.answer_cache.stats(),
         "sample_chunks": samples,
     }
 
 
+@router.get("/debug/query-logs")
+async def debug_query_logs(
+    request: Request,
+    admin: User = Depends(require_admin),
+):
+    return request.app.state.query_log_writer.stats()
+
+
 @router.get("/debug/test-retrieval")
 async def debug_test_retrieval(
     request: Request,
     q: str = Query(..., min_length=2),
+    nprobe: int | None = Query(None, ge=1),
+    ef_search: int | None = Query(None, ge=1),
     admin: User = Depends(require_admin),
 ):
     engine = request.app.state.engine
-    retrieved = engine.retriever.retrieve(q)
+    timings = {}
+    retrieved = engine.retriever.retrieve(q, nprobe=nprobe, ef_search=ef_search, timings=timings)
     return {
         "query": q,
+        "timings_ms": timings,
         "results": [
             {
                 "score": r["score"],
+                "lexical_score": r["lexical_score"],
                 "source": r["source"],
                 "page": r["page"],
+                "page_end": r["page_end"],
                 "text_preview": r["text"][:300],
             }
             for r in retrieved
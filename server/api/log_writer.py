@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import itertools
+import logging
+from collections import Counter
+from datetime import datetime, timezone
+
+from sqlalchemy import bindparam, func, insert, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from server.models import QueryLog, User
+
+logger = logging.getLogger("ask-michal")
+
+_users = User.__table__
+_ADD_TOKENS = (
+    update(_users)
+    .where(_users.c.id == bindparam("user"))
+    .values(total_tokens=_users.c.total_tokens + bindparam("tokens"))
+)
+
+
+class QueryLogWriter:
+    """Write-behind buffer for QueryLog rows.
+
+    ``submit`` gives the row its id at once and queues it. The rows are
+    inserted in one transaction once ``batch_size`` are waiting or
+    ``flush_seconds`` have passed, instead of one small transaction per
+    question. The same transaction adds the tokens to ``users.total_tokens``.
+
+    When a batch fails, its rows are written one at a time so one bad row
+    can't hold back the rest. A row that fails on its own is retried at
+    later flushes and dropped, with an error logged, after
+    ``max_attempts`` failures.
+
+    Ids count up from the highest one in the table when the writer
+    starts, so this must be the only process inserting query logs. Ids
+    are not reserved durably: ids handed out for rows lost in a crash are
+    handed out again after the restart, so a client still holding one
+    could rate a later question of the same user (other users' questions
+    are protected by the owner check in /api/rate).
+    """
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker,
+        batch_size: int = 100,
+        flush_seconds: float = 1.0,
+        max_attempts: int = 5,
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_attempts = max_attempts
+        self._ids = None
+        self._queued: dict[int, dict] = {}
+        self._in_flight: dict[int, dict] = {}
+        self._attempts: dict[int, int] = {}  # Failed writes of rows still queued
+        self._flush_lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task = None
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.failed_flushes = 0
+
+    async def start(self):
+        async with self.session_factory() as db:
+            last_id = await db.scalar(select(func.max(QueryLog.id)))
+        self._ids = itertools.count((last_id or 0) + 1)
+        self._task = asyncio.create_task(self._run())
+
+    def submit(self, user_id: int, question: str, usage: dict) -> int:
+        """Queue the log of an answered question (hash only, not raw text)
+        with the engine's usage, and return its id."""
+        query_id = next(self._ids)
+        self._queued[query_id] = {
+            "id": query_id,
+            "user_id": user_id,
+            "question_hash": hashlib.sha256(question.encode()).hexdigest(),
+            "tokens_used": usage["tokens_used"],
+            "cache_read_tokens": usage["cache_read_tokens"],
+            "cache_write_tokens": usage["cache_write_tokens"],
+            "model": usage.get("model"),
+            # The time of the question, not of the flush; naive UTC like func.now()
+            "created_at": datetime.now(timezone.utc).replace(tzinfo=None),
+        }
+        if len(self._queued) >= self.batch_size:
+            self._wake.set()
+        return query_id
+
+    def is_pending(self, query_id: int) -> bool:
+        """Whether the row is not in the database yet."""
+        return query_id in self._queued or query_id in self._in_flight
+
+    def queue_depth(self) -> int:
+        return len(self._queued) + len(self._in_flight)
+
+    async def _write(self, rows: list[dict]):
+        """Insert ``rows`` and add their tokens to the users, in one transaction."""
+        tokens = Counter()
+        for row in rows:
+            tokens[row["user_id"]] += row["tokens_used"]
+        async with self.session_factory() as db:
+            await db.execute(insert(QueryLog), rows)
+            await db.execute(
+                _ADD_TOKENS,
+                [{"user": user_id, "tokens": n} for user_id, n in tokens.items()],
+            )
+            await db.commit()
+
+    async def _write_one_by_one(self, rows: list[dict]) -> dict[int, dict]:
+        """Write rows separately after their batch failed; return the rows to retry."""
+        retry = {}
+        for row in rows:
+            try:
+                await self._write([row])
+                self.rows_written += 1
+                self._attempts.pop(row["id"], None)
+                del self._in_flight[row["id"]]
+            except Exception as e:
+                attempts = self._attempts.get(row["id"], 0) + 1
+                if attempts >= self.max_attempts:
+                    self.rows_dropped += 1
+                    self._attempts.pop(row["id"], None)
+                    logger.error(f"Dropped query log {row['id']} after {attempts} failed writes: {e}")
+                else:
+                    self._attempts[row["id"]] = attempts
+                    retry[row["id"]] = row
+                del self._in_flight[row["id"]]
+        return retry
+
+    async def flush(self):
+        """Write every row submitted so far.
+
+        Rows that fail to write are retried at the next flush, up to
+        ``max_attempts`` times each.
+        """
+        async with self._flush_lock:
+            if not self._queued:
+                return
+            self._in_flight, self._queued = self._queued, {}
+            rows = list(self._in_flight.values())
+            retry = {}
+            try:
+                try:
+                    await self._write(rows)
+                    self.rows_written += len(rows)
+                    for row in rows:
+                        self._attempts.pop(row["id"], None)
+                    self._in_flight = {}
+                except Exception as e:
+                    self.failed_flushes += 1
+                    logger.error(f"Writing {len(rows)} query logs failed, writing them one by one: {e}")
+                    retry = await self._write_one_by_one(rows)
+            finally:
+                # Rows not yet written, also on cancellation, so close() still writes them
+                self._queued = {**retry, **self._in_flight, **self._queued}
+                self._in_flight = {}
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def close(self):
+        """Stop the background flushes and write what is left."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._queued:
+            logger.error(f"{len(self._queued)} query logs were not written at shutdown")
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth(),
+            "batch_size": self.batch_size,
+            "rows_written": self.rows_written,
+            "rows_dropped": self.rows_dropped,
+            "failed_flushes": self.failed_flushes,
+        }
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Question quota accounting.
+
+Every change to ``users.queries_remaining`` is a single conditional
+UPDATE, so concurrent requests from the same user can't overwrite each
+other's counts the way reading the row, changing it in Python and
+writing it back would. ``users.queries_used`` moves in the same
+statement when a question is taken or given back.
+"""
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from server.models import User
+
+
+def _add(user_id: int, amount: int, used: int = 0):
+    values = {"queries_remaining": User.queries_remaining + amount}
+    if used:
+        values["queries_used"] = User.queries_used + used
+    return (
+        update(User)
+        .where(User.id == user_id)
+        .values(**values)
+        .returning(User.queries_remaining)
+    )
+
+
+async def reserve(db: AsyncSession, user_id: int) -> int | None:
+    """Take one question from the user's quota before answering it.
+
+    Returns the questions left afterwards, or None if the quota was
+    already used up. Commits at once so the row isn't locked while the
+    question is answered.
+    """
+    stmt = _add(user_id, -1, used=1).where(User.queries_remaining > 0)
+    remaining = (await db.execute(stmt)).scalar_one_or_none()
+    await db.commit()
+    return remaining
+
+
+async def release(db: AsyncSession, user_id: int) -> int | None:
+    """Give back a reserved question that wasn't answered."""
+    await db.rollback()
+    remaining = (await db.execute(_add(user_id, 1, used=-1))).scalar_one_or_none()
+    await db.commit()
+    return remaining
+
+
+async def credit(db: AsyncSession, user_id: int, amount: int) -> int | None:
+    """Add questions to the user's quota, together with any pending changes
+    in ``db``. Returns the new balance, or None if there is no such user."""
+    remaining = (await db.execute(_add(user_id, amount))).scalar_one_or_none()
+    await db.commit()
+    return remaining
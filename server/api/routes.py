@@ -1,70 +1,120 @@
 # -*- coding: utf-8 -*-
-import hashlib
+import json
 import logging
 import os
 from datetime import datetime, timezone
 
 from fastapi import APIRouter, Depends, HTTPException, Request, UploadFile, File
-from sqlalchemy.orm import Session
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from server.auth.jwt import get_current_user
-from server.database import get_db
+from server.api import quota
+from server.auth.jwt import aget_current_user
+from server.database import AsyncSessionLocal, aget_db
 from server.models import User, QueryLog
-from server.api.schemas import AskRequest, AskResponse, QuotaResponse, RateRequest, RateResponse
+from server.api.schemas import (
+    AskRequest,
+    AskResponse,
+    IngestJobResponse,
+    QuotaResponse,
+    RateRequest,
+    RateResponse,
+)
 
 logger = logging.getLogger("ask-michal")
 router = APIRouter(prefix="/api", tags=["api"])
 
 MSG_QUOTA_EXHAUSTED = "מכסת השאלות שלך נגמרה. לקבלת שאלות נוספות פנה/י למנהל המערכת: bar@yae.la"
 MSG_INTERNAL_ERROR = "שגיאה פנימית. נסה/י שנית."
+MSG_JOB_NOT_FOUND = "משימת עיבוד לא נמצאה"
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 
 @router.post("/ask", response_model=AskResponse)
 async def ask_question(
     body: AskRequest,
     request: Request,
-    user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    user: User = Depends(aget_current_user),
+    db: AsyncSession = Depends(aget_db),
 ):
-    if user.queries_remaining <= 0:
+    user_id = user.id
+    queries_remaining = await quota.reserve(db, user_id)
+    if queries_remaining is None:
         raise HTTPException(status_code=429, detail=MSG_QUOTA_EXHAUSTED)
 
-    # Decrement quota optimistically
-    user.queries_remaining -= 1
-    db.commit()
-
     try:
         engine = request.app.state.engine
-        result = engine.ask(body.question)
+        result = await engine.aask(body.question)
 
-        # Log the query (hash only, not raw text)
-        log = QueryLog(
-            user_id=user.id,
-            question_hash=hashlib.sha256(body.question.encode()).hexdigest(),
-            tokens_used=result["tokens_used"],
-        )
-        db.add(log)
-        db.commit()
-        db.refresh(log)
+        query_id = request.app.state.query_log_writer.submit(user_id, body.question, result)
 
         return AskResponse(
             answer=result["answer"],
             sources=result["sources"],
-            queries_remaining=user.queries_remaining,
-            query_id=log.id,
+            queries_remaining=queries_remaining,
+            query_id=query_id,
         )
     except Exception:
         # Restore quota on failure
-        user.queries_remaining += 1
-        db.commit()
+        await quota.release(db, user_id)
         raise HTTPException(status_code=500, detail=MSG_INTERNAL_ERROR)
 
 
-@router.post("/upload-pdf")
+@router.post("/ask/stream")
+async def ask_question_stream(
+    body: AskRequest,
+    request: Request,
+    user: User = Depends(aget_current_user),
+    db: AsyncSession = Depends(aget_db),
+):
+    """Like /ask, but streams the answer as server-sent events.
+
+    Events: ``sources`` first, ``delta`` chunks of answer text, then ``done``
+    with ``query_id`` and ``queries_remaining`` (or ``error``).
+    """
+    user_id = user.id
+    queries_remaining = await quota.reserve(db, user_id)
+    if queries_remaining is None:
+        raise HTTPException(status_code=429, detail=MSG_QUOTA_EXHAUSTED)
+
+    engine = request.app.state.engine
+    log_writer = request.app.state.query_log_writer
+
+    async def events():
+        logged = False
+        try:
+            async for event, data in engine.astream(body.question):
+                if event != "done":
+                    yield _sse(event, data)
+                    continue
+                query_id = log_writer.submit(user_id, body.question, data)
+                logged = True
+                yield _sse("done", {"query_id": query_id, "queries_remaining": queries_remaining})
+        except Exception as e:
+            logger.error(f"Streaming answer failed: {e}")
+            yield _sse("error", {"detail": MSG_INTERNAL_ERROR})
+        finally:
+            if not logged:
+                # Restore quota on failure or client disconnect. The
+                # request's session is closed once the response starts.
+                async with AsyncSessionLocal() as session:
+                    await quota.release(session, user_id)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post("/upload-pdf", status_code=202)
 async def upload_pdf(
     request: Request,
     file: UploadFile = File(...),
-    user: User = Depends(get_current_user),
+    user: User = Depends(aget_current_user),
 ):
     if not file.filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="ניתן להעלות קבצי PDF בלבד")
@@ -77,47 +127,50 @@ async def upload_pdf(
     with open(path, "wb") as f:
         f.write(content)
 
-    # Ingest the new PDF
-    try:
-        from server.rag.ingest import PDFIngestor
-        from server.config import Settings
-
-        ingestor = PDFIngestor(Settings())
-        chunks = ingestor.ingest_pdf(path)
+    # Ingest in the background; the client polls /api/jobs/{job_id}
+    job = request.app.state.ingest_jobs.submit([path], user_id=user.id)
+    logger.info(f"User {user.email} uploaded {file.filename}: ingest job {job.id}")
+    return {
+        "message": f"הקובץ {file.filename} הועלה ונמצא בעיבוד",
+        "job_id": job.id,
+    }
 
-        # Reload the retriever with updated index
-        request.app.state.engine.retriever._load_index()
 
-        logger.info(f"User {user.email} uploaded {file.filename}: {chunks} chunks")
-        return {
-            "message": f"הקובץ {file.filename} הועלה ועובד בהצלחה",
-            "chunks": chunks,
-        }
-    except Exception as e:
-        logger.error(f"Failed to ingest {file.filename}: {e}")
-        raise HTTPException(status_code=500, detail="שגיאה בעיבוד הקובץ")
+@router.get("/jobs/{job_id}", response_model=IngestJobResponse)
+async def get_ingest_job(
+    job_id: str,
+    request: Request,
+    user: User = Depends(aget_current_user),
+):
+    job = request.app.state.ingest_jobs.get(job_id)
+    if not job or (job.user_id != user.id and not user.is_admin):
+        raise HTTPException(status_code=404, detail=MSG_JOB_NOT_FOUND)
+    return IngestJobResponse.from_job(job)
 
 
 @router.get("/quota", response_model=QuotaResponse)
 async def get_quota(
-    user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    user: User = Depends(aget_current_user),
 ):
-    queries_used = db.query(QueryLog).filter(QueryLog.user_id == user.id).count()
     return QuotaResponse(
         queries_remaining=user.queries_remaining,
-        queries_used=queries_used,
-        total_quota=queries_used + user.queries_remaining,
+        queries_used=user.queries_used,
+        total_quota=user.queries_used + user.queries_remaining,
     )
 
 
 @router.post("/rate", response_model=RateResponse)
 async def rate_answer(
     body: RateRequest,
-    user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    request: Request,
+    user: User = Depends(aget_current_user),
+    db: AsyncSession = Depends(aget_db),
 ):
-    log = db.query(QueryLog).filter(QueryLog.id == body.query_id).first()
+    log_writer = request.app.state.query_log_writer
+    if log_writer.is_pending(body.query_id):
+        # Rated right after answering: write the log first
+        await log_writer.flush()
+    log = await db.get(QueryLog, body.query_id)
     if not log:
         raise HTTPException(status_code=404, detail="שאילתה לא נמצאה")
 
@@ -131,10 +184,10 @@ async def rate_answer(
     log.rating_comment = body.comment
     log.rated_at = datetime.now(timezone.utc)
 
-    user.queries_remaining += 1
-    db.commit()
+    # Rating earns a question back, in the same transaction as the rating
+    queries_remaining = await quota.credit(db, user.id, 1)
 
     return RateResponse(
         message="תודה על הדירוג!",
-        queries_remaining=user.queries_remaining,
+        queries_remaining=queries_remaining,
     )
@@ -26,6 +26,8 @@ class UserResponse(BaseModel):
     email: str
     name: str
     queries_remaining: int
+    queries_used: int
+    total_tokens: int
     is_admin: bool
     created_at: datetime | None
     last_login: datetime | None
@@ -63,3 +65,35 @@ class RatingsListResponse(BaseModel):
 
 class ReloadQuotaRequest(BaseModel):
     amount: int = Field(..., gt=0, le=1000)
+
+
+class IngestJobResponse(BaseModel):
+    job_id: str
+    status: str
+    files_total: int
+    files_done: int
+    chunks_embedded: int
+    chunks_removed: int
+    results: dict[str, int]
+    eta_seconds: float | None
+    error: str | None
+    created_at: datetime
+    started_at: datetime | None
+    finished_at: datetime | None
+
+    @classmethod
+    def from_job(cls, job) -> "IngestJobResponse":
+        return cls(
+            job_id=job.id,
+            status=job.status,
+            files_total=job.files_total,
+            files_done=job.files_done,
+            chunks_embedded=job.chunks_embedded,
+            chunks_removed=job.chunks_removed,
+            results=dict(job.results),
+            eta_seconds=job.eta_seconds,
+            error=job.error,
+            created_at=job.created_at,
+            started_at=job.started_at,
+            finished_at=job.finished_at,
+        )
@@ -4,10 +4,11 @@ from datetime import datetime, timedelta, timezone
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import jwt, JWTError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from server.config import Settings
-from server.database import get_db
+from server.database import aget_db, get_db
 from server.models import User
 
 settings = Settings()
@@ -45,13 +46,7 @@ def decode_token(token: str) -> dict:
         )
 
 
-async def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db),
-) -> User:
-    payload = decode_token(credentials.credentials)
-    user_id = int(payload["sub"])
-    user = db.query(User).filter(User.id == user_id).first()
+def _found(user: User | None) -> User:
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -60,10 +55,36 @@ async def get_current_user(
     return user
 
 
-async def require_admin(user: User = Depends(get_current_user)) -> User:
+def _admin(user: User) -> User:
     if not user.is_admin:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=MSG_ADMIN_REQUIRED,
         )
     return user
+
+
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: Session = Depends(get_db),
+) -> User:
+    payload = decode_token(credentials.credentials)
+    user_id = int(payload["sub"])
+    return _found(db.query(User).filter(User.id == user_id).first())
+
+
+async def require_admin(user: User = Depends(get_current_user)) -> User:
+    return _admin(user)
+
+
+async def aget_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: AsyncSession = Depends(aget_db),
+) -> User:
+    """get_current_user on the async session, for routes that use aget_db."""
+    payload = decode_token(credentials.credentials)
+    return _found(await db.get(User, int(payload["sub"])))
+
+
+async def arequire_admin(user: User = Depends(aget_current_user)) -> User:
+    return _admin(user)
@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -17,19 +19,78 @@ class Settings(BaseSettings):
     # Anthropic
     anthropic_api_key: str = ""
     anthropic_model: str = "claude-opus-4-6"
+    # Short questions with strongly matching context go to the fast model
+    anthropic_fast_model: str = "claude-haiku-4-5"
+    model_routing: bool = True
+    route_fast_max_words: int = 25
+    route_fast_min_score: float = 0.6  # Cosine of the top chunk
+    max_input_tokens: int = 8000  # Prompt budget; low-ranked chunks are dropped to fit
+    rag_worker_threads: int = 4  # Threads for embedding + FAISS search off the event loop
+
+    # Semantic answer cache
+    answer_cache_size: int = 256
+    answer_cache_ttl_seconds: int = 3600
+    answer_cache_threshold: float = 0.95
 
     # RAG
     embedding_model: str = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
     faiss_index_path: str = "./data/faiss_index"
+    max_store_segments: int = 8  # Merge chunk store segments beyond this many
+    # Chunk size and overlap in embedding model tokens
     chunk_size: int = 200
     chunk_overlap: int = 30
+    # Page cleaning: a line among the first / last header_scan_lines of a page
+    # that recurs on header_min_page_share of the document's pages is removed
+    header_scan_lines: int = 3
+    header_min_page_share: float = 0.5
+    embedding_batch_size: int = 64
+    ingest_jobs: int = 1
     retrieval_top_k: int = 5
+    query_embedding_cache_size: int = 1024
+
+    # Hybrid retrieval: BM25 over chunk text fused with the vector search
+    hybrid_retrieval: bool = True
+    hybrid_candidates: int = 20  # Results taken from each side before fusion
+    rrf_k: int = 60  # Reciprocal rank fusion constant
+    lexical_min_coverage: float = 0.8  # Share of the query a chunk must contain to count as relevant
+    # Query words found in more than this share of the chunks (and in more
+    # than one) are too common to count toward that share
+    lexical_max_term_share: float = 0.05
+    # Skip the vector search when one chunk contains the whole query and
+    # outscores the next one by this factor
+    lexical_shortcut_coverage: float = 1.0
+    lexical_shortcut_margin: float = 1.5
+
+    # Vector index: "flat" (exact), "ivf" or "hnsw" (approximate), "sq8" or
+    # "pq" (compressed, 4x / 32x smaller, candidates re-scored exactly)
+    faiss_index_type: str = "flat"
+    faiss_ivf_nlist: int = 256
+    faiss_ivf_nprobe: int = 16
+    faiss_hnsw_m: int = 32
+    faiss_hnsw_ef_construction: int = 80
+    faiss_hnsw_ef_search: int = 64
+    faiss_pq_m: int = 48  # PQ sub-quantizers, i.e. bytes per vector
+    faiss_rerank_factor: int = 4  # sq8 / pq: fetch k times this, then re-score exactly
 
     # Quota
     default_query_quota: int = 3
 
     # Database
     database_url: str = "sqlite:///./data/michal.db"
+    db_pool_size: int = 5
+    db_max_overflow: int = 5
+    db_pool_timeout: int = 30  # Seconds to wait for a free connection
+    db_read_pool_size: int = 3  # Separate read-only connections for admin analytics
+    # Query logs are buffered and inserted in batches of this many, or this often
+    query_log_batch_size: int = 100
+    query_log_flush_seconds: float = 1.0
+    query_log_max_attempts: int = 5  # A row failing this many writes is dropped
+    # SQLite pragmas, set on every connection
+    sqlite_wal: bool = True
+    sqlite_synchronous: Literal["OFF", "NORMAL", "FULL", "EXTRA"] = "NORMAL"
+    sqlite_busy_timeout_ms: int = 5000  # Wait this long for a lock instead of failing
+    sqlite_cache_size_kb: int = 16384
+    sqlite_mmap_size_mb: int = 256
 
     # Server
     host: str = "0.0.0.0"
@@ -1,18 +1,107 @@
 import logging
 
-from sqlalchemy import create_engine, inspect, text
+from sqlalchemy import create_engine, event, func, inspect, or_, select, text, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import DeclarativeBase, sessionmaker
 
 from server.config import Settings
 
 logger = logging.getLogger("ask-michal")
 
+
+def sqlite_pragmas(settings: Settings, read_only: bool = False) -> list[str]:
+    """PRAGMA statements run on every new SQLite connection."""
+    pragmas = [
+        f"PRAGMA busy_timeout = {settings.sqlite_busy_timeout_ms}",
+        f"PRAGMA synchronous = {settings.sqlite_synchronous}",
+        # Negative cache_size is in KiB rather than pages
+        f"PRAGMA cache_size = -{settings.sqlite_cache_size_kb}",
+        f"PRAGMA mmap_size = {settings.sqlite_mmap_size_mb * 1024 * 1024}",
+    ]
+    if read_only:
+        pragmas.append("PRAGMA query_only = ON")
+    elif settings.sqlite_wal:
+        # Readers see the last commit and don't block the writer, or the other way round
+        pragmas.insert(0, "PRAGMA journal_mode = WAL")
+    return pragmas
+
+
+def _apply_pragmas(engine, settings: Settings, read_only: bool = False):
+    if engine.dialect.name != "sqlite":
+        return
+    pragmas = sqlite_pragmas(settings, read_only)
+
+    @event.listens_for(engine, "connect")
+    def _configure(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def _pool_args(url: str, pool_size: int, max_overflow: int, pool_timeout: int) -> dict:
+    """Pool sizing for a QueuePool, or nothing for an in-memory SQLite database,
+    whose single-connection pool takes no sizing arguments."""
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite" and (
+        parsed.database in (None, "", ":memory:") or parsed.query.get("mode") == "memory"
+    ):
+        return {}
+    return {"pool_size": pool_size, "max_overflow": max_overflow, "pool_timeout": pool_timeout}
+
+
+def create_db_engine(settings: Settings, read_only: bool = False):
+    """Engine with an explicitly sized pool and SQLite tuned for concurrent use.
+
+    The read-only engine has its own pool, so long analytics queries never
+    hold a connection the request path needs.
+    """
+    engine = create_engine(
+        settings.database_url,
+        connect_args={"check_same_thread": False},
+        **_pool_args(
+            settings.database_url,
+            settings.db_read_pool_size if read_only else settings.db_pool_size,
+            0 if read_only else settings.db_max_overflow,
+            settings.db_pool_timeout,
+        ),
+    )
+    _apply_pragmas(engine, settings, read_only)
+    return engine
+
+
+def async_database_url(url: str) -> str:
+    """``url`` with the async driver: aiosqlite for SQLite."""
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite" and parsed.get_driver_name() != "aiosqlite":
+        parsed = parsed.set(drivername="sqlite+aiosqlite")
+    return parsed.render_as_string(hide_password=False)
+
+
+def create_async_db_engine(settings: Settings):
+    """Async engine for the request path, with the same pool sizing and pragmas."""
+    engine = create_async_engine(
+        async_database_url(settings.database_url),
+        **_pool_args(
+            settings.database_url,
+            settings.db_pool_size,
+            settings.db_max_overflow,
+            settings.db_pool_timeout,
+        ),
+    )
+    _apply_pragmas(engine.sync_engine, settings)
+    return engine
+
+
 settings = Settings()
-engine = create_engine(
-    settings.database_url,
-    connect_args={"check_same_thread": False},
-)
+engine = create_db_engine(settings)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+read_engine = create_db_engine(settings, read_only=True)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+async_engine = create_async_db_engine(settings)
+# Objects stay readable after commit: reloading them would need an await
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 
 class Base(DeclarativeBase):
@@ -28,22 +117,89 @@ def get_db():
         db.close()
 
 
-def _migrate_rating_columns():
-    """Add rating columns to query_logs if they don't exist (SQLite migration)."""
+async def aget_db():
+    """FastAPI dependency for async database sessions, for the hot request path."""
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def get_read_db():
+    """FastAPI dependency for read-only sessions, for admin listings and analytics."""
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def _add_missing_columns(table: str, migrations: dict[str, str]) -> list[str]:
+    """Add the columns of ``migrations`` that ``table`` lacks (SQLite migration)."""
     inspector = inspect(engine)
-    existing = {col["name"] for col in inspector.get_columns("query_logs")}
-    migrations = {
-        "rating": "INTEGER",
-        "rating_comment": "TEXT",
-        "rated_at": "DATETIME",
-    }
+    existing = {col["name"] for col in inspector.get_columns(table)}
+    added = []
     with engine.begin() as conn:
         for col_name, col_type in migrations.items():
             if col_name not in existing:
                 conn.execute(text(
-                    f"ALTER TABLE query_logs ADD COLUMN {col_name} {col_type}"
+                    f"ALTER TABLE {table} ADD COLUMN {col_name} {col_type}"
                 ))
-                logger.info(f"Migrated: added column query_logs.{col_name}")
+                added.append(col_name)
+                logger.info(f"Migrated: added column {table}.{col_name}")
+    return added
+
+
+def _migrate_query_log_columns():
+    """Add newer columns to query_logs if they don't exist."""
+    _add_missing_columns("query_logs", {
+        "rating": "INTEGER",
+        "rating_comment": "TEXT",
+        "rated_at": "DATETIME",
+        "cache_read_tokens": "INTEGER NOT NULL DEFAULT 0",
+        "cache_write_tokens": "INTEGER NOT NULL DEFAULT 0",
+        "model": "VARCHAR",
+    })
+
+
+def _migrate_user_columns():
+    """Add the usage counters to users, filled in from query_logs."""
+    added = _add_missing_columns("users", {
+        "queries_used": "INTEGER NOT NULL DEFAULT 0",
+        "total_tokens": "INTEGER NOT NULL DEFAULT 0",
+    })
+    if added:
+        rebuild_usage_counters()
+
+
+def rebuild_usage_counters(bind=None) -> int:
+    """Recount users.queries_used and users.total_tokens from query_logs.
+
+    The counters are kept up to date as questions are asked; this backfills
+    them and repairs any drift. Questions still being answered are not in
+    query_logs yet, so run it while the server is stopped. Returns the
+    number of users whose counters were corrected.
+    """
+    from server.models import QueryLog, User
+
+    logs = QueryLog.__table__
+    users = User.__table__
+    queries = (
+        select(func.count()).where(logs.c.user_id == users.c.id).scalar_subquery()
+    )
+    tokens = (
+        select(func.coalesce(func.sum(logs.c.tokens_used), 0))
+        .where(logs.c.user_id == users.c.id)
+        .scalar_subquery()
+    )
+    stmt = (
+        update(users)
+        .where(or_(users.c.queries_used != queries, users.c.total_tokens != tokens))
+        .values(queries_used=queries, total_tokens=tokens)
+    )
+    with (bind or engine).begin() as conn:
+        repaired = conn.execute(stmt).rowcount
+    if repaired:
+        logger.info(f"Rebuilt usage counters of {repaired} users")
+    return repaired
 
 
 def _promote_initial_admin():
@@ -68,7 +224,11 @@ def init_db():
     """Create all tables."""
     Base.metadata.create_all(bind=engine)
     try:
-        _migrate_rating_columns()
+        _migrate_query_log_columns()
+    except Exception:
+        pass
+    try:
+        _migrate_user_columns()
     except Exception:
         pass
     try:
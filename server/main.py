@@ -8,10 +8,12 @@ from fastapi.responses import HTMLResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from server.config import Settings
-from server.database import init_db
+from server.database import AsyncSessionLocal, async_engine, init_db
 from server.auth.oauth import router as auth_router
 from server.api.routes import router as api_router
 from server.api.admin import router as admin_router
+from server.api.log_writer import QueryLogWriter
+from server.rag.jobs import IngestJobManager
 from server.rag.retriever import KnowledgeRetriever
 from server.ai.engine import MichalEngine
 
@@ -36,9 +38,22 @@ async def lifespan(app: FastAPI):
         )
 
     app.state.engine = MichalEngine(settings, retriever)
+    # Reload the retriever whenever a background ingest job changes the index
+    app.state.ingest_jobs = IngestJobManager(settings, on_index_changed=retriever.reload)
+    app.state.query_log_writer = QueryLogWriter(
+        AsyncSessionLocal,
+        settings.query_log_batch_size,
+        settings.query_log_flush_seconds,
+        settings.query_log_max_attempts,
+    )
+    await app.state.query_log_writer.start()
     logger.info("Ask Michal server ready.")
     yield
     # Shutdown
+    app.state.ingest_jobs.shutdown(timeout=30)
+    app.state.engine.shutdown()
+    await app.state.query_log_writer.close()
+    await async_engine.dispose()
 
 
 app = FastAPI(
@@ -12,6 +12,9 @@ class User(Base):
     email = Column(String, unique=True, nullable=False, index=True)
     name = Column(String, nullable=False)
     queries_remaining = Column(Integer, nullable=False, default=50)
+    # Running totals of query_logs, so /api/quota doesn't count the history
+    queries_used = Column(Integer, nullable=False, default=0, server_default="0")
+    total_tokens = Column(Integer, nullable=False, default=0, server_default="0")
     is_admin = Column(Boolean, default=False, nullable=False)
     created_at = Column(DateTime, server_default=func.now())
     last_login = Column(DateTime, onupdate=func.now())
@@ -26,6 +29,10 @@ class QueryLog(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     question_hash = Column(String, nullable=False)
     tokens_used = Column(Integer, nullable=False)
+    # Prompt cache input tokens, already counted in tokens_used
+    cache_read_tokens = Column(Integer, nullable=False, default=0, server_default="0")
+    cache_write_tokens = Column(Integer, nullable=False, default=0, server_default="0")
+    model = Column(String, nullable=True)  # Claude model that answered, if any
     created_at = Column(DateTime, server_default=func.now())
 
     rating = Column(Integer, nullable=True)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import re
+
+import numpy as np
+from tokenizers import Tokenizer
+
+_WORD = re.compile(r"\S+")
+
+
+def token_spans(text: str, tokenizer: Tokenizer | None) -> tuple[np.ndarray, np.ndarray]:
+    """Character spans of the tokens of ``text``, as ``(bounds, word_start)``.
+
+    ``bounds`` is an (n, 2) array of start / end offsets and ``word_start``
+    marks the tokens that begin a word. Without a tokenizer every
+    whitespace-separated word is a single token.
+    """
+    if tokenizer is None:
+        flat = np.fromiter(
+            (offset for match in _WORD.finditer(text) for offset in match.span()), dtype=np.int64
+        )
+        bounds = flat.reshape(-1, 2)
+        return bounds, np.ones(len(bounds), dtype=bool)
+    encoding = tokenizer.encode(text, add_special_tokens=False)
+    bounds = np.array(encoding.offsets, dtype=np.int64).reshape(-1, 2)
+    words = np.array([-1 if w is None else w for w in encoding.word_ids], dtype=np.int64)
+    word_start = np.ones(len(words), dtype=bool)
+    word_start[1:] = words[1:] != words[:-1]
+    return bounds, word_start
+
+
+def chunk_spans(
+    bounds: np.ndarray, word_start: np.ndarray, size: int, overlap: int
+) -> list[tuple[int, int]]:
+    """Character ranges of overlapping chunks of at most ``size`` tokens.
+
+    Chunks end before a word rather than inside it, unless a single word is
+    longer than a whole chunk, and the next chunk starts ``overlap`` tokens
+    back, also at a word.
+    """
+    n = len(bounds)
+    if n == 0:
+        return []
+    # For every token, the position of the token that starts its word
+    word_first = np.maximum.accumulate(np.where(word_start, np.arange(n), 0))
+    spans = []
+    first = 0
+    while True:
+        last = min(first + size, n)  # exclusive
+        if last < n and word_first[last] > first:
+            last = int(word_first[last])
+        spans.append((int(bounds[first, 0]), int(bounds[last - 1, 1])))
+        if last == n:
+            return spans
+        next_first = int(word_first[max(last - overlap, 0)])
+        first = next_first if next_first > first else last
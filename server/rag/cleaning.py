@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import re
+from collections import Counter
+
+# Classification marks (בלמ"ס), wherever they appear on the page
+_CLASSIFICATION = re.compile(r"-?\s*בלמ\"?ס\s*-?")
+
+# Headers of the AKA standing orders. The repeated-line pass finds headers
+# like these by itself; these stay for documents too short for it.
+_KNOWN_HEADERS = re.compile(
+    r"מטכ\"?ל\s+אכ\"?א\d*\s+חט'\s+תכנון\s+ומנהל\s+כ\"א\s+תכנון\s+כ\"א\s+מילואים\s+ענף\s+ושמ\"פ\s+מדור\s+תע\"ם"
+    r"|הוראת קבע אכ\"?א[\d\-]+"
+)
+_KNOWN_FRAGMENTS = frozenset(("מדור תע\"ם", "ענף ושמ\"פ", "תכנון כ\"א", "חט' תכנון"))
+
+# Standalone page numbers: "12", "- 12 -"
+_PAGE_NUMBER = re.compile(r"-?\s*\d+\s*-?")
+
+_DIGITS = re.compile(r"\d+")
+_LETTER = re.compile(r"[^\W\d_]")
+
+# Fewer pages than this give too little evidence to call a line repeated
+MIN_PAGES_FOR_REPEATS = 3
+
+
+def _page_lines(text: str) -> list[str]:
+    """Non-empty lines of a page, without known marks and page numbers."""
+    # Neither pattern starts with a literal the regex engine can skip ahead
+    # to, so test for a word they share before running them
+    if "בלמ" in text:
+        text = _CLASSIFICATION.sub("", text)
+    if "אכ" in text:
+        text = _KNOWN_HEADERS.sub("", text)
+    lines = []
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if not stripped or stripped in _KNOWN_FRAGMENTS or _PAGE_NUMBER.fullmatch(stripped):
+            continue
+        lines.append(line)
+    return lines
+
+
+def _line_key(line: str) -> str:
+    """Lines that differ only in numbers or spacing ("עמוד 3 מתוך 9") share a key."""
+    return " ".join(_DIGITS.sub("#", line).split())
+
+
+def _edge(lines: list[str], scan_lines: int) -> list[int]:
+    """Positions of the first and last ``scan_lines`` lines."""
+    if len(lines) <= 2 * scan_lines:
+        return list(range(len(lines)))
+    return [*range(scan_lines), *range(len(lines) - scan_lines, len(lines))]
+
+
+def repeated_lines(pages: list[list[str]], scan_lines: int, min_page_share: float) -> set[str]:
+    """Keys of the lines found near the top or bottom of many pages.
+
+    A line counts once per page, and only if it is one of the first or
+    last ``scan_lines`` lines there. Lines on at least ``min_page_share``
+    of the pages are headers, footers or marks.
+    """
+    if len(pages) < MIN_PAGES_FOR_REPEATS:
+        return set()
+    counts = Counter()
+    for lines in pages:
+        keys = {_line_key(lines[i]) for i in _edge(lines, scan_lines)}
+        # Letterless lines ("1.", "*") are list markers and the like, not headers
+        counts.update(key for key in keys if _LETTER.search(key))
+    threshold = max(MIN_PAGES_FOR_REPEATS, min_page_share * len(pages))
+    return {key for key, count in counts.items() if count >= threshold}
+
+
+def clean_pages(texts: list[str], scan_lines: int = 3, min_page_share: float = 0.5) -> list[str]:
+    """Clean the pages of one document for embedding.
+
+    Drops empty lines, page numbers and known marks, then removes the lines
+    repeated across the document's pages in one sweep. Returns one string
+    per page, empty if nothing is left.
+    """
+    pages = [_page_lines(text) for text in texts]
+    repeated = repeated_lines(pages, scan_lines, min_page_share)
+    cleaned = []
+    for lines in pages:
+        if repeated:
+            noise = {i for i in _edge(lines, scan_lines) if _line_key(lines[i]) in repeated}
+            lines = [line for i, line in enumerate(lines) if i not in noise]
+        cleaned.append("\n".join(lines).strip())
+    return cleaned
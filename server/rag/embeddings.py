@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import threading
+from pathlib import Path
+
+from fastembed import TextEmbedding
+from tokenizers import Tokenizer
+
+# One ONNX session per model name for the whole process. The retriever and
+# every ingestor share it instead of each loading their own copy.
+_models: dict[str, TextEmbedding] = {}
+_dimensions: dict[str, int] = {}
+_tokenizers: dict[str, Tokenizer] = {}
+_lock = threading.Lock()
+
+
+def get_embedding_model(model_name: str) -> TextEmbedding:
+    """Return the process-wide embedding model, loading it on first use."""
+    model = _models.get(model_name)
+    if model is None:
+        with _lock:
+            model = _models.get(model_name)
+            if model is None:
+                model = TextEmbedding(model_name)
+                _models[model_name] = model
+    return model
+
+
+def get_embedding_dimension(model_name: str) -> int:
+    """Return the vector dimension of a model without a throwaway embedding when possible."""
+    dimension = _dimensions.get(model_name)
+    if dimension is None:
+        try:
+            dimension = TextEmbedding.get_embedding_size(model_name)
+        except (AttributeError, ValueError):
+            # Older fastembed or a custom model: learn it from a test embedding
+            dimension = len(next(iter(get_embedding_model(model_name).embed(["test"]))))
+        _dimensions[model_name] = dimension
+    return dimension
+
+
+def get_tokenizer(model_name: str) -> Tokenizer:
+    """Return the model's tokenizer, for sizing chunks in its tokens.
+
+    Read from the tokenizer.json in fastembed's model cache, the file the
+    ONNX session tokenizes with, so chunk boundaries don't depend on
+    reaching the HuggingFace Hub. The model is not loaded (lazy_load), so
+    ingestion worker processes get the tokenizer cheaply. Truncation is off
+    so whole documents can be measured.
+
+    Raises RuntimeError if the tokenizer can't be loaded, rather than
+    sizing chunks in another unit: that would move every chunk boundary.
+    """
+    tokenizer = _tokenizers.get(model_name)
+    if tokenizer is None:
+        with _lock:
+            tokenizer = _tokenizers.get(model_name)
+            if tokenizer is None:
+                try:
+                    model_dir = Path(TextEmbedding(model_name, lazy_load=True).model._model_dir)
+                    tokenizer = Tokenizer.from_file(str(model_dir / "tokenizer.json"))
+                except Exception as e:
+                    raise RuntimeError(
+                        f"Cannot load the tokenizer of {model_name}; chunk sizes are counted in its tokens"
+                    ) from e
+                tokenizer.no_truncation()
+                tokenizer.no_padding()
+                _tokenizers[model_name] = tokenizer
+    return tokenizer
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+import time
+
+import faiss
+import numpy as np
+
+from server.config import Settings
+
+INDEX_TYPES = ("flat", "ivf", "hnsw", "sq8", "pq")
+
+# Compressed types: candidates are re-scored against the stored float vectors
+QUANTIZED_TYPES = ("sq8", "pq")
+
+# FAISS recommends at least this many training points per IVF list / PQ centroid
+MIN_TRAIN_POINTS_PER_LIST = 39
+
+# A flat index stands in for quantized ones until there is this much to train on
+MIN_QUANTIZER_TRAIN_POINTS = 1024
+# PQ training time grows with the sample; 256 centroids need no more than this
+MAX_PQ_TRAIN_POINTS = 256 * MIN_TRAIN_POINTS_PER_LIST
+
+
+def _base_index(index: faiss.Index) -> faiss.Index:
+    """The index doing the search, unwrapped from its id map."""
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def index_type(index: faiss.Index) -> str:
+    """Return which of INDEX_TYPES an index was built as."""
+    if faiss.try_extract_index_ivf(index) is not None:
+        return "ivf"
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(base, faiss.IndexScalarQuantizer):
+        return "sq8"
+    if isinstance(base, faiss.IndexPQ):
+        return "pq"
+    return "flat"
+
+
+def is_quantized(index: faiss.Index) -> bool:
+    return index_type(index) in QUANTIZED_TYPES
+
+
+def pq_subquantizers(settings: Settings, dimension: int) -> int:
+    """Largest count not above ``faiss_pq_m`` that divides the dimension."""
+    return next(m for m in range(min(settings.faiss_pq_m, dimension), 0, -1) if dimension % m == 0)
+
+
+def is_id_mapped(index: faiss.Index) -> bool:
+    """True if the index stores caller-chosen ids (needed to remove vectors).
+
+    IVF indexes do natively; flat and HNSW ones need an IndexIDMap2 wrapper.
+    """
+    return isinstance(index, faiss.IndexIDMap) or faiss.try_extract_index_ivf(index) is not None
+
+
+def supports_removal(index: faiss.Index) -> bool:
+    """HNSW graphs cannot drop vectors; they are rebuilt instead."""
+    return is_id_mapped(index) and index_type(index) != "hnsw"
+
+
+def ivf_list_count(settings: Settings, num_vectors: int) -> int:
+    """Number of IVF lists to use for a collection of the given size."""
+    return max(1, min(settings.faiss_ivf_nlist, num_vectors // MIN_TRAIN_POINTS_PER_LIST))
+
+
+def create_index(settings: Settings, dimension: int, train_vectors: np.ndarray | None = None) -> faiss.Index:
+    """Build an empty index of the configured type (inner product on normalized vectors).
+
+    Vectors are added with ``add_with_ids`` using chunk store row ids. IVF
+    and quantized indexes are trained on ``train_vectors``. Without (enough)
+    training vectors a flat index stands in until ``needs_rebuild`` asks for
+    the real one.
+    """
+    kind = settings.faiss_index_type
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown faiss_index_type {kind!r}, expected one of {INDEX_TYPES}")
+
+    if kind == "ivf" and train_vectors is not None and len(train_vectors):
+        nlist = ivf_list_count(settings, len(train_vectors))
+        index = faiss.index_factory(dimension, f"IVF{nlist},Flat", faiss.METRIC_INNER_PRODUCT)
+        index.train(train_vectors)
+        faiss.extract_index_ivf(index).nprobe = settings.faiss_ivf_nprobe
+    elif kind == "hnsw":
+        index = faiss.index_factory(
+            dimension, f"HNSW{settings.faiss_hnsw_m},Flat", faiss.METRIC_INNER_PRODUCT
+        )
+        index.hnsw.efConstruction = settings.faiss_hnsw_ef_construction
+        index.hnsw.efSearch = settings.faiss_hnsw_ef_search
+        index = faiss.IndexIDMap2(index)
+    elif (
+        kind in QUANTIZED_TYPES
+        and train_vectors is not None
+        and len(train_vectors) >= MIN_QUANTIZER_TRAIN_POINTS
+    ):
+        if kind == "sq8":
+            index = faiss.IndexScalarQuantizer(
+                dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+            )
+        else:
+            index = faiss.IndexPQ(
+                dimension, pq_subquantizers(settings, dimension), 8, faiss.METRIC_INNER_PRODUCT
+            )
+            if len(train_vectors) > MAX_PQ_TRAIN_POINTS:
+                sample = np.random.default_rng(0).choice(
+                    len(train_vectors), MAX_PQ_TRAIN_POINTS, replace=False
+                )
+                train_vectors = train_vectors[np.sort(sample)]
+        index.train(train_vectors)
+        index = faiss.IndexIDMap2(index)
+    else:
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+    return index
+
+
+def needs_rebuild(settings: Settings, index: faiss.Index) -> bool:
+    """True if the index type changed, it lacks ids or an IVF index outgrew its training."""
+    kind = index_type(index)
+    if not is_id_mapped(index):
+        return index.ntotal > 0
+    if kind != settings.faiss_index_type:
+        if kind == "flat" and settings.faiss_index_type in QUANTIZED_TYPES:
+            # Keep the flat stand-in until there is enough to train on
+            return index.ntotal >= MIN_QUANTIZER_TRAIN_POINTS
+        return index.ntotal > 0
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # Trained on a much smaller collection: too few lists for the current size
+        return ivf.nlist * 2 <= ivf_list_count(settings, index.ntotal)
+    return False
+
+
+def all_vectors(index: faiss.Index) -> np.ndarray:
+    """Reconstruct every vector of an index without id map, in order."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    if index.ntotal == 0:
+        return np.empty((0, index.d), dtype=np.float32)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def rebuild_index(settings: Settings, dimension: int, vectors: np.ndarray, ids: np.ndarray) -> faiss.Index:
+    """Build an index of the configured type holding ``vectors`` under ``ids``."""
+    rebuilt = create_index(settings, dimension, train_vectors=vectors)
+    if len(vectors):
+        rebuilt.add_with_ids(vectors, ids)
+    return rebuilt
+
+
+def rerank(
+    query: np.ndarray, ids: np.ndarray, vectors: np.ndarray, k: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Re-score candidates exactly and keep the top ``k``.
+
+    ``vectors`` are the full-precision vectors of ``ids``. Returns
+    ``(scores, ids)`` sorted by descending inner product with ``query``.
+    """
+    if not len(ids):
+        return np.empty(0, dtype=np.float32), ids
+    scores = vectors @ query.ravel()
+    top = np.argsort(-scores, kind="stable")[:k]
+    return scores[top], ids[top]
+
+
+def index_bytes_per_vector(index: faiss.Index) -> float:
+    """Serialized index size per vector: codes, ids and amortized codebooks."""
+    if not index.ntotal:
+        return 0.0
+    return faiss.serialize_index(index).nbytes / index.ntotal
+
+
+def search_params(
+    index: faiss.Index, nprobe: int | None = None, ef_search: int | None = None
+) -> faiss.SearchParameters | None:
+    """Per-query search parameters overriding the index defaults."""
+    kind = index_type(index)
+    if kind == "ivf" and nprobe:
+        return faiss.SearchParametersIVF(nprobe=nprobe)
+    if kind == "hnsw" and ef_search:
+        return faiss.SearchParametersHNSW(efSearch=ef_search)
+    return None
+
+
+def configure_search(settings: Settings, index: faiss.Index):
+    """Apply the configured default nprobe / efSearch to a loaded index."""
+    kind = index_type(index)
+    if kind == "ivf":
+        faiss.extract_index_ivf(index).nprobe = settings.faiss_ivf_nprobe
+    elif kind == "hnsw":
+        _base_index(index).hnsw.efSearch = settings.faiss_hnsw_ef_search
+
+
+def _timed_search(index: faiss.Index, queries: np.ndarray, k: int, params=None):
+    """Search queries one at a time, like the retriever does."""
+    started = time.perf_counter()
+    results = [index.search(q[None, :], k, params=params)[1][0] for q in queries]
+    return results, time.perf_counter() - started
+
+
+def evaluate_index(
+    index: faiss.Index,
+    vectors: np.ndarray,
+    ids: np.ndarray,
+    k: int = 5,
+    num_queries: int = 200,
+    nprobe: int | None = None,
+    ef_search: int | None = None,
+    seed: int = 0,
+    rerank_factor: int = 1,
+) -> dict:
+    """Compare an index against exact flat search over the same vectors.
+
+    ``vectors`` / ``ids`` are what the index holds (see
+    ``ChunkStore.live_vectors``). Queries are stored vectors with a little
+    noise added. Returns recall@k (fraction of the exact top-k that the index
+    also returned), the mean per-query latency of both indexes in
+    milliseconds and the index size per vector against flat float32.
+
+    With ``rerank_factor > 1`` the index returns that many times ``k``
+    candidates, which are re-scored exactly from ``vectors`` as the
+    retriever does for quantized indexes; ``recall_at_k`` is then measured
+    after re-ranking and ``raw_recall_at_k`` before it.
+    """
+    if not len(vectors):
+        return {"index_type": index_type(index), "vectors": 0, "k": k, "queries": 0}
+
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)
+    queries = vectors[sample] + rng.normal(scale=0.05, size=(len(sample), index.d)).astype(np.float32)
+    faiss.normalize_L2(queries)
+    k = min(k, len(vectors))
+
+    exact = faiss.IndexIDMap2(faiss.IndexFlatIP(index.d))
+    exact.add_with_ids(vectors, ids)
+
+    expected, exact_elapsed = _timed_search(exact, queries, k)
+    fetch = min(len(vectors), k * max(1, rerank_factor))
+    candidates, index_elapsed = _timed_search(
+        index, queries, fetch, search_params(index, nprobe, ef_search)
+    )
+
+    def recall(results) -> float:
+        hits = sum(len(set(e) & set(a[a >= 0])) for e, a in zip(expected, results))
+        return hits / (k * len(queries))
+
+    report = {
+        "index_type": index_type(index),
+        "vectors": len(vectors),
+        "k": k,
+        "queries": len(queries),
+        "recall_at_k": recall([c[:k] for c in candidates]),
+        "latency_ms": index_elapsed * 1000 / len(queries),
+        "flat_latency_ms": exact_elapsed * 1000 / len(queries),
+        "bytes_per_vector": index_bytes_per_vector(index),
+        "flat_bytes_per_vector": index_bytes_per_vector(exact),
+    }
+    if fetch > k:
+        order = np.argsort(ids)
+        started = time.perf_counter()
+        reranked = []
+        for query, found in zip(queries, candidates):
+            found = found[found >= 0]
+            rows = order[np.searchsorted(ids, found, sorter=order)]
+            reranked.append(rerank(query, found, vectors[rows], k)[1])
+        rerank_elapsed = time.perf_counter() - started
+        report["raw_recall_at_k"] = report["recall_at_k"]
+        report["recall_at_k"] = recall(reranked)
+        report["latency_ms"] += rerank_elapsed * 1000 / len(queries)
+    return report
@@ -1,158 +1,348 @@
 # -*- coding: utf-8 -*-
 import hashlib
 import json
+import logging
 import os
-import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
+from typing import Callable
 
-import faiss
 import fitz  # PyMuPDF
 import numpy as np
-from fastembed import TextEmbedding
 
 from server.config import Settings
+from server.rag.chunking import chunk_spans, token_spans
+from server.rag.cleaning import clean_pages
+from server.rag.embeddings import get_embedding_dimension, get_embedding_model, get_tokenizer
+from server.rag.index import create_index, needs_rebuild, rebuild_index, supports_removal
+from server.rag.store import ChunkStore
 
+logger = logging.getLogger("ask-michal")
+
+
+class PDFParser:
+    """Extract, clean and chunk PDF text.
+
+    Holds no embedding model or index, so it is cheap to build inside
+    worker processes during parallel ingestion.
+    """
 
-class PDFIngestor:
     def __init__(self, settings: Settings):
         self.settings = settings
-        self.embedding_model = TextEmbedding(settings.embedding_model)
-        # Get dimension from a test embedding
-        test = list(self.embedding_model.embed(["test"]))[0]
-        self.dimension = len(test)
+        self.tokenizer = get_tokenizer(settings.embedding_model)
+
+    def extract_text_from_pdf(self, pdf_path: str) -> list[dict]:
+        """Extract cleaned text from a PDF with page metadata."""
+        with fitz.open(pdf_path) as doc:
+            texts = [page.get_text("text") for page in doc]
+        # Headers and footers are found by comparing pages, so clean them together
+        texts = clean_pages(
+            texts, self.settings.header_scan_lines, self.settings.header_min_page_share
+        )
+        source = os.path.basename(pdf_path)
+        return [
+            {"text": text, "page": page_num, "source": source}
+            for page_num, text in enumerate(texts, 1)
+            if text
+        ]
+
+    def chunk_ranges(self, text: str) -> list[tuple[int, int]]:
+        """Character ranges of overlapping chunks sized in embedding model tokens."""
+        bounds, word_start = token_spans(text, self.tokenizer)
+        ranges = []
+        for start, end in chunk_spans(
+            bounds, word_start, self.settings.chunk_size, self.settings.chunk_overlap
+        ):
+            # Some tokenizers count the space before a word into its first token
+            while start < end and text[start].isspace():
+                start += 1
+            ranges.append((start, end))
+        return ranges
+
+    def chunk_text(self, text: str) -> list[str]:
+        """Split text into overlapping chunks sized in embedding model tokens."""
+        return [text[start:end] for start, end in self.chunk_ranges(text)]
+
+    def prepare_pdf(self, pdf_path: str) -> list[dict]:
+        """Extract and chunk a PDF into chunk records ready for embedding.
+
+        The pages are chunked as one text, so a chunk can run across a page
+        break; ``page`` and ``page_end`` are its first and last page.
+        """
+        pages = self.extract_text_from_pdf(pdf_path)
+        if not pages:
+            return []
+        document = "\n".join(p["text"] for p in pages)
+        page_starts = np.cumsum([0] + [len(p["text"]) + 1 for p in pages[:-1]])
+        records = []
+        for i, (start, end) in enumerate(self.chunk_ranges(document)):
+            first = pages[int(np.searchsorted(page_starts, start, side="right")) - 1]
+            last = pages[int(np.searchsorted(page_starts, end - 1, side="right")) - 1]
+            chunk = document[start:end]
+            # Content-derived, so unchanged chunks of an edited file keep their id
+            chunk_id = hashlib.sha256(
+                f"{first['source']}:{first['page']}:{chunk}".encode()
+            ).hexdigest()
+            records.append(
+                {
+                    "id": chunk_id,
+                    "text": chunk,
+                    "source": first["source"],
+                    "page": first["page"],
+                    "page_end": last["page"],
+                    "chunk_index": i,
+                }
+            )
+        return records
+
+
+def file_sha256(path: str) -> str:
+    """Hex sha256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(partial(f.read, 1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def ingest_fingerprint(settings: Settings, tokenizer) -> str:
+    """Hex sha256 of everything besides a file's contents that shapes its vectors:
+    the page cleaning and chunking settings, the tokenizer and the embedding model."""
+    parts = [
+        settings.embedding_model,
+        settings.chunk_size,
+        settings.chunk_overlap,
+        settings.header_scan_lines,
+        settings.header_min_page_share,
+        tokenizer.to_str() if tokenizer is not None else None,
+    ]
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode()).hexdigest()
+
+
+def _prepare_pdf(settings: Settings, pdf_path: str) -> list[dict]:
+    """Process pool entry point: parse a single PDF in a worker."""
+    return PDFParser(settings).prepare_pdf(pdf_path)
+
+
+class PDFIngestor(PDFParser):
+    def __init__(self, settings: Settings):
+        super().__init__(settings)
+        self.embedding_model = get_embedding_model(settings.embedding_model)
+        self.dimension = get_embedding_dimension(settings.embedding_model)
+        self.fingerprint = ingest_fingerprint(settings, self.tokenizer)
+        self.last_ingest_stats = self._empty_stats()
+        self.rows_removed = 0  # Over the ingestor's lifetime, stale chunks and deleted files
         self._load_or_create_index()
 
+    @staticmethod
+    def _empty_stats(**overrides) -> dict:
+        stats = {
+            "chunks": 0,
+            "removed": 0,
+            "seconds": 0.0,
+            "chunks_per_second": 0.0,
+            "skipped": False,
+        }
+        return {**stats, **overrides}
+
     def _load_or_create_index(self):
-        index_path = self.settings.faiss_index_path
-        faiss_file = f"{index_path}.faiss"
-        meta_file = f"{index_path}.meta.json"
-
-        if os.path.exists(faiss_file) and os.path.exists(meta_file):
-            self.index = faiss.read_index(faiss_file)
-            with open(meta_file, "r", encoding="utf-8") as f:
-                self.metadata = json.load(f)
-        else:
-            self.index = faiss.IndexFlatIP(self.dimension)  # Inner product (cosine with normalized vectors)
-            self.metadata = {"chunks": [], "id_map": {}}
+        self.store = ChunkStore.open(self.settings.faiss_index_path)
+        self.index = self.store.load_index()
+        self._index_dirty = False
+        if self.index is None:
+            self.index = create_index(self.settings, self.dimension)
+        elif needs_rebuild(self.settings, self.index):
+            self._rebuild_index()
+
+    def _rebuild_index(self):
+        """Rebuild the index as the configured type from the store's vectors."""
+        vectors, row_ids = self.store.live_vectors()
+        self.index = rebuild_index(self.settings, self.dimension, vectors, row_ids)
+        self._index_dirty = True
 
     def _save_index(self):
-        index_path = self.settings.faiss_index_path
-        os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
-        faiss.write_index(self.index, f"{index_path}.faiss")
-        with open(f"{index_path}.meta.json", "w", encoding="utf-8") as f:
-            json.dump(self.metadata, f, ensure_ascii=False, indent=2)
+        """Commit new chunks as a store segment.
 
-    @staticmethod
-    def _strip_headers(text: str) -> str:
-        """Remove repeating PDF headers/footers that pollute embeddings."""
-        # First pass: remove known multi-word header patterns that may appear on one line
-        text = re.sub(
-            r"-?\s*בלמ\"?ס\s*-?", "", text
-        )
-        text = re.sub(
-            r"מטכ\"?ל\s+אכ\"?א\d*\s+חט'\s+תכנון\s+ומנהל\s+כ\"א\s+תכנון\s+כ\"א\s+מילואים\s+ענף\s+ושמ\"פ\s+מדור\s+תע\"ם",
-            "", text
+        The index itself is only written when it was rebuilt, lost vectors or
+        has no checkpoint yet; otherwise its new vectors live in the segment.
+        """
+        checkpoint = self._index_dirty or not self.store.index_rows
+        self.store.commit(self.index if checkpoint else None)
+        self._index_dirty = False
+
+    def _remove_rows(self, row_ids: list[int]):
+        self.rows_removed += len(row_ids)
+        self.store.delete(row_ids)
+        if supports_removal(self.index):
+            self.index.remove_ids(np.asarray(row_ids, dtype=np.int64))
+        else:
+            self._rebuild_index()  # HNSW graphs cannot drop nodes
+        self._index_dirty = True
+
+    def compact(self, force: bool = False) -> bool:
+        """Merge store segments and checkpoint the index once there are too many."""
+        if not force and not self.store.needs_compaction(self.settings.max_store_segments):
+            return False
+        started = time.perf_counter()
+        self.store.compact(self.index)
+        logger.info(
+            f"Compacted chunk store ({len(self.store)} chunks) in {time.perf_counter() - started:.2f}s"
         )
-        text = re.sub(r"הוראת קבע אכ\"?א[\d\-]+", "", text)
-
-        # Second pass: line-by-line cleanup
-        lines = text.split("\n")
-        cleaned = []
-        for line in lines:
-            stripped = line.strip()
-            if not stripped:
-                continue
-            # Skip standalone page numbers
-            if re.match(r"^-?\s*\d+\s*-?\s*$", stripped):
-                continue
-            # Skip standalone unit/branch header fragments
-            if stripped in ("מדור תע\"ם", "ענף ושמ\"פ", "תכנון כ\"א", "חט' תכנון"):
-                continue
-            cleaned.append(line)
-        return "\n".join(cleaned).strip()
+        return True
 
-    def extract_text_from_pdf(self, pdf_path: str) -> list[dict]:
-        """Extract text from PDF with page metadata."""
-        doc = fitz.open(pdf_path)
-        pages = []
-        for page_num, page in enumerate(doc, 1):
-            text = page.get_text("text")
-            text = re.sub(r"\n{3,}", "\n\n", text)
-            text = self._strip_headers(text)
-            if text:
-                pages.append(
-                    {
-                        "text": text,
-                        "page": page_num,
-                        "source": os.path.basename(pdf_path),
-                    }
+    def embed_chunks(self, texts: list[str]) -> np.ndarray:
+        """Embed texts in batches and return L2-normalized float32 vectors."""
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        embeddings = np.asarray(
+            list(
+                self.embedding_model.embed(
+                    texts, batch_size=self.settings.embedding_batch_size
                 )
-        doc.close()
-        return pages
-
-    def chunk_text(self, text: str) -> list[str]:
-        """Split text into overlapping chunks by word count."""
-        words = text.split()
-        chunks = []
-        start = 0
-        while start < len(words):
-            end = start + self.settings.chunk_size
-            chunk = " ".join(words[start:end])
-            if chunk.strip():
-                chunks.append(chunk)
-            start = end - self.settings.chunk_overlap
-        return chunks
+            ),
+            dtype=np.float32,
+        )
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return embeddings / norms  # normalize for cosine sim
 
     def ingest_pdf(self, pdf_path: str) -> int:
         """Process a single PDF: extract, chunk, embed, store in FAISS."""
-        pages = self.extract_text_from_pdf(pdf_path)
-        total_chunks = 0
-
-        for page_data in pages:
-            chunks = self.chunk_text(page_data["text"])
-
-            for i, chunk in enumerate(chunks):
-                chunk_id = hashlib.sha256(
-                    f"{page_data['source']}:{page_data['page']}:{i}".encode()
-                ).hexdigest()
-
-                # Skip if already indexed
-                if chunk_id in self.metadata["id_map"]:
-                    continue
-
-                embedding = list(self.embedding_model.embed([chunk]))[0]
-                embedding = embedding / np.linalg.norm(embedding)  # normalize for cosine sim
-                embedding = np.array([embedding], dtype=np.float32)
-
-                idx = self.index.ntotal
-                self.index.add(embedding)
-
-                self.metadata["id_map"][chunk_id] = idx
-                self.metadata["chunks"].append(
-                    {
-                        "id": chunk_id,
-                        "text": chunk,
-                        "source": page_data["source"],
-                        "page": page_data["page"],
-                        "chunk_index": i,
-                    }
-                )
-                total_chunks += 1
+        return self._index_chunks(pdf_path, self.prepare_pdf(pdf_path), file_sha256(pdf_path))
+
+    def _file_entry(self, digest: str) -> dict:
+        """What ``store.files`` records for a file ingested with the current settings."""
+        return {"sha256": digest, "settings": self.fingerprint}
+
+    def _index_chunks(self, pdf_path: str, records: list[dict], digest: str) -> int:
+        """Bring the indexed chunks of a PDF in line with its parsed records.
+
+        Chunks that are no longer in the file are removed; only chunks not
+        indexed yet are embedded. If the file was ingested with other
+        settings (see ``ingest_fingerprint``) none of its chunks are kept.
+        """
+        source = os.path.basename(pdf_path)
+        indexed = self.store.source_rows(source)
+        recorded = self.store.files.get(source)
+        if recorded is not None and recorded["settings"] != self.fingerprint:
+            kept = set()
+        else:
+            kept = indexed.keys() & {c["id"] for c in records}
+        stale = [row_id for chunk_id, row_id in indexed.items() if chunk_id not in kept]
+        if stale:
+            self._remove_rows(stale)
+        new_chunks = list({c["id"]: c for c in records if c["id"] not in kept}.values())
+
+        started = time.perf_counter()
+        embeddings = self.embed_chunks([c["text"] for c in new_chunks])
+
+        if new_chunks:
+            row_ids = self.store.append(new_chunks, embeddings)
+            self.index.add_with_ids(embeddings, row_ids)
+            if needs_rebuild(self.settings, self.index):
+                # Train (or retrain) on everything indexed so far
+                self._rebuild_index()
+        self.store.files[source] = self._file_entry(digest)
+        elapsed = time.perf_counter() - started
+
+        self.last_ingest_stats = self._empty_stats(
+            chunks=len(new_chunks),
+            removed=len(stale),
+            seconds=elapsed,
+            chunks_per_second=len(new_chunks) / elapsed if elapsed > 0 else 0.0,
+        )
+        logger.info(
+            f"Embedded {len(new_chunks)} chunks from {source}, removed {len(stale)} stale, "
+            f"in {elapsed:.2f}s ({self.last_ingest_stats['chunks_per_second']:.1f} chunks/s)"
+        )
 
         self._save_index()
-        return total_chunks
+        return len(new_chunks)
+
+    def remove_source(self, source: str) -> int:
+        """Remove every chunk of a source file from the index."""
+        row_ids = list(self.store.source_rows(source).values())
+        if row_ids:
+            self._remove_rows(row_ids)
+        self.store.files.pop(source, None)
+        self._save_index()
+        logger.info(f"Removed {len(row_ids)} chunks of deleted file {source}")
+        return len(row_ids)
+
+    def ingest_directory(
+        self,
+        directory: str,
+        jobs: int | None = None,
+        on_file: Callable[[str, int], None] | None = None,
+        prune: bool = False,
+    ) -> dict[str, int]:
+        """Process all PDFs in a directory.
+
+        With ``prune`` every indexed file that is not in the directory is
+        removed first. Only use it when the directory holds the whole
+        knowledge base, not when other directories feed the same index.
+        """
+        filenames = [f for f in sorted(os.listdir(directory)) if f.lower().endswith(".pdf")]
+        if prune:
+            indexed = self.store.sources_in_use() | set(self.store.files)
+            for source in sorted(indexed - set(filenames)):
+                self.remove_source(source)
+        return self.ingest_files(
+            [os.path.join(directory, f) for f in filenames], jobs=jobs, on_file=on_file
+        )
+
+    def ingest_files(
+        self,
+        paths: list[str],
+        jobs: int | None = None,
+        on_file: Callable[[str, int], None] | None = None,
+    ) -> dict[str, int]:
+        """Process PDFs in the given order, calling ``on_file`` after each one.
+
+        Files whose content hash and ingest settings match the ones recorded
+        at their last ingestion are skipped without being parsed. With ``jobs > 1``
+        extraction, header stripping and chunking run in a process pool.
+        Parsed files are handed back in order to this process, the single
+        writer of the index and metadata, so the result does not depend on
+        the number of workers. An exception raised by ``on_file`` stops
+        ingestion after the current file.
+        """
+        jobs = jobs or self.settings.ingest_jobs
+
+        digests = {path: file_sha256(path) for path in paths}
+        recorded = self.store.files
+        changed = [p for p in paths if recorded.get(os.path.basename(p)) != self._file_entry(digests[p])]
+        changed_paths = set(changed)
 
-    def ingest_directory(self, directory: str) -> dict[str, int]:
-        """Process all PDFs in a directory."""
         results = {}
-        for filename in sorted(os.listdir(directory)):
-            if filename.lower().endswith(".pdf"):
-                path = os.path.join(directory, filename)
-                count = self.ingest_pdf(path)
-                results[filename] = count
+        pool = None
+        if jobs > 1 and len(changed) > 1:
+            # spawn: never fork a process holding ONNX runtime threads
+            pool = ProcessPoolExecutor(
+                max_workers=min(jobs, len(changed)), mp_context=get_context("spawn")
+            )
+            parsed = pool.map(partial(_prepare_pdf, self.settings), changed)
+        else:
+            parsed = map(self.prepare_pdf, changed)
+        try:
+            for path in paths:
+                filename = os.path.basename(path)
+                if path not in changed_paths:
+                    logger.info(f"Skipping unchanged {filename}")
+                    self.last_ingest_stats = self._empty_stats(skipped=True)
+                    results[filename] = 0
+                else:
+                    results[filename] = self._index_chunks(path, next(parsed), digests[path])
+                if on_file:
+                    on_file(filename, results[filename])
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
         return results
 
     def clear(self):
         """Clear the entire index."""
-        self.index = faiss.IndexFlatIP(self.dimension)
-        self.metadata = {"chunks": [], "id_map": {}}
-        self._save_index()
+        self.index = create_index(self.settings, self.dimension)
+        self.store.clear()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import logging
+import queue
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Callable
+
+from server.config import Settings
+
+logger = logging.getLogger("ask-michal")
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+FINISHED_STATUSES = (JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED)
+
+# Finished jobs kept around for status queries
+MAX_FINISHED_JOBS = 50
+
+
+class JobCancelled(Exception):
+    pass
+
+
+@dataclass
+class IngestJob:
+    paths: list[str]
+    clear: bool = False
+    user_id: int | None = None
+    # Set when the job covers a whole directory and removes files not in it
+    prune_directory: str | None = None
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = JOB_QUEUED
+    files_done: int = 0
+    chunks_embedded: int = 0
+    chunks_removed: int = 0
+    results: dict[str, int] = field(default_factory=dict)
+    error: str | None = None
+    created_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    cancel_requested: bool = False
+    _started_monotonic: float | None = None
+
+    @property
+    def files_total(self) -> int:
+        return len(self.paths)
+
+    @property
+    def eta_seconds(self) -> float | None:
+        """Remaining time extrapolated from the average time per finished file."""
+        if self.status != JOB_RUNNING or not self.files_done:
+            return None
+        elapsed = time.monotonic() - self._started_monotonic
+        return elapsed / self.files_done * (self.files_total - self.files_done)
+
+
+class IngestJobManager:
+    """Runs knowledge base ingestion jobs off the request path.
+
+    Jobs are executed one at a time by a single worker thread, so only one
+    job ever writes to the index. ``on_index_changed`` is called after each
+    job that added or removed data, typically to reload the retriever.
+    """
+
+    def __init__(self, settings: Settings, on_index_changed: Callable[[], None] | None = None):
+        self.settings = settings
+        self.on_index_changed = on_index_changed
+        self._jobs: dict[str, IngestJob] = {}
+        self._queue: queue.Queue[IngestJob | None] = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name="ingest-worker", daemon=True)
+        self._worker.start()
+
+    def submit(
+        self,
+        paths: list[str],
+        clear: bool = False,
+        user_id: int | None = None,
+        prune_directory: str | None = None,
+    ) -> IngestJob:
+        """Queue ``paths`` for ingestion. With ``prune_directory``, ``paths`` are
+        the PDFs in it, and indexed files that are not there are removed."""
+        job = IngestJob(
+            paths=list(paths), clear=clear, user_id=user_id, prune_directory=prune_directory
+        )
+        with self._lock:
+            finished = [j for j in self._jobs.values() if j.status in FINISHED_STATUSES]
+            for old in sorted(finished, key=lambda j: j.created_at)[:-MAX_FINISHED_JOBS]:
+                del self._jobs[old.id]
+            self._jobs[job.id] = job
+        self._queue.put(job)
+        logger.info(f"Queued ingest job {job.id}: {job.files_total} files (clear={clear})")
+        return job
+
+    def get(self, job_id: str) -> IngestJob | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def all_jobs(self) -> list[IngestJob]:
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: j.created_at, reverse=True)
+
+    def cancel(self, job_id: str) -> IngestJob | None:
+        """Request cancellation. A running job stops after its current file."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATUSES:
+                return job
+            job.cancel_requested = True
+            if job.status == JOB_QUEUED:
+                self._finish(job, JOB_CANCELLED)
+        return job
+
+    def shutdown(self, timeout: float | None = None):
+        """Cancel outstanding jobs and stop the worker."""
+        for job in self.all_jobs():
+            self.cancel(job.id)
+        self._queue.put(None)
+        self._worker.join(timeout)
+
+    def _finish(self, job: IngestJob, status: str, error: str | None = None):
+        job.status = status
+        job.error = error
+        job.finished_at = datetime.now(timezone.utc)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                if job.status != JOB_QUEUED:
+                    continue  # cancelled while waiting
+                job.status = JOB_RUNNING
+                job.started_at = datetime.now(timezone.utc)
+                job._started_monotonic = time.monotonic()
+            self._execute(job)
+
+    def _execute(self, job: IngestJob):
+        from server.rag.ingest import PDFIngestor
+
+        def on_file(filename: str, chunks: int):
+            job.results[filename] = chunks
+            job.files_done += 1
+            job.chunks_embedded += chunks
+            if job.cancel_requested:
+                raise JobCancelled()
+
+        changed = False
+        ingestor = None
+        try:
+            ingestor = PDFIngestor(self.settings)
+            if job.clear:
+                ingestor.clear()
+                changed = True
+            if job.prune_directory:
+                ingestor.ingest_directory(job.prune_directory, on_file=on_file, prune=True)
+            else:
+                ingestor.ingest_files(job.paths, on_file=on_file)
+            # Merge segments here, off the request path, once enough piled up
+            ingestor.compact()
+            self._finish(job, JOB_COMPLETED)
+        except JobCancelled:
+            self._finish(job, JOB_CANCELLED)
+        except Exception as e:
+            logger.error(f"Ingest job {job.id} failed: {e}")
+            self._finish(job, JOB_FAILED, error=str(e))
+
+        if ingestor is not None:
+            job.chunks_removed = ingestor.rows_removed
+        changed = changed or job.chunks_embedded > 0 or job.chunks_removed > 0
+        logger.info(
+            f"Ingest job {job.id} {job.status}: {job.files_done}/{job.files_total} files, "
+            f"{job.chunks_embedded} chunks embedded, {job.chunks_removed} removed"
+        )
+        if changed and self.on_index_changed:
+            try:
+                self.on_index_changed()
+            except Exception as e:
+                logger.error(f"Failed to reload index after job {job.id}: {e}")
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from dataclasses import dataclass
+from typing import Iterable
+
+import numpy as np
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Letters that attach to the front of a Hebrew word: ו ה ב כ ל מ ש
+HEBREW_PREFIXES = "והבכלמש"
+MAX_PREFIX_LETTERS = 2
+MIN_STEM_LENGTH = 3
+
+_NIQQUD = re.compile("[\u0591-\u05bd\u05bf\u05c1\u05c2\u05c4\u05c5\u05c7]")
+# Geresh / gershayim inside abbreviations (אכ"א, ת"ז, חט')
+_INNER_QUOTES = re.compile("(?<=\\w)[\"'\u05f3\u05f4](?=\\w)")
+# Words, and codes such as 35.0201 or 1-2 kept whole
+_TOKEN = re.compile(r"\w+(?:[./-]\w+)*")
+_FINAL_FORMS = str.maketrans("ךםןףץ", "כמנפצ")
+
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _NIQQUD.sub("", text)
+    text = _INNER_QUOTES.sub("", text)
+    return text.translate(_FINAL_FORMS)
+
+
+def _variants(token: str) -> list[str]:
+    """A token followed by the forms left after stripping prefix letters."""
+    variants = [token]
+    stem = token
+    for _ in range(MAX_PREFIX_LETTERS):
+        if stem[0] not in HEBREW_PREFIXES or len(stem) - 1 < MIN_STEM_LENGTH:
+            break
+        stem = stem[1:]
+        variants.append(stem)
+    return variants
+
+
+def tokenize(text: str) -> list[list[str]]:
+    """Split text into words, each given as the list of its search forms.
+
+    Niqqud and quote marks inside abbreviations are removed and final
+    letters are folded into their regular form, so ``שלום`` and ``שלומ``
+    match. Each word is followed by its forms without leading prefix
+    letters (``ובחופשה`` -> ``בחופשה``, ``חופשה``). Codes such as
+    ``35.0201`` are kept whole and also split into their parts.
+    """
+    words = []
+    for match in _TOKEN.finditer(_normalize(text)):
+        token = match.group()
+        words.append(_variants(token))
+        parts = re.split(r"[./-]", token)
+        if len(parts) > 1:
+            words.extend([part] for part in parts if part)
+    return words
+
+
+@dataclass
+class LexicalHit:
+    row_id: int
+    score: float  # BM25
+    coverage: float  # share of the query's distinctive idf weight found in the chunk, 0..1
+
+
+class LexicalPostings:
+    """BM25 postings of one batch of chunks, keyed by store row id.
+
+    Kept in CSR form: the documents containing term ``t`` are
+    ``docs[offsets[t]:offsets[t + 1]]`` with matching term frequencies in
+    ``tfs``. Documents are positions into ``row_ids``.
+    """
+
+    def __init__(
+        self,
+        terms: list[str],
+        offsets: np.ndarray,
+        docs: np.ndarray,
+        tfs: np.ndarray,
+        row_ids: np.ndarray,
+        doc_lengths: np.ndarray,
+    ):
+        self.terms = terms
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.docs = docs
+        self.tfs = tfs
+        self.row_ids = row_ids
+        self.doc_lengths = doc_lengths
+
+    def __len__(self) -> int:
+        return len(self.row_ids)
+
+    @classmethod
+    def build(cls, row_ids: np.ndarray, texts: Iterable[str]) -> "LexicalPostings":
+        postings: dict[str, list[tuple[int, int]]] = {}
+        doc_lengths = []
+        for doc, text in enumerate(texts):
+            words = tokenize(text)
+            doc_lengths.append(len(words))
+            counts = Counter(form for forms in words for form in forms)
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((doc, tf))
+
+        terms = sorted(postings)
+        sizes = [len(postings[t]) for t in terms]
+        offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        flat = [entry for t in terms for entry in postings[t]]
+        return cls(
+            terms,
+            offsets,
+            np.array([doc for doc, _ in flat], dtype=np.int32),
+            np.array([tf for _, tf in flat], dtype=np.uint16),
+            np.asarray(row_ids, dtype=np.int64),
+            np.array(doc_lengths, dtype=np.float32),
+        )
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                terms=np.array(self.terms, dtype=str),
+                offsets=self.offsets,
+                docs=self.docs,
+                tfs=self.tfs,
+                row_ids=self.row_ids,
+                doc_lengths=self.doc_lengths,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+
+    @classmethod
+    def load(cls, path: str) -> "LexicalPostings":
+        with np.load(path) as data:
+            return cls(
+                data["terms"].tolist(),
+                data["offsets"],
+                data["docs"],
+                data["tfs"],
+                data["row_ids"],
+                data["doc_lengths"],
+            )
+
+    def lookup(self, term: str) -> tuple[np.ndarray, np.ndarray] | None:
+        """Documents containing ``term`` and its frequency in each."""
+        t = self.term_ids.get(term)
+        if t is None:
+            return None
+        start, end = self.offsets[t], self.offsets[t + 1]
+        return self.docs[start:end], self.tfs[start:end]
+
+
+class LexicalIndex:
+    """BM25 search over one or more ``LexicalPostings``, such as one per
+    store segment, without the rows in ``deleted``.
+
+    Adding chunks only needs postings for the new ones: document
+    frequencies, the document count and the average length are taken over
+    the live rows of all parts when searching, so scores are the same as
+    for postings built over those rows at once.
+    """
+
+    def __init__(self, parts: list[LexicalPostings], deleted: Iterable[int] = ()):
+        self.parts = parts
+        deleted = np.fromiter(deleted, dtype=np.int64)
+        self._starts = np.cumsum([0] + [len(p) for p in parts], dtype=np.int64)
+        self._live = [~np.isin(p.row_ids, deleted) for p in parts]
+        self.row_ids = np.concatenate([p.row_ids for p in parts] or [np.empty(0, dtype=np.int64)])
+        self.doc_lengths = np.concatenate(
+            [p.doc_lengths for p in parts] or [np.empty(0, dtype=np.float32)]
+        )
+        live = np.concatenate(self._live or [np.empty(0, dtype=bool)])
+        self.num_docs = int(live.sum())
+        self.avg_length = float(self.doc_lengths[live].mean()) if self.num_docs else 0.0
+
+    def __len__(self) -> int:
+        return self.num_docs
+
+    @classmethod
+    def build(cls, row_ids: np.ndarray, texts: Iterable[str]) -> "LexicalIndex":
+        return cls([LexicalPostings.build(row_ids, texts)])
+
+    def term_count(self) -> int:
+        return len(set().union(*(p.terms for p in self.parts)))
+
+    def _postings(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        """Live documents containing ``term`` (positions into ``row_ids``) and its frequencies."""
+        docs, tfs = [], []
+        for part, start, live in zip(self.parts, self._starts, self._live):
+            found = part.lookup(term)
+            if found is None:
+                continue
+            keep = live[found[0]]
+            docs.append(found[0][keep].astype(np.int64) + start)
+            tfs.append(found[1][keep])
+        if not docs:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint16)
+        return np.concatenate(docs), np.concatenate(tfs)
+
+    def _idf(self, df: int) -> float:
+        n = self.num_docs
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, k: int, max_term_share: float = 1.0) -> list[LexicalHit]:
+        """Top-k chunks by BM25.
+
+        Each query word scores once, by its best matching form, so prefix
+        variants do not count the same word twice. Words found in more than
+        ``max_term_share`` of the chunks (and in more than one) still score
+        but are left out of ``coverage``: a chunk containing only common
+        words such as "מה יש" has covered nothing. A query made only of
+        such words gives every hit a coverage of 0.
+        """
+        words = tokenize(query)
+        if not words or not self.num_docs:
+            return []
+
+        scores = np.zeros(len(self.row_ids), dtype=np.float32)
+        matched = np.zeros(len(self.row_ids), dtype=np.float64)
+        total_weight = 0.0
+        common_df = max(1.0, max_term_share * self.num_docs)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths / max(self.avg_length, 1e-9))
+        for forms in words:
+            word_scores = np.zeros(len(self.row_ids), dtype=np.float32)
+            df = 0  # the word weighs as its most common form; unseen words the most
+            for form in forms:
+                docs, tfs = self._postings(form)
+                if not len(docs):
+                    continue
+                tfs = tfs.astype(np.float32)
+                idf = self._idf(len(docs))
+                df = max(df, len(docs))
+                contribution = idf * tfs * (BM25_K1 + 1) / (tfs + norm[docs])
+                word_scores[docs] = np.maximum(word_scores[docs], contribution)
+            scores += word_scores
+            if df <= common_df:
+                weight = self._idf(df)
+                matched += weight * (word_scores > 0)
+                total_weight += weight
+
+        k = min(k, int(np.count_nonzero(scores)))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        coverage = matched[top] / total_weight if total_weight else np.zeros(len(top))
+        return [
+            LexicalHit(int(self.row_ids[d]), float(scores[d]), float(c))
+            for d, c in zip(top, coverage)
+        ]
@@ -1,68 +1,265 @@
 # -*- coding: utf-8 -*-
-import json
-import os
+import logging
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
 
 import faiss
 import numpy as np
-from fastembed import TextEmbedding
 
 from server.config import Settings
+from server.rag.embeddings import get_embedding_model
+from server.rag.index import configure_search, is_quantized, rerank, search_params
+from server.rag.lexical import LexicalHit, LexicalIndex
+from server.rag.store import ChunkStore
+
+logger = logging.getLogger("ask-michal")
+
+
+def normalize_query(query: str) -> str:
+    """Canonical form of a query for cache keys: case, width and spacing folded."""
+    text = unicodedata.normalize("NFKC", query).casefold()
+    return " ".join(text.split()).strip("?!.,;: ")
+
+
+@contextmanager
+def _timed(timings: dict, stage: str):
+    """Record the wall time of a retrieval stage in milliseconds."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = (time.perf_counter() - started) * 1000
+
+
+class QueryEmbeddingCache:
+    """Thread-safe LRU cache of normalized query vectors."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> np.ndarray | None:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key: str, vector: np.ndarray):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+@dataclass(frozen=True)
+class RetrieverSnapshot:
+    """A loaded index together with the chunk store it was built from.
+
+    Snapshots are never modified after loading. A reload builds a new one
+    and swaps it in, so a request that grabbed a snapshot keeps a consistent
+    index / store pair however long it runs.
+    """
+
+    index: faiss.Index | None = None
+    store: ChunkStore | None = None
+    version: int = 0
+    lexical: LexicalIndex | None = None
+
+    def is_ready(self) -> bool:
+        return self.index is not None and len(self.store) > 0
 
 
 class KnowledgeRetriever:
     def __init__(self, settings: Settings):
         self.settings = settings
-        self.embedding_model = TextEmbedding(settings.embedding_model)
-        self._load_index()
-
-    def _load_index(self):
-        index_path = self.settings.faiss_index_path
-        faiss_file = f"{index_path}.faiss"
-        meta_file = f"{index_path}.meta.json"
-
-        if os.path.exists(faiss_file) and os.path.exists(meta_file):
-            self.index = faiss.read_index(faiss_file)
-            with open(meta_file, "r", encoding="utf-8") as f:
-                self.metadata = json.load(f)
-        else:
-            self.index = None
-            self.metadata = {"chunks": []}
+        self.embedding_model = get_embedding_model(settings.embedding_model)
+        self.query_cache = QueryEmbeddingCache(settings.query_embedding_cache_size)
+        self.snapshot = RetrieverSnapshot()
+        self._reload_lock = threading.Lock()
+        self.reload()
+
+    def reload(self) -> RetrieverSnapshot:
+        """Load the persisted index into a new snapshot and swap it in.
+
+        Loading happens entirely off to the side; the swap is a single
+        reference assignment. The old snapshot is freed once the last
+        request using it lets go.
+        """
+        with self._reload_lock:
+            index_path = self.settings.faiss_index_path
+            index, store, lexical = None, None, None
+            if ChunkStore.exists(index_path):
+                store = ChunkStore.open(index_path, read_only=True)
+                index = store.load_index()
+                if index is not None:
+                    configure_search(self.settings, index)
+                lexical = store.load_lexical()
+            snapshot = RetrieverSnapshot(index, store, self.snapshot.version + 1, lexical)
+            self.snapshot = snapshot
+        return snapshot
+
+    # Views of the current snapshot. Code that reads more than one of these
+    # should take ``self.snapshot`` once instead.
+    @property
+    def index(self) -> faiss.Index | None:
+        return self.snapshot.index
+
+    @property
+    def store(self) -> ChunkStore | None:
+        return self.snapshot.store
+
+    @property
+    def version(self) -> int:
+        return self.snapshot.version
 
     def is_ready(self) -> bool:
-        return self.index is not None and len(self.metadata["chunks"]) > 0
+        return self.snapshot.is_ready()
 
-    def retrieve(self, query: str, top_k: int | None = None) -> list[dict]:
-        """Retrieve the most relevant chunks for a query."""
-        if not self.is_ready():
+    def embed_query(self, query: str) -> np.ndarray:
+        """Normalized query vector of shape (1, dimension), cached by query text."""
+        key = normalize_query(query)
+        query_embedding = self.query_cache.get(key)
+        if query_embedding is None:
+            query_embedding = list(self.embedding_model.embed([query]))[0]
+            query_embedding = query_embedding / np.linalg.norm(query_embedding)
+            query_embedding = np.array([query_embedding], dtype=np.float32)
+            query_embedding.flags.writeable = False  # shared between requests
+            self.query_cache.put(key, query_embedding)
+        return query_embedding
+
+    def retrieve(
+        self,
+        query: str,
+        top_k: int | None = None,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        snapshot: RetrieverSnapshot | None = None,
+        timings: dict | None = None,
+    ) -> list[dict]:
+        """Retrieve the most relevant chunks for a query.
+
+        BM25 and vector search results are combined by reciprocal rank
+        fusion. Each result has the cosine ``score`` of the chunk (0.0 if
+        the vector search was skipped) and the share of the query it
+        contains as ``lexical_score``. When one chunk is a clear, complete
+        lexical match the vector search is skipped.
+
+        ``nprobe`` / ``ef_search`` override the configured search effort of
+        IVF / HNSW indexes for this query only. Searches ``snapshot`` if
+        given, else the current one. Stage durations in milliseconds are
+        written to ``timings`` if given.
+        """
+        snapshot = snapshot or self.snapshot
+        if not snapshot.is_ready():
             return []
+        index, store = snapshot.index, snapshot.store
+        timings = {} if timings is None else timings
 
-        k = min(top_k or self.settings.retrieval_top_k, self.index.ntotal)
+        k = min(top_k or self.settings.retrieval_top_k, index.ntotal)
         if k == 0:
             return []
+        candidates = max(k, self.settings.hybrid_candidates)
+
+        lexical_hits = []
+        if self.settings.hybrid_retrieval and snapshot.lexical is not None:
+            with _timed(timings, "lexical"):
+                lexical_hits = snapshot.lexical.search(
+                    query, candidates, self.settings.lexical_max_term_share
+                )
 
-        query_embedding = list(self.embedding_model.embed([query]))[0]
-        query_embedding = query_embedding / np.linalg.norm(query_embedding)
-        query_embedding = np.array([query_embedding], dtype=np.float32)
-
-        distances, indices = self.index.search(query_embedding, k)
-
-        results = []
-        for i in range(len(indices[0])):
-            idx = int(indices[0][i])
-            if idx < 0 or idx >= len(self.metadata["chunks"]):
-                continue
-            chunk = self.metadata["chunks"][idx]
-            results.append(
-                {
-                    "text": chunk["text"],
-                    "source": chunk["source"],
-                    "page": chunk["page"],
-                    "score": float(distances[0][i]),
-                }
-            )
+        dense_scores = {}
+        query_embedding = None
+        if not self._is_lexical_shortcut(lexical_hits):
+            with _timed(timings, "embed"):
+                query_embedding = self.embed_query(query)
+            dense_k = k if not lexical_hits else min(candidates, index.ntotal)
+            quantized = is_quantized(index)
+            with _timed(timings, "dense"):
+                distances, indices = index.search(
+                    query_embedding,
+                    min(dense_k * self.settings.faiss_rerank_factor, index.ntotal)
+                    if quantized
+                    else dense_k,
+                    params=search_params(index, nprobe, ef_search),
+                )
+            scores, row_ids = distances[0], indices[0][indices[0] >= 0]
+            if quantized:
+                # Compressed scores are approximate: re-score from the stored vectors
+                with _timed(timings, "rerank"):
+                    vectors, row_ids = store.vectors_for(row_ids)
+                    scores, row_ids = rerank(query_embedding, row_ids, vectors, dense_k)
+            dense_scores = {int(r): float(score) for r, score in zip(row_ids, scores)}
 
+        with _timed(timings, "fusion"):
+            fused = {}
+            for ranking in (list(dense_scores), [hit.row_id for hit in lexical_hits]):
+                for rank, row_id in enumerate(ranking):
+                    fused[row_id] = fused.get(row_id, 0.0) + 1 / (self.settings.rrf_k + rank + 1)
+            ranked = sorted(fused, key=fused.get, reverse=True)
+            coverage = {hit.row_id: hit.coverage for hit in lexical_hits}
+
+            results = []
+            for row_id in ranked:
+                chunk = store.get(row_id)
+                if chunk is None:
+                    continue
+                score = dense_scores.get(row_id)
+                if score is None and query_embedding is not None:
+                    # Found lexically only: score it against the stored vector
+                    score = float(store.vector(row_id) @ query_embedding[0])
+                results.append(
+                    {
+                        "text": chunk["text"],
+                        "source": chunk["source"],
+                        "page": chunk["page"],
+                        "page_end": chunk["page_end"],
+                        "score": score or 0.0,
+                        "lexical_score": coverage.get(row_id, 0.0),
+                    }
+                )
+                if len(results) == k:
+                    break
+
+        logger.debug(
+            "Retrieval timings (ms): "
+            + ", ".join(f"{stage}={ms:.2f}" for stage, ms in timings.items())
+        )
         return results
 
+    def _is_lexical_shortcut(self, hits: list[LexicalHit]) -> bool:
+        """True if the best lexical hit contains the whole query and clearly leads."""
+        if not hits or hits[0].coverage < self.settings.lexical_shortcut_coverage:
+            return False
+        runner_up = hits[1].score if len(hits) > 1 else 0.0
+        return hits[0].score >= self.settings.lexical_shortcut_margin * runner_up
+
     def format_context(self, results: list[dict]) -> str:
         """Format retrieved chunks for injection into Claude's context."""
         parts = []
@@ -0,0 +1,574 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import shutil
+
+import faiss
+import numpy as np
+
+from server.rag.index import all_vectors
+from server.rag.lexical import LexicalIndex, LexicalPostings
+
+logger = logging.getLogger("ask-michal")
+
+STORE_FORMAT_VERSION = 1
+MANIFEST = "MANIFEST.json"
+# BM25 postings of a segment's rows, next to its columns
+LEXICAL_POSTINGS = "lexical.npz"
+
+# Column name -> dtype. Every column is an .npy file inside a segment
+# directory and is memory-mapped on load, so opening a store costs almost
+# no RAM regardless of its size.
+COLUMNS = {
+    "text": np.uint8,  # UTF-8 text of the segment's chunks, back to back
+    "offsets": np.int64,  # chunk i is text[offsets[i]:offsets[i + 1]]
+    "source_ids": np.int32,  # index into the manifest's sources table
+    "pages": np.int32,  # first page of the chunk
+    "page_ends": np.int32,  # last page, for chunks that run across a page break
+    "chunk_index": np.int32,
+    "ids": np.uint8,  # raw sha256 digest of the chunk id, one 32-byte row per chunk
+    "vectors": np.float32,  # normalized embeddings, one row per chunk
+    "row_ids": np.int64,  # stable row id, also the row's FAISS vector id
+}
+
+
+def store_dir(index_path: str) -> str:
+    return f"{index_path}.chunks"
+
+
+def _write_npy(path: str, array: np.ndarray):
+    with open(path, "wb") as f:
+        np.save(f, array)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_json(path: str, data: dict):
+    """Atomically replace a JSON file (write-then-rename)."""
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+
+class Segment:
+    """One immutable, memory-mapped batch of rows."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.columns = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in COLUMNS
+        }
+        self._lexical: LexicalPostings | None = None
+
+    @property
+    def lexical(self) -> LexicalPostings:
+        """The segment's BM25 postings, read on first use."""
+        if self._lexical is None:
+            self._lexical = LexicalPostings.load(os.path.join(self.path, LEXICAL_POSTINGS))
+        return self._lexical
+
+    def __len__(self) -> int:
+        return len(self.columns["pages"])
+
+    def text(self, i: int) -> str:
+        offsets = self.columns["offsets"]
+        return bytes(self.columns["text"][offsets[i]:offsets[i + 1]]).decode("utf-8")
+
+    @staticmethod
+    def write(path: str, columns: dict[str, np.ndarray]):
+        """Write columns and the BM25 postings of their text as a new segment
+        directory, atomically."""
+        tmp_dir = f"{path}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name, dtype in COLUMNS.items():
+            _write_npy(os.path.join(tmp_dir, f"{name}.npy"), np.asarray(columns[name], dtype=dtype))
+        text, offsets = bytes(np.asarray(columns["text"], dtype=np.uint8)), columns["offsets"]
+        texts = (text[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1))
+        postings = LexicalPostings.build(columns["row_ids"], texts)
+        postings.save(os.path.join(tmp_dir, LEXICAL_POSTINGS))
+        os.rename(tmp_dir, path)
+
+
+class ChunkStore:
+    """Append-only, segmented store of chunks and their vectors.
+
+    Every row has a stable row id, which is also its vector id in the FAISS
+    index. Each commit writes the new rows as a fresh segment directory and
+    then atomically replaces MANIFEST.json, so ingestion only writes what
+    was added and a crash never leaves a half-written store behind. Deleted
+    rows are only listed in the manifest until ``compact`` rewrites the
+    segments without them.
+
+    The manifest also names a FAISS index checkpoint holding every live row
+    with a row id below ``index_rows``; later rows are added from the
+    segments when the index is loaded. Each segment also holds the BM25
+    postings of its rows, so ``load_lexical`` needs no rebuild after rows
+    are added or deleted. ``files`` maps each ingested source file to the
+    sha256 of its contents and of the settings it was ingested with.
+
+    Rows are only decoded into dicts when requested, so the retriever pays
+    for the top-k rows it returns and nothing else.
+
+    There is a single writer. Readers open the store ``read_only`` and
+    never change its directory.
+    """
+
+    def __init__(self, path: str, read_only: bool = False):
+        self.path = path
+        self.read_only = read_only
+        self._reset()
+
+    def _reset(self):
+        self.segments: list[Segment] = []
+        self._starts = np.zeros(1, dtype=np.int64)
+        self._row_ids = np.empty(0, dtype=np.int64)
+        self.sources: list[str] = []
+        self._source_lookup: dict[str, int] = {}
+        self.files: dict[str, dict] = {}
+        self._deleted: set[int] = set()
+        self._manifest = {
+            "version": STORE_FORMAT_VERSION,
+            "segments": [],
+            "sources": [],
+            "files": {},
+            "index": None,
+            "index_rows": 0,
+            "next_id": 1,
+            "next_row_id": 0,
+            "deleted": [],
+            "garbage": [],
+        }
+        self._pending: list[dict] = []
+        self._pending_vectors: list[np.ndarray] = []
+        self._pending_start = 0
+        self._id_set: set[bytes] | None = None
+        self._legacy_index: faiss.Index | None = None
+
+    @classmethod
+    def open(cls, index_path: str, read_only: bool = False) -> "ChunkStore":
+        """Open the store next to a FAISS index.
+
+        A writer migrates a ``<index>.meta.json`` + ``<index>.faiss`` pair
+        into the store. A reader loads such a pair into memory instead and
+        leaves the migration to the next writer.
+        """
+        store = cls(store_dir(index_path), read_only)
+        if os.path.exists(os.path.join(store.path, MANIFEST)):
+            store._load()
+            return store
+        index = store._read_legacy(index_path)
+        if index is None:
+            return store
+        if read_only:
+            store._legacy_index = index
+        else:
+            store.commit(index)
+            logger.info(f"Migrated {len(store)} chunks from {index_path}.faiss to {store.path}")
+        return store
+
+    @classmethod
+    def exists(cls, index_path: str) -> bool:
+        return any(
+            os.path.exists(path)
+            for path in (os.path.join(store_dir(index_path), MANIFEST), f"{index_path}.meta.json")
+        )
+
+    def _read_legacy(self, index_path: str) -> faiss.Index | None:
+        """Append the rows of a ``<index>.meta.json`` + ``<index>.faiss`` pair.
+
+        Returns their index, or None if there is no such pair. The old index
+        numbered vectors by position, which are the new row ids, so it is
+        rebuilt as a flat index holding them under those ids.
+        """
+        legacy_meta = f"{index_path}.meta.json"
+        legacy_index = f"{index_path}.faiss"
+        if not (os.path.exists(legacy_meta) and os.path.exists(legacy_index)):
+            return None
+
+        with open(legacy_meta, "r", encoding="utf-8") as f:
+            chunks = json.load(f)["chunks"]
+        vectors = all_vectors(faiss.read_index(legacy_index))
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(vectors.shape[1]))
+        index.add_with_ids(vectors, self.append(chunks, vectors))
+        return index
+
+    def _load(self):
+        with open(os.path.join(self.path, MANIFEST), "r", encoding="utf-8") as f:
+            self._manifest = json.load(f)
+        self.segments = [Segment(os.path.join(self.path, name)) for name in self._manifest["segments"]]
+        self._starts = np.cumsum([0] + [len(s) for s in self.segments], dtype=np.int64)
+        self._row_ids = self._column("row_ids")
+        self.sources = list(self._manifest["sources"])
+        self._source_lookup = {s: i for i, s in enumerate(self.sources)}
+        self.files = dict(self._manifest["files"])
+        self._deleted = set(self._manifest["deleted"])
+        self._pending = []
+        self._pending_vectors = []
+        self._pending_start = self._manifest["next_row_id"]
+        self._id_set = None
+
+    @property
+    def saved_count(self) -> int:
+        """Rows in the segments, including deleted ones not yet compacted."""
+        return int(self._starts[-1])
+
+    @property
+    def index_rows(self) -> int:
+        """Row ids below this are covered by the index checkpoint."""
+        return self._manifest["index_rows"]
+
+    def __len__(self) -> int:
+        """Number of live rows."""
+        return self.saved_count + len(self._pending) - len(self._deleted)
+
+    def _position(self, row_id: int) -> int | None:
+        if row_id >= self._pending_start:
+            pos = row_id - self._pending_start
+            return self.saved_count + pos if pos < len(self._pending) else None
+        pos = int(np.searchsorted(self._row_ids, row_id))
+        if pos < len(self._row_ids) and self._row_ids[pos] == row_id:
+            return pos
+        return None
+
+    def _row(self, pos: int) -> dict:
+        """Decode the row at a physical position."""
+        if pos >= self.saved_count:
+            return self._pending[pos - self.saved_count]
+        s = int(np.searchsorted(self._starts, pos, side="right")) - 1
+        segment, j = self.segments[s], pos - int(self._starts[s])
+        return {
+            "id": segment.columns["ids"][j].tobytes().hex(),
+            "text": segment.text(j),
+            "source": self.sources[segment.columns["source_ids"][j]],
+            "page": int(segment.columns["pages"][j]),
+            "page_end": int(segment.columns["page_ends"][j]),
+            "chunk_index": int(segment.columns["chunk_index"][j]),
+        }
+
+    def get(self, row_id: int) -> dict | None:
+        """Decode a single live row, or None if it does not exist."""
+        if row_id in self._deleted:
+            return None
+        pos = self._position(row_id)
+        return None if pos is None else self._row(pos)
+
+    def vector(self, row_id: int) -> np.ndarray | None:
+        """The stored vector of a live row."""
+        pos = None if row_id in self._deleted else self._position(row_id)
+        if pos is None:
+            return None
+        if pos >= self.saved_count:
+            return np.concatenate(self._pending_vectors)[pos - self.saved_count]
+        s = int(np.searchsorted(self._starts, pos, side="right")) - 1
+        return np.asarray(self.segments[s].columns["vectors"][pos - int(self._starts[s])])
+
+    def vectors_for(self, row_ids) -> tuple[np.ndarray, np.ndarray]:
+        """Stored vectors of the live rows among ``row_ids``, and those row ids."""
+        found = [(int(r), v) for r in row_ids if (v := self.vector(int(r))) is not None]
+        if not found:
+            return np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64)
+        return (
+            np.stack([v for _, v in found]).astype(np.float32, copy=False),
+            np.array([r for r, _ in found], dtype=np.int64),
+        )
+
+    def _column(self, name: str) -> np.ndarray:
+        """A column across all saved segments (a copy, for bulk operations)."""
+        if not self.segments:
+            return np.empty((0, 32) if name == "ids" else 0, dtype=COLUMNS[name])
+        return np.concatenate([s.columns[name] for s in self.segments])
+
+    def _live_mask(self, row_ids: np.ndarray) -> np.ndarray:
+        if not self._deleted:
+            return np.ones(len(row_ids), dtype=bool)
+        return ~np.isin(row_ids, np.fromiter(self._deleted, dtype=np.int64))
+
+    def _pending_row_ids(self) -> np.ndarray:
+        return np.arange(self._pending_start, self._pending_start + len(self._pending), dtype=np.int64)
+
+    def live_row_ids(self) -> np.ndarray:
+        row_ids = np.concatenate([self._row_ids, self._pending_row_ids()])
+        return row_ids[self._live_mask(row_ids)]
+
+    def pages(self) -> np.ndarray:
+        pages = np.concatenate(
+            [self._column("pages"), np.array([c["page"] for c in self._pending], dtype=np.int32)]
+        )
+        return pages[self._live_mask(np.concatenate([self._row_ids, self._pending_row_ids()]))]
+
+    def _vectors_from(self, start: int = 0) -> np.ndarray:
+        """Vectors of saved rows from position ``start`` on, in row order."""
+        parts = [
+            segment.columns["vectors"][max(0, start - int(seg_start)):]
+            for segment, seg_start in zip(self.segments, self._starts)
+            if seg_start + len(segment) > start
+        ]
+        if not parts:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.ascontiguousarray(np.concatenate(parts), dtype=np.float32)
+
+    def live_vectors(self) -> tuple[np.ndarray, np.ndarray]:
+        """Vectors and row ids of every live row, saved or pending."""
+        vectors = [self._vectors_from()] if self.segments else []
+        vectors += self._pending_vectors
+        row_ids = np.concatenate([self._row_ids, self._pending_row_ids()])
+        if not vectors:
+            return np.empty((0, 0), dtype=np.float32), row_ids
+        live = self._live_mask(row_ids)
+        return np.ascontiguousarray(np.concatenate(vectors)[live]), row_ids[live]
+
+    def source_rows(self, source: str) -> dict[str, int]:
+        """Chunk id -> row id for every live row of a source file."""
+        rows = {}
+        source_id = self._source_lookup.get(source)
+        if source_id is not None and self.segments:
+            match = (self._column("source_ids") == source_id) & self._live_mask(self._row_ids)
+            ids = self._column("ids")
+            for pos in np.flatnonzero(match):
+                rows[ids[pos].tobytes().hex()] = int(self._row_ids[pos])
+        for chunk, row_id in zip(self._pending, self._pending_row_ids()):
+            if chunk["source"] == source and int(row_id) not in self._deleted:
+                rows[chunk["id"]] = int(row_id)
+        return rows
+
+    def sources_in_use(self) -> set[str]:
+        """Sources with at least one live row."""
+        source_ids = self._column("source_ids")[self._live_mask(self._row_ids)]
+        used = {self.sources[i] for i in np.unique(source_ids)}
+        used.update(
+            c["source"]
+            for c, row_id in zip(self._pending, self._pending_row_ids())
+            if int(row_id) not in self._deleted
+        )
+        return used
+
+    def __contains__(self, chunk_id: str) -> bool:
+        if self._id_set is None:
+            ids = self._column("ids")[self._live_mask(self._row_ids)]
+            self._id_set = {row.tobytes() for row in ids}
+            self._id_set.update(
+                bytes.fromhex(c["id"])
+                for c, row_id in zip(self._pending, self._pending_row_ids())
+                if int(row_id) not in self._deleted
+            )
+        return bytes.fromhex(chunk_id) in self._id_set
+
+    def append(self, chunks: list[dict], vectors: np.ndarray) -> np.ndarray:
+        """Buffer new rows and return their row ids.
+
+        The rows become visible immediately and durable on commit.
+        """
+        first = self._manifest["next_row_id"]
+        if not chunks:
+            return np.empty(0, dtype=np.int64)
+        for chunk in chunks:
+            self._pending.append({"page_end": chunk["page"], **chunk})
+            if chunk["source"] not in self._source_lookup:
+                self._source_lookup[chunk["source"]] = len(self.sources)
+                self.sources.append(chunk["source"])
+            if self._id_set is not None:
+                self._id_set.add(bytes.fromhex(chunk["id"]))
+        self._pending_vectors.append(np.asarray(vectors, dtype=np.float32))
+        self._manifest["next_row_id"] = first + len(chunks)
+        return np.arange(first, first + len(chunks), dtype=np.int64)
+
+    def delete(self, row_ids):
+        """Mark rows deleted; ``compact`` drops them from the segments."""
+        self._deleted.update(int(r) for r in row_ids)
+        self._id_set = None
+
+    def _pending_columns(self) -> dict[str, np.ndarray]:
+        pending = self._pending
+        texts = [c["text"].encode("utf-8") for c in pending]
+        lengths = np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+        return {
+            "text": np.frombuffer(b"".join(texts), dtype=np.uint8),
+            "offsets": np.concatenate([[0], np.cumsum(lengths)]),
+            "source_ids": [self._source_lookup[c["source"]] for c in pending],
+            "pages": [c["page"] for c in pending],
+            "page_ends": [c["page_end"] for c in pending],
+            "chunk_index": [c["chunk_index"] for c in pending],
+            "ids": np.frombuffer(
+                b"".join(bytes.fromhex(c["id"]) for c in pending), dtype=np.uint8
+            ).reshape(-1, 32),
+            "vectors": np.concatenate(self._pending_vectors),
+            "row_ids": self._pending_row_ids(),
+        }
+
+    def _new_name(self, prefix: str) -> str:
+        name = f"{prefix}-{self._manifest['next_id']:06d}"
+        self._manifest["next_id"] += 1
+        return name
+
+    def _replace_file(self, key: str, suffix: str, write) -> str:
+        """Write a new artifact named in the manifest under ``key``, retiring the old one."""
+        if self._manifest[key]:
+            self._manifest["garbage"].append(self._manifest[key])
+        name = self._new_name(key) + suffix
+        tmp_file = os.path.join(self.path, f"{name}.tmp")
+        write(tmp_file)
+        os.replace(tmp_file, os.path.join(self.path, name))
+        self._manifest[key] = name
+        return name
+
+    def _checkpoint(self, index: faiss.Index):
+        """Write ``index`` (covering every live row) as the new index checkpoint."""
+        self._replace_file("index", ".faiss", lambda path: faiss.write_index(index, path))
+        self._manifest["index_rows"] = self._manifest["next_row_id"]
+
+    def _collect_garbage(self):
+        """Delete files retired by the previous commit.
+
+        Deletion lags one commit behind so a reader that opened the previous
+        manifest can still map everything it names.
+        """
+        for name in self._manifest["garbage"]:
+            target = os.path.join(self.path, name)
+            if os.path.isdir(target):
+                shutil.rmtree(target, ignore_errors=True)
+            elif os.path.exists(target):
+                os.remove(target)
+        self._manifest["garbage"] = []
+
+    def _remove_orphans(self):
+        """Delete files a crashed commit wrote but never named in the manifest.
+
+        New names come from ``next_id``, which is only saved with the
+        manifest, so an orphan would otherwise block the next commit that
+        reuses its name. Only the writer calls this: a reader can't tell an
+        orphan from the segment of a commit still in progress.
+        """
+        if not os.path.isdir(self.path):
+            return
+        named = {MANIFEST, *self._manifest["segments"], *self._manifest["garbage"]}
+        if self._manifest["index"]:
+            named.add(self._manifest["index"])
+        for name in os.listdir(self.path):
+            if name in named or not (name.startswith(("seg-", "index-")) or name.endswith(".tmp")):
+                continue
+            target = os.path.join(self.path, name)
+            if os.path.isdir(target):
+                shutil.rmtree(target, ignore_errors=True)
+            else:
+                os.remove(target)
+            logger.warning(f"Removed {target}, left behind by an interrupted commit")
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError(f"Chunk store {self.path} was opened read-only")
+
+    def _write_manifest(self):
+        self._manifest["version"] = STORE_FORMAT_VERSION
+        self._manifest["sources"] = self.sources
+        self._manifest["files"] = self.files
+        self._manifest["deleted"] = sorted(self._deleted)
+        _write_json(os.path.join(self.path, MANIFEST), self._manifest)
+        self._load()
+
+    def commit(self, index: faiss.Index | None = None):
+        """Persist pending rows as a new segment, plus deletions and file hashes.
+
+        If ``index`` is given it also becomes the new index checkpoint. It
+        must be given whenever rows covered by the checkpoint were deleted.
+        Only the new segment, the optional index files and the small
+        manifest are written; the manifest replace is the commit point.
+        """
+        self._check_writable()
+        os.makedirs(self.path, exist_ok=True)
+        self._remove_orphans()
+        self._collect_garbage()
+        if self._pending:
+            name = self._new_name("seg")
+            Segment.write(os.path.join(self.path, name), self._pending_columns())
+            self._manifest["segments"].append(name)
+        if index is not None:
+            self._checkpoint(index)
+        self._write_manifest()
+
+    def needs_compaction(self, max_segments: int) -> bool:
+        """Too many segments, or a quarter of the saved rows are deleted."""
+        return len(self.segments) > max_segments or len(self._deleted) * 4 > self.saved_count
+
+    def _live_columns(self, segment: Segment) -> dict[str, np.ndarray]:
+        """A segment's columns without its deleted rows."""
+        live = self._live_mask(segment.columns["row_ids"])
+        if live.all():
+            return {name: segment.columns[name] for name in COLUMNS}
+        columns = {
+            name: segment.columns[name][live] for name in COLUMNS if name not in ("text", "offsets")
+        }
+        texts = [segment.text(j).encode("utf-8") for j in np.flatnonzero(live)]
+        lengths = np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+        columns["text"] = np.frombuffer(b"".join(texts), dtype=np.uint8)
+        columns["offsets"] = np.concatenate([[0], np.cumsum(lengths)])
+        return columns
+
+    def compact(self, index: faiss.Index):
+        """Merge all segments into one without deleted rows and checkpoint ``index``."""
+        self.commit()
+        if len(self.segments) > 1 or (self.segments and self._deleted):
+            parts = [self._live_columns(s) for s in self.segments]
+            merged = {
+                name: np.concatenate([p[name] for p in parts])
+                for name in COLUMNS
+                if name != "offsets"
+            }
+            # Offsets restart in every segment; rebase them onto the merged text
+            bases = np.cumsum([0] + [len(p["text"]) for p in parts[:-1]])
+            merged["offsets"] = np.concatenate(
+                [[0]] + [p["offsets"][1:] + base for p, base in zip(parts, bases)]
+            )
+            name = self._new_name("seg")
+            Segment.write(os.path.join(self.path, name), merged)
+            self._manifest["garbage"].extend(self._manifest["segments"])
+            self._manifest["segments"] = [name]
+            self._deleted = set()
+        self._checkpoint(index)
+        self._write_manifest()
+
+    def load_index(self) -> faiss.Index | None:
+        """Load the index checkpoint and add the live rows committed after it."""
+        if self._legacy_index is not None:
+            return self._legacy_index
+        if not self._manifest["index"] and not self.saved_count:
+            return None
+        if self._manifest["index"]:
+            index = faiss.read_index(os.path.join(self.path, self._manifest["index"]))
+        else:
+            index = faiss.IndexIDMap2(
+                faiss.IndexFlatIP(self.segments[0].columns["vectors"].shape[1])
+            )
+        tail = (self._row_ids >= self.index_rows) & self._live_mask(self._row_ids)
+        if tail.any():
+            start = int(np.argmax(tail))
+            index.add_with_ids(self._vectors_from(start)[tail[start:]], self._row_ids[tail])
+        return index
+
+    def load_lexical(self) -> LexicalIndex | None:
+        """BM25 search over the committed live rows, from the segments' postings."""
+        if not self.segments:
+            return None
+        return LexicalIndex([s.lexical for s in self.segments], self._deleted)
+
+    def clear(self):
+        """Drop all rows; their files are deleted by the next commit."""
+        self._check_writable()
+        os.makedirs(self.path, exist_ok=True)
+        self._remove_orphans()
+        self._collect_garbage()
+        retired = list(self._manifest["segments"])
+        if self._manifest["index"]:
+            retired.append(self._manifest["index"])
+        next_id = self._manifest["next_id"]
+        next_row_id = self._manifest["next_row_id"]
+        self._reset()
+        self._manifest["garbage"] = retired
+        self._manifest["next_id"] = next_id
+        self._manifest["next_row_id"] = next_row_id
+        self._pending_start = next_row_id
+        self._write_manifest()
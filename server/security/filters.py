@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import re
 from dataclasses import dataclass
+from typing import Iterable
 
 
 @dataclass
@@ -10,6 +11,16 @@ class FilterResult:
     reason: str = ""
 
 
+@dataclass(frozen=True)
+class FilterRule:
+    """A pattern that blocks a question, and the reason and refusal it maps to."""
+
+    reason: str
+    refusal_message: str
+    pattern: str
+    flags: int = 0  # re flags, e.g. re.I
+
+
 # Hebrew refusal messages
 REFUSAL_PII = (
     "אינני רשאית לעבד מידע אישי מזהה. "
@@ -22,74 +33,84 @@ REFUSAL_PERSONAL = (
 REFUSAL_INJECTION = "אינני יכולה לעבד בקשה זו."
 
 
-class InputFilter:
-    """Filter incoming questions for PII and security violations."""
+class RuleMatcher:
+    """Ordered filter rules, each compiled once.
 
-    # Israeli ID (Teudat Zehut): exactly 9 digits
-    TEUDAT_ZEHUT_PATTERN = re.compile(r"\b\d{9}\b")
+    The rules are searched one at a time and the first rule that matches
+    anywhere in the text wins. One alternation of all the rules was
+    measured slower with Python's re engine: a rule searched on its own
+    skips ahead to its literal prefix, which an alternation cannot.
+    """
 
-    # Israeli phone numbers
-    PHONE_PATTERN = re.compile(r"\b0[2-9]\d{7,8}\b|(\+972|972)\d{8,9}\b")
+    def __init__(self, rules: Iterable[FilterRule]):
+        self.rules = list(rules)
+        self._patterns = [re.compile(rule.pattern, rule.flags) for rule in self.rules]
+
+    def first_match(self, text: str) -> FilterRule | None:
+        for rule, pattern in zip(self.rules, self._patterns):
+            if pattern.search(text):
+                return rule
+        return None
+
+
+class InputFilter:
+    """Filter incoming questions for PII and security violations."""
 
-    # Patterns suggesting a query about a specific person
-    PERSONAL_QUERY_PATTERNS = [
-        re.compile(r"מספר\s+אישי"),
-        re.compile(r"תעודת\s+זהות"),
-        re.compile(r"ת\.?ז\.?"),
-        re.compile(r"כתובת\s+של"),
-        re.compile(r"טלפון\s+של"),
-        re.compile(r"איפה\s+(?:גר|גרה)\b"),
-        re.compile(r"מידע\s+על\s+[\u05d0-\u05ea]+\s+[\u05d0-\u05ea]+"),
+    # Checked in this order: the first rule that matches anywhere in the
+    # question decides the reason. Append to extend.
+    RULES = [
+        # Israeli ID (Teudat Zehut): exactly 9 digits
+        FilterRule("teudat_zehut", REFUSAL_PII, r"\b\d{9}\b"),
+        # Israeli phone numbers
+        FilterRule("phone_number", REFUSAL_PII, r"\b0[2-9]\d{7,8}\b|(?:\+972|972)\d{8,9}\b"),
+        # Patterns suggesting a query about a specific person
+        FilterRule("personal_query", REFUSAL_PERSONAL, r"מספר\s+אישי"),
+        FilterRule("personal_query", REFUSAL_PERSONAL, r"תעודת\s+זהות"),
+        FilterRule("personal_query", REFUSAL_PERSONAL, r"ת\.?ז\.?"),
+        FilterRule("personal_query", REFUSAL_PERSONAL, r"כתובת\s+של"),
+        FilterRule("personal_query", REFUSAL_PERSONAL, r"טלפון\s+של"),
+        FilterRule("personal_query", REFUSAL_PERSONAL, r"איפה\s+(?:גר|גרה)\b"),
+        FilterRule(
+            "personal_query",
+            REFUSAL_PERSONAL,
+            r"מידע\s+על\s+[\u05d0-\u05ea]+\s+[\u05d0-\u05ea]+",
+        ),
         # IDF ranks followed by a name
-        re.compile(
-            r'(טוראי|רב"ט|סמל|סמ"ר|רס"ל|סא"ל|אל"מ|תא"ל|רב\s*אלוף|סגן|סרן|רס"ן)'
-            r"\s+[\u05d0-\u05ea]+"
+        FilterRule(
+            "personal_query",
+            REFUSAL_PERSONAL,
+            r'(?:טוראי|רב"ט|סמל|סמ"ר|רס"ל|סא"ל|אל"מ|תא"ל|רב\s*אלוף|סגן|סרן|רס"ן)'
+            r"\s+[\u05d0-\u05ea]+",
+        ),
+        # Prompt injection patterns (Hebrew + English)
+        FilterRule(
+            "injection_attempt",
+            REFUSAL_INJECTION,
+            r"ignore\s+(?:previous|above|all)\s+(?:instructions|prompts)",
+            re.I,
         ),
+        FilterRule(
+            "injection_attempt",
+            REFUSAL_INJECTION,
+            r"forget\s+(?:your|all)\s+(?:instructions|rules)",
+            re.I,
+        ),
+        FilterRule("injection_attempt", REFUSAL_INJECTION, r"התעלם\s+מה?(?:הנחיות|כללים|הוראות)"),
+        FilterRule("injection_attempt", REFUSAL_INJECTION, r"שנה\s+את\s+הזהות"),
+        FilterRule("injection_attempt", REFUSAL_INJECTION, r"אתה\s+לא\s+מיכל"),
+        FilterRule("injection_attempt", REFUSAL_INJECTION, r"system\s*prompt", re.I),
+        FilterRule("injection_attempt", REFUSAL_INJECTION, r"you\s+are\s+now", re.I),
+        FilterRule("injection_attempt", REFUSAL_INJECTION, r"act\s+as\s+(?!a\s+hr)", re.I),
     ]
 
-    # Prompt injection patterns (Hebrew + English)
-    INJECTION_PATTERNS = [
-        re.compile(r"ignore\s+(previous|above|all)\s+(instructions|prompts)", re.I),
-        re.compile(r"forget\s+(your|all)\s+(instructions|rules)", re.I),
-        re.compile(r"התעלם\s+מ(ה?(הנחיות|כללים|הוראות))"),
-        re.compile(r"שנה\s+את\s+הזהות"),
-        re.compile(r"אתה\s+לא\s+מיכל"),
-        re.compile(r"system\s*prompt", re.I),
-        re.compile(r"you\s+are\s+now", re.I),
-        re.compile(r"act\s+as\s+(?!a\s+hr)", re.I),
-    ]
+    def __init__(self, rules: Iterable[FilterRule] | None = None):
+        self.matcher = RuleMatcher(self.RULES if rules is None else rules)
 
     def check(self, text: str) -> FilterResult:
-        # Check for PII data in the question itself
-        if self.TEUDAT_ZEHUT_PATTERN.search(text):
-            return FilterResult(
-                blocked=True, refusal_message=REFUSAL_PII, reason="teudat_zehut"
-            )
-
-        if self.PHONE_PATTERN.search(text):
-            return FilterResult(
-                blocked=True, refusal_message=REFUSAL_PII, reason="phone_number"
-            )
-
-        # Check for queries about specific individuals
-        for pattern in self.PERSONAL_QUERY_PATTERNS:
-            if pattern.search(text):
-                return FilterResult(
-                    blocked=True,
-                    refusal_message=REFUSAL_PERSONAL,
-                    reason="personal_query",
-                )
-
-        # Check for prompt injection attempts
-        for pattern in self.INJECTION_PATTERNS:
-            if pattern.search(text):
-                return FilterResult(
-                    blocked=True,
-                    refusal_message=REFUSAL_INJECTION,
-                    reason="injection_attempt",
-                )
-
-        return FilterResult(blocked=False)
+        rule = self.matcher.first_match(text)
+        if rule is None:
+            return FilterResult(blocked=False)
+        return FilterResult(blocked=True, refusal_message=rule.refusal_message, reason=rule.reason)
 
 
 class OutputFilter:
@@ -102,3 +123,29 @@ class OutputFilter:
         text = self.TEUDAT_ZEHUT_PATTERN.sub("[מספר מזהה הוסר]", text)
         text = self.PHONE_PATTERN.sub("[מספר טלפון הוסר]", text)
         return text
+
+
+class StreamingOutputFilter:
+    """Apply OutputFilter to text that arrives in pieces.
+
+    PII patterns never span whitespace, so text is released up to the last
+    whitespace seen and the trailing partial word is held back until more
+    text (or the end of the stream) shows how it ends. The concatenated
+    output equals ``OutputFilter.sanitize`` of the whole text.
+    """
+
+    def __init__(self, output_filter: OutputFilter | None = None):
+        self.output_filter = output_filter or OutputFilter()
+        self._pending = ""
+
+    def feed(self, text: str) -> str:
+        self._pending += text
+        cut = max(self._pending.rfind(c) for c in " \n\t") + 1
+        if cut <= 0:
+            return ""
+        ready, self._pending = self._pending[:cut], self._pending[cut:]
+        return self.output_filter.sanitize(ready)
+
+    def flush(self) -> str:
+        ready, self._pending = self._pending, ""
+        return self.output_filter.sanitize(ready)
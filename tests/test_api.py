@@ -65,3 +65,313 @@ class TestAskResponse:
             query_id=42,
         )
         assert resp.query_id == 42
+
+
+@pytest.fixture
+def quota_db(tmp_path):
+    """Run ``scenario(sessionmaker)`` against a fresh database with one user with a quota of 20."""
+    import asyncio
+
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+
+    from server.config import Settings
+    from server.database import Base, create_async_db_engine
+    from server.models import User
+
+    settings = Settings(database_url=f"sqlite:///{tmp_path / 'quota.db'}")
+
+    def run(scenario):
+        async def main():
+            engine = create_async_db_engine(settings)
+            try:
+                async with engine.begin() as conn:
+                    await conn.run_sync(Base.metadata.create_all)
+                Session = async_sessionmaker(engine, expire_on_commit=False)
+                async with Session() as db:
+                    db.add(User(id=1, google_id="g1", email="user@example.com", name="User", queries_remaining=20))
+                    await db.commit()
+                return await scenario(Session)
+            finally:
+                await engine.dispose()
+
+        return asyncio.run(main())
+
+    return run
+
+
+async def _remaining(Session) -> int:
+    from server.models import User
+
+    async with Session() as db:
+        return (await db.get(User, 1)).queries_remaining
+
+
+class TestQuotaAccounting:
+    def test_reserve_stops_at_zero(self, quota_db):
+        from server.api import quota
+
+        async def scenario(Session):
+            async with Session() as db:
+                results = [await quota.reserve(db, 1) for _ in range(21)]
+            return results, await _remaining(Session)
+
+        results, remaining = quota_db(scenario)
+
+        assert results[0] == 19
+        assert results[19] == 0
+        assert results[20] is None
+        assert remaining == 0
+
+    def test_release_refunds(self, quota_db):
+        from server.api import quota
+        from server.models import User
+
+        async def scenario(Session):
+            async with Session() as db:
+                await quota.reserve(db, 1)
+                await quota.reserve(db, 1)
+                assert await quota.release(db, 1) == 19
+            async with Session() as db:
+                return (await db.get(User, 1)).queries_used, await _remaining(Session)
+
+        assert quota_db(scenario) == (1, 19)
+
+    def test_concurrent_requests_lose_no_updates(self, quota_db):
+        import asyncio
+
+        from server.api import quota
+
+        async def reserve(Session):
+            async with Session() as db:
+                return await quota.reserve(db, 1)
+
+        async def credit(Session):
+            async with Session() as db:
+                return await quota.credit(db, 1, 1)
+
+        async def scenario(Session):
+            reserved = await asyncio.gather(*(reserve(Session) for _ in range(60)))
+            after_reserve = await _remaining(Session)
+            credited = await asyncio.gather(*(credit(Session) for _ in range(30)))
+            return reserved, after_reserve, credited, await _remaining(Session)
+
+        reserved, after_reserve, credited, remaining = quota_db(scenario)
+
+        # Each granted request saw its own balance, and no more than the quota was granted
+        assert sorted(r for r in reserved if r is not None) == list(range(20))
+        assert after_reserve == 0
+        assert sorted(credited) == list(range(1, 31))
+        assert remaining == 30
+
+
+USAGE = {"tokens_used": 10, "cache_read_tokens": 0, "cache_write_tokens": 0, "model": "m"}
+
+
+async def _log_count(Session) -> int:
+    from sqlalchemy import func, select
+
+    from server.models import QueryLog
+
+    async with Session() as db:
+        return await db.scalar(select(func.count()).select_from(QueryLog))
+
+
+class TestQueryLogWriter:
+    def test_ids_are_returned_before_the_batch_is_written(self, quota_db):
+        from server.api.log_writer import QueryLogWriter
+        from server.models import QueryLog, User
+
+        async def scenario(Session):
+            writer = QueryLogWriter(Session, batch_size=100, flush_seconds=60)
+            await writer.start()
+            ids = [writer.submit(1, f"שאלה {i}", USAGE) for i in range(5)]
+            assert writer.is_pending(ids[0])
+            before = await _log_count(Session)
+
+            await writer.flush()
+            async with Session() as db:
+                log = await db.get(QueryLog, ids[-1])
+                user = await db.get(User, 1)
+            await writer.close()
+            return ids, before, log, user.total_tokens, writer.stats()
+
+        ids, before, log, total_tokens, stats = quota_db(scenario)
+
+        assert ids == [1, 2, 3, 4, 5]
+        assert before == 0
+        assert (log.user_id, log.model, log.tokens_used) == (1, "m", 10)
+        assert total_tokens == 50
+        assert stats["queue_depth"] == 0 and stats["rows_written"] == 5
+
+    def test_full_batch_is_written_in_the_background(self, quota_db):
+        import asyncio
+
+        from server.api.log_writer import QueryLogWriter
+
+        async def scenario(Session):
+            writer = QueryLogWriter(Session, batch_size=3, flush_seconds=60)
+            await writer.start()
+            for i in range(3):
+                writer.submit(1, f"שאלה {i}", USAGE)
+            for _ in range(100):
+                if writer.queue_depth() == 0:
+                    break
+                await asyncio.sleep(0.01)
+            count = await _log_count(Session)
+            await writer.close()
+            return count
+
+        assert quota_db(scenario) == 3
+
+    def test_close_writes_what_is_left_and_ids_continue(self, quota_db):
+        from server.api.log_writer import QueryLogWriter
+
+        async def scenario(Session):
+            writer = QueryLogWriter(Session, batch_size=100, flush_seconds=60)
+            await writer.start()
+            writer.submit(1, "שאלה", USAGE)
+            await writer.close()
+
+            restarted = QueryLogWriter(Session)
+            await restarted.start()
+            next_id = restarted.submit(1, "שאלה", USAGE)
+            await restarted.close()
+            return next_id, await _log_count(Session)
+
+        assert quota_db(scenario) == (2, 2)
+
+    def test_row_that_keeps_failing_is_dropped_without_blocking_others(self, quota_db):
+        from server.api.log_writer import QueryLogWriter
+        from server.models import QueryLog
+
+        async def scenario(Session):
+            writer = QueryLogWriter(Session, batch_size=100, flush_seconds=60, max_attempts=2)
+            await writer.start()
+            # Another writer took the id this one is about to hand out
+            async with Session() as db:
+                db.add(QueryLog(id=2, user_id=1, question_hash="h", tokens_used=0))
+                await db.commit()
+            ids = [writer.submit(1, f"שאלה {i}", USAGE) for i in range(3)]
+
+            await writer.flush()
+            first = writer.stats()
+            await writer.flush()
+            await writer.close()
+            return ids, first, writer.stats(), await _log_count(Session)
+
+        ids, first, final, count = quota_db(scenario)
+
+        assert ids == [1, 2, 3]
+        assert (first["rows_written"], first["queue_depth"]) == (2, 1)
+        assert (final["rows_written"], final["rows_dropped"], final["queue_depth"]) == (2, 1, 0)
+        assert count == 3
+
+
+class TestUsageCounters:
+    def test_rebuild_recounts_from_query_logs(self, tmp_path):
+        from sqlalchemy.orm import sessionmaker
+
+        from server.config import Settings
+        from server.database import Base, create_db_engine, rebuild_usage_counters
+        from server.models import QueryLog, User
+
+        engine = create_db_engine(Settings(database_url=f"sqlite:///{tmp_path / 'x.db'}"))
+        Base.metadata.create_all(engine)
+        Session = sessionmaker(bind=engine)
+        with Session() as db:
+            db.add_all([
+                User(id=1, google_id="g1", email="a@example.com", name="A", queries_used=7, total_tokens=1),
+                User(id=2, google_id="g2", email="b@example.com", name="B"),
+                QueryLog(user_id=1, question_hash="h", tokens_used=100),
+                QueryLog(user_id=1, question_hash="h", tokens_used=50),
+            ])
+            db.commit()
+
+        assert rebuild_usage_counters(engine) == 1
+        assert rebuild_usage_counters(engine) == 0
+        with Session() as db:
+            assert (db.get(User, 1).queries_used, db.get(User, 1).total_tokens) == (2, 150)
+            assert (db.get(User, 2).queries_used, db.get(User, 2).total_tokens) == (0, 0)
+        engine.dispose()
+
+
+class TestDatabaseTuning:
+    def test_write_engine_uses_wal_and_settings_pragmas(self, tmp_path):
+        from sqlalchemy import text
+
+        from server.config import Settings
+        from server.database import create_db_engine
+
+        settings = Settings(database_url=f"sqlite:///{tmp_path / 'x.db'}", sqlite_busy_timeout_ms=1234)
+        engine = create_db_engine(settings)
+        with engine.connect() as conn:
+            assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+            assert conn.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+            assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 1234
+        assert engine.pool.size() == settings.db_pool_size
+        engine.dispose()
+
+    def test_read_engine_rejects_writes(self, tmp_path):
+        from sqlalchemy import text
+        from sqlalchemy.exc import OperationalError
+
+        from server.config import Settings
+        from server.database import create_db_engine
+
+        settings = Settings(database_url=f"sqlite:///{tmp_path / 'x.db'}")
+        engine = create_db_engine(settings)
+        read_engine = create_db_engine(settings, read_only=True)
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE t (x INTEGER)"))
+            conn.execute(text("INSERT INTO t VALUES (1)"))
+
+        with read_engine.connect() as conn:
+            assert conn.execute(text("SELECT x FROM t")).scalar() == 1
+            with pytest.raises(OperationalError):
+                conn.execute(text("INSERT INTO t VALUES (2)"))
+        engine.dispose()
+        read_engine.dispose()
+
+    def test_in_memory_database_gets_no_pool_sizing(self):
+        import asyncio
+
+        from sqlalchemy import text
+
+        from server.config import Settings
+        from server.database import create_async_db_engine, create_db_engine
+
+        for url in ("sqlite://", "sqlite:///:memory:", "sqlite:///file:x?mode=memory&uri=true"):
+            settings = Settings(database_url=url)
+            for read_only in (False, True):
+                engine = create_db_engine(settings, read_only=read_only)
+                with engine.connect() as conn:
+                    assert conn.execute(text("SELECT 1")).scalar() == 1
+                engine.dispose()
+
+            async def select_one():
+                engine = create_async_db_engine(settings)
+                async with engine.connect() as conn:
+                    value = (await conn.execute(text("SELECT 1"))).scalar()
+                await engine.dispose()
+                return value
+
+            assert asyncio.run(select_one()) == 1
+
+    def test_async_engine_uses_aiosqlite_with_the_same_pragmas(self, tmp_path):
+        import asyncio
+
+        from sqlalchemy import text
+
+        from server.config import Settings
+        from server.database import async_database_url, create_async_db_engine
+
+        assert async_database_url("sqlite:///./data/michal.db") == "sqlite+aiosqlite:///./data/michal.db"
+
+        async def journal_mode():
+            engine = create_async_db_engine(Settings(database_url=f"sqlite:///{tmp_path / 'x.db'}"))
+            async with engine.connect() as conn:
+                mode = (await conn.execute(text("PRAGMA journal_mode"))).scalar()
+            await engine.dispose()
+            return mode
+
+        assert asyncio.run(journal_mode()) == "wal"
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from unittest.mock import MagicMock
+
+from server.ai.cache import AnswerCache
+from server.ai.engine import MichalEngine
+from server.config import Settings
+
+
+def _unit(*values) -> np.ndarray:
+    vector = np.array([values], dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+@pytest.fixture
+def engine():
+    retriever = MagicMock()
+    retriever.snapshot.version = 1
+    retriever.snapshot.is_ready.return_value = True
+    retriever.embed_query.return_value = _unit(1.0, 0.0)
+    retriever.retrieve.return_value = [
+        {"text": "חופשה שנתית", "source": "leave.pdf", "page": 3, "score": 0.8}
+    ]
+    retriever.format_context.return_value = "[קטע 1]\nחופשה שנתית"
+
+    engine = MichalEngine(Settings(), retriever)
+    engine.client = MagicMock()
+    response = engine.client.messages.create.return_value
+    response.content = [MagicMock(text="18 ימי חופשה")]
+    response.usage.input_tokens = 100
+    response.usage.output_tokens = 20
+    response.usage.cache_read_input_tokens = 0
+    response.usage.cache_creation_input_tokens = 0
+    return engine
+
+
+class TestAnswerCache:
+    def test_hit_above_threshold(self):
+        cache = AnswerCache(max_size=10, ttl_seconds=60, threshold=0.95)
+        cache.put(_unit(1.0, 0.0), {"answer": "a"}, version=1)
+
+        assert cache.get(_unit(1.0, 0.01), version=1) == {"answer": "a"}
+        assert cache.get(_unit(0.0, 1.0), version=1) is None
+
+    def test_version_change_invalidates(self):
+        cache = AnswerCache(max_size=10, ttl_seconds=60, threshold=0.95)
+        cache.put(_unit(1.0, 0.0), {"answer": "a"}, version=1)
+
+        assert cache.get(_unit(1.0, 0.0), version=2) is None
+
+    def test_expired_entries_miss(self):
+        cache = AnswerCache(max_size=10, ttl_seconds=0, threshold=0.95)
+        cache.put(_unit(1.0, 0.0), {"answer": "a"}, version=1)
+
+        assert cache.get(_unit(1.0, 0.0), version=1) is None
+
+    def test_evicts_oldest_beyond_max_size(self):
+        cache = AnswerCache(max_size=1, ttl_seconds=60, threshold=0.95)
+        cache.put(_unit(1.0, 0.0), {"answer": "a"}, version=1)
+        cache.put(_unit(0.0, 1.0), {"answer": "b"}, version=1)
+
+        assert cache.get(_unit(1.0, 0.0), version=1) is None
+        assert cache.stats()["size"] == 1
+
+
+class TestEngineAnswerCache:
+    def test_repeated_question_skips_llm(self, engine):
+        first = engine.ask("כמה ימי חופשה מגיעים לי?")
+        second = engine.ask("כמה ימי חופשה מגיעים לי")
+
+        assert engine.client.messages.create.call_count == 1
+        assert second["answer"] == first["answer"]
+        assert second["sources"] == first["sources"]
+        assert second["tokens_used"] == 0
+
+    def test_reingest_invalidates_cache(self, engine):
+        engine.ask("כמה ימי חופשה מגיעים לי?")
+        engine.retriever.snapshot.version = 2
+        engine.ask("כמה ימי חופשה מגיעים לי?")
+
+        assert engine.client.messages.create.call_count == 2
+
+    def test_conversation_follow_up_bypasses_cache(self, engine):
+        engine.ask("כמה ימי חופשה מגיעים לי?")
+        history = [{"role": "user", "content": "שאלה"}, {"role": "assistant", "content": "תשובה"}]
+        engine.ask("כמה ימי חופשה מגיעים לי?", conversation_history=history)
+
+        assert engine.client.messages.create.call_count == 2
+
+
+class TestEngineRelevance:
+    def test_exact_lexical_match_is_answered_despite_low_cosine(self, engine):
+        engine.retriever.retrieve.return_value = [
+            {"text": "טופס 1212", "source": "forms.pdf", "page": 1, "score": 0.1, "lexical_score": 1.0}
+        ]
+        result = engine.ask("טופס 1212")
+
+        assert result["answer"] == "18 ימי חופשה"
+        engine.client.messages.create.assert_called_once()
+
+    def test_weak_match_is_refused(self, engine):
+        from server.ai.prompts import REFUSAL_NO_KNOWLEDGE
+
+        engine.retriever.retrieve.return_value = [
+            {"text": "טופס 1212", "source": "forms.pdf", "page": 1, "score": 0.1, "lexical_score": 0.2}
+        ]
+        assert engine.ask("משהו אחר")["answer"] == REFUSAL_NO_KNOWLEDGE
+        engine.client.messages.create.assert_not_called()
+
+    def test_no_usable_context_is_refused(self, engine):
+        from server.ai.prompts import REFUSAL_NO_KNOWLEDGE
+
+        engine.retriever.retrieve.return_value = [
+            {"text": "  ", "source": "leave.pdf", "page": 3, "score": 0.8}
+        ]
+        result = engine.ask("כמה ימי חופשה מגיעים לי?")
+
+        assert result["answer"] == REFUSAL_NO_KNOWLEDGE
+        assert result["sources"] == []
+        engine.client.messages.create.assert_not_called()
+
+
+class TestClaudeRequest:
+    def test_fixed_instructions_and_context_are_separate_blocks(self, engine):
+        from server.ai.prompts import SYSTEM_PROMPT
+
+        engine.ask("כמה ימי חופשה מגיעים לי?")
+        system = engine.client.messages.create.call_args.kwargs["system"]
+
+        assert system[0] == {"type": "text", "text": SYSTEM_PROMPT}
+        assert "חופשה שנתית" in system[1]["text"]
+
+    def test_cache_tokens_are_reported(self, engine):
+        usage = engine.client.messages.create.return_value.usage
+        usage.input_tokens = 30
+        usage.cache_read_input_tokens = 900
+
+        result = engine.ask("כמה ימי חופשה מגיעים לי?")
+
+        assert result["tokens_used"] == 950
+        assert result["cache_read_tokens"] == 900
+        assert result["cache_write_tokens"] == 0
+
+        # Answered from the answer cache: no Claude tokens at all
+        cached = engine.ask("כמה ימי חופשה מגיעים לי?")
+        assert (cached["tokens_used"], cached["cache_read_tokens"]) == (0, 0)
+
+
+class TestContextAssembly:
+    def _chunk(self, text, score=0.8, source="leave.pdf"):
+        return {"text": text, "source": source, "page": 1, "score": score}
+
+    def test_irrelevant_chunks_are_dropped(self):
+        from server.ai.context import ContextAssembler
+
+        assembler = ContextAssembler(min_score=0.3, min_lexical_coverage=0.6)
+        selected = assembler.assemble(
+            [self._chunk("חופשה שנתית"), self._chunk("נושא אחר", score=0.1)], budget_tokens=1000
+        )
+
+        assert [c["text"] for c in selected] == ["חופשה שנתית"]
+
+    def test_stops_at_budget_but_keeps_top_chunk(self):
+        from server.ai.context import ContextAssembler, estimate_tokens
+
+        assembler = ContextAssembler(min_score=0.3, min_lexical_coverage=0.6)
+        first, second = "א" * 100, "ב" * 100
+        budget = estimate_tokens(first) + 10
+
+        selected = assembler.assemble([self._chunk(first), self._chunk(second)], budget)
+        assert [c["text"] for c in selected] == [first]
+
+        long_first = "א" * 1000
+        selected = assembler.assemble([self._chunk(long_first), self._chunk(second)], budget_tokens=150)
+        assert len(selected) == 1
+        assert estimate_tokens(selected[0]["text"]) == 150
+
+    def test_top_chunk_keeps_minimum_when_budget_is_spent(self):
+        from server.ai.context import MIN_TOP_CHUNK_TOKENS, ContextAssembler, estimate_tokens
+
+        assembler = ContextAssembler(min_score=0.3, min_lexical_coverage=0.6)
+        first = "א" * 1000
+
+        for budget in (0, -50):
+            selected = assembler.assemble([self._chunk(first), self._chunk("ב" * 100)], budget)
+            assert len(selected) == 1
+            assert selected[0]["text"]
+            assert estimate_tokens(selected[0]["text"]) == MIN_TOP_CHUNK_TOKENS
+
+    def test_overlap_with_neighbouring_chunk_is_cut(self):
+        from server.ai.context import ContextAssembler
+
+        assembler = ContextAssembler(min_score=0.3, min_lexical_coverage=0.6)
+        shared = "ימי החופשה נצברים לפי חודשי השירות"
+        first = f"זכאות לחופשה שנתית. {shared}"
+        second = f"{shared} ומחושבים בסוף השנה."
+
+        selected = assembler.assemble(
+            [self._chunk(first), self._chunk(second), self._chunk(second, source="other.pdf")],
+            budget_tokens=1000,
+        )
+
+        assert [c["text"] for c in selected] == [first, "ומחושבים בסוף השנה.", second]
+
+
+class TestModelRouting:
+    def _router(self, **overrides):
+        from server.ai.router import ModelRouter
+
+        return ModelRouter(Settings(anthropic_model="big", anthropic_fast_model="small", **overrides))
+
+    def test_simple_question_with_strong_context_goes_fast(self):
+        model, _ = self._router().choose("כמה ימי חופשה?", [{"score": 0.8}], None)
+        assert model == "small"
+
+    def test_exact_lexical_match_goes_fast(self):
+        context = [{"score": 0.4, "lexical_score": 1.0}]
+        assert self._router().choose("כמה ימי חופשה?", context, None)[0] == "small"
+
+    @pytest.mark.parametrize(
+        "question, context, history",
+        [
+            ("כמה ימי חופשה?", [{"score": 0.4}], None),
+            ("כמה ימי חופשה? ומה עם מחלה?", [{"score": 0.8}], None),
+            (" ".join(["מילה"] * 30), [{"score": 0.8}], None),
+            ("ומה איתם?", [{"score": 0.8}], [{"role": "user", "content": "שאלה"}]),
+        ],
+    )
+    def test_escalates_to_main_model(self, question, context, history):
+        assert self._router().choose(question, context, history)[0] == "big"
+
+    def test_routing_can_be_disabled(self):
+        router = self._router(model_routing=False)
+        assert router.choose("כמה ימי חופשה?", [{"score": 0.8}], None)[0] == "big"
+
+    def test_engine_calls_the_routed_model(self, engine):
+        result = engine.ask("כמה ימי חופשה מגיעים לי?")
+
+        assert engine.client.messages.create.call_args.kwargs["model"] == "claude-haiku-4-5"
+        assert result["model"] == "claude-haiku-4-5"
+
+
+class TestSourceReferences:
+    def test_chunks_spanning_pages_cite_a_range(self):
+        from server.ai.engine import MichalEngine
+
+        retrieved = [
+            {"source": "leave.pdf", "page": 3, "page_end": 3},
+            {"source": "leave.pdf", "page": 3, "page_end": 4},
+            {"source": "leave.pdf", "page": 3},
+        ]
+        assert MichalEngine.source_references(retrieved) == [
+            "leave.pdf (עמוד 3)",
+            "leave.pdf (עמודים 3-4)",
+        ]
+
+
+class TestAsyncEngine:
+    def test_aask_awaits_async_client(self, engine):
+        import asyncio
+        from unittest.mock import AsyncMock
+
+        engine.async_client = MagicMock()
+        engine.async_client.messages.create = AsyncMock(
+            return_value=engine.client.messages.create.return_value
+        )
+
+        result = asyncio.run(engine.aask("כמה ימי חופשה מגיעים לי?"))
+
+        assert result["answer"] == "18 ימי חופשה"
+        assert result["tokens_used"] == 120
+        engine.async_client.messages.create.assert_awaited_once()
+        engine.client.messages.create.assert_not_called()
+
+    def test_aask_runs_concurrently(self, engine):
+        import asyncio
+
+        in_flight = 0
+        peak = 0
+
+        async def slow_create(**kwargs):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.05)
+            in_flight -= 1
+            return engine.client.messages.create.return_value
+
+        engine.async_client = MagicMock()
+        engine.async_client.messages.create = slow_create
+        engine.answer_cache.max_size = 0
+
+        async def run():
+            await asyncio.gather(*(engine.aask(f"שאלה על חופשה {i}") for i in range(5)))
+
+        asyncio.run(run())
+        assert peak == 5
+
+
+class TestStreamingEngine:
+    def test_astream_emits_sources_deltas_and_done(self, engine):
+        import asyncio
+        from types import SimpleNamespace
+
+        class FakeStream:
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            @property
+            async def text_stream(self):
+                for piece in ["18 ימי ", "חופשה"]:
+                    yield piece
+
+            async def get_final_message(self):
+                return SimpleNamespace(usage=SimpleNamespace(input_tokens=100, output_tokens=20))
+
+        engine.async_client = MagicMock()
+        engine.async_client.messages.stream = lambda **kwargs: FakeStream()
+
+        async def collect():
+            return [event async for event in engine.astream("כמה ימי חופשה מגיעים לי?")]
+
+        events = asyncio.run(collect())
+
+        assert events[0] == ("sources", {"sources": ["leave.pdf (עמוד 3)"]})
+        assert "".join(data["text"] for name, data in events if name == "delta") == "18 ימי חופשה"
+        assert events[-1] == (
+            "done",
+            {
+                "tokens_used": 120,
+                "cache_read_tokens": 0,
+                "cache_write_tokens": 0,
+                "model": "claude-haiku-4-5",
+            },
+        )
@@ -9,21 +9,17 @@ from server.config import Settings
 class TestChunking:
     """Test the text chunking logic without needing ML models."""
 
-    def test_chunk_splits_text(self):
-        from server.rag.ingest import PDFIngestor
+    def _parser(self, monkeypatch, chunk_size: int = 10, chunk_overlap: int = 2):
+        from server.rag import ingest
 
-        # Create a minimal mock to test chunking only
-        class MockIngestor:
-            def __init__(self):
-                self.settings = Settings()
-                self.settings.chunk_size = 10
-                self.settings.chunk_overlap = 2
+        # Without a tokenizer every word is one token
+        monkeypatch.setattr(ingest, "get_tokenizer", lambda name: None)
+        return ingest.PDFParser(Settings(chunk_size=chunk_size, chunk_overlap=chunk_overlap))
 
-            chunk_text = PDFIngestor.chunk_text
-
-        ingestor = MockIngestor()
+    def test_chunk_splits_text(self, monkeypatch):
+        parser = self._parser(monkeypatch)
         text = " ".join(f"word{i}" for i in range(25))
-        chunks = ingestor.chunk_text(text)
+        chunks = parser.chunk_text(text)
 
         assert len(chunks) >= 3
         # First chunk should have 10 words
@@ -33,16 +29,771 @@ class TestChunking:
         second_chunk_words = chunks[1].split()
         # Last 2 words of chunk 0 should be first 2 words of chunk 1
         assert first_chunk_words[-2:] == second_chunk_words[:2]
+        assert chunks[-1].endswith("word24")
+
+    def test_empty_text_returns_no_chunks(self, monkeypatch):
+        parser = self._parser(monkeypatch)
+        assert parser.chunk_text("") == []
+        assert parser.chunk_text(" \n ") == []
+
+    def test_chunks_are_slices_of_the_text(self, monkeypatch):
+        parser = self._parser(monkeypatch, chunk_size=3, chunk_overlap=1)
+        text = "סעיף  א:\nזכאות   לחופשה שנתית\nבהתאם לוותק"
+        for start, end in parser.chunk_ranges(text):
+            assert text[start:end].split() == text[start:end].strip().split()
+        assert parser.chunk_text(text)[0] == "סעיף  א:\nזכאות"
+
+    def test_chunks_never_end_inside_a_word(self):
+        import numpy as np
+        from server.rag.chunking import chunk_spans
+
+        # Six tokens, words made of tokens [0, 1], [2, 3, 4] and [5]
+        bounds = np.array([[0, 2], [2, 4], [5, 7], [7, 9], [9, 10], [11, 13]])
+        word_start = np.array([True, False, True, False, False, True])
+        assert chunk_spans(bounds, word_start, 4, 0) == [(0, 4), (5, 13)]
+        # A word longer than a chunk is split rather than looping
+        assert chunk_spans(bounds, word_start, 2, 1) == [(0, 4), (5, 9), (9, 13)]
+
+    def test_chunks_span_page_breaks(self, monkeypatch):
+        parser = self._parser(monkeypatch, chunk_size=4, chunk_overlap=0)
+        pages = [
+            {"text": "אחת שתיים שלוש", "page": 1, "source": "a.pdf"},
+            {"text": "ארבע חמש שש", "page": 2, "source": "a.pdf"},
+            {"text": "שבע", "page": 4, "source": "a.pdf"},
+        ]
+        monkeypatch.setattr(parser, "extract_text_from_pdf", lambda path: pages)
+        records = parser.prepare_pdf("a.pdf")
+
+        assert [r["text"] for r in records] == ["אחת שתיים שלוש\nארבע", "חמש שש\nשבע"]
+        assert [(r["page"], r["page_end"]) for r in records] == [(1, 2), (2, 4)]
+        assert [r["chunk_index"] for r in records] == [0, 1]
+
+
+class TestPageCleaning:
+    def _page(self, n: int, body: str) -> str:
+        return f'בלמ"ס\nענף תנאי שירות - פקודת מטה\n{body}\nעמוד {n} מתוך 5\n- {n} -\n'
+
+    def test_removes_lines_repeated_across_pages(self):
+        from server.rag.cleaning import clean_pages
+
+        bodies = ["חופשה שנתית", "חופשת מחלה", "חופשה מיוחדת", "ימי אבל", "חג ומועד"]
+        cleaned = clean_pages([self._page(i + 1, body) for i, body in enumerate(bodies)])
+        assert cleaned == bodies
+
+    def test_keeps_lines_of_short_documents(self):
+        from server.rag.cleaning import clean_pages
+
+        cleaned = clean_pages([self._page(1, "סעיף א"), self._page(2, "סעיף ב")])
+        # Too few pages to tell a header, but marks and page numbers go
+        assert cleaned[0] == "ענף תנאי שירות - פקודת מטה\nסעיף א\nעמוד 1 מתוך 5"
+
+    def test_repeated_body_lines_are_kept(self):
+        from server.rag.cleaning import clean_pages
+
+        # The same line in the middle of every page is content, not a header
+        pages = [f"כותרת {i}\nא\nב\nג\nהערה חשובה\nד\nה\nו\nסוף {i}" for i in range(4)]
+        cleaned = clean_pages(pages)
+        assert all("הערה חשובה" in page for page in cleaned)
+
+    def test_list_markers_are_kept(self):
+        from server.rag.cleaning import clean_pages
+
+        pages = [f"1.\n{a}\n2.\n{b}" for a, b in zip("אבגד", "הוזח")]
+        assert clean_pages(pages) == pages
+
+    def test_empty_pages(self):
+        from server.rag.cleaning import clean_pages
+
+        assert clean_pages(["", "  \n- 3 -\n", 'בלמ"ס']) == ["", "", ""]
+
+
+class TestChunkStore:
+    def _chunk(self, i: int, source: str = "doc.pdf") -> dict:
+        return {
+            "id": f"{i:064x}",
+            "text": f"סעיף {i} בפקודה",
+            "source": source,
+            "page": i + 1,
+            "page_end": i + 2,
+            "chunk_index": i,
+        }
+
+    def _vectors(self, n: int, d: int = 8):
+        import numpy as np
+
+        return np.random.default_rng(n).standard_normal((n, d)).astype(np.float32)
+
+    def test_roundtrip_decodes_rows(self, tmp_path):
+        from server.rag.store import ChunkStore
+
+        store = ChunkStore.open(str(tmp_path / "index"))
+        store.append([self._chunk(0), self._chunk(1, "other.pdf")], self._vectors(2))
+        store.commit()
+
+        reopened = ChunkStore.open(str(tmp_path / "index"))
+        assert len(reopened) == 2
+        assert reopened.get(1) == self._chunk(1, "other.pdf")
+        assert reopened.sources == ["doc.pdf", "other.pdf"]
+        assert self._chunk(0)["id"] in reopened
+
+    def test_commits_append_segments_and_compact(self, tmp_path):
+        import faiss
+        import numpy as np
+        from server.rag.store import ChunkStore
+
+        index_path = str(tmp_path / "index")
+        store = ChunkStore.open(index_path)
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(8))
+        for i in range(3):
+            vectors = self._vectors(i + 1)
+            row_ids = store.append([self._chunk(10 * i + j) for j in range(i + 1)], vectors)
+            index.add_with_ids(vectors, row_ids)
+            store.commit(index if i == 0 else None)
+
+        reopened = ChunkStore.open(index_path)
+        assert len(reopened.segments) == 3
+        assert reopened.index_rows == 1
+        loaded = reopened.load_index()
+        assert loaded.ntotal == 6
+        vectors, row_ids = reopened.live_vectors()
+        np.testing.assert_array_equal(loaded.reconstruct_batch(row_ids), vectors)
+
+        # Drop the second segment's rows, then merge
+        reopened.delete([1, 2])
+        loaded.remove_ids(np.array([1, 2], dtype=np.int64))
+        reopened.commit(loaded)
+        assert len(reopened) == 4
+        assert reopened.get(1) is None
+        assert self._chunk(10)["id"] not in reopened
+
+        assert reopened.needs_compaction(max_segments=2)
+        reopened.compact(loaded)
+        compacted = ChunkStore.open(index_path)
+        assert len(compacted.segments) == 1
+        assert compacted.saved_count == 4
+        assert compacted.index_rows == 6
+        assert [compacted.get(i)["chunk_index"] for i in (0, 3, 4, 5)] == [0, 20, 21, 22]
+        assert compacted.get(5)["text"] == "סעיף 22 בפקודה"
+        assert compacted.load_index().ntotal == 4
+
+    def test_crash_before_manifest_write_does_not_block_commits(self, tmp_path, monkeypatch):
+        import server.rag.store as store_module
+        from server.rag.store import ChunkStore
+
+        index_path = str(tmp_path / "index")
+        store = ChunkStore.open(index_path)
+        store.append([self._chunk(0)], self._vectors(1))
+        store.commit()
+
+        # The new segment is renamed into place, then the manifest write dies
+        store.append([self._chunk(1)], self._vectors(1))
+        write_json = store_module._write_json
+
+        def crash(path, data):
+            raise OSError("simulated crash")
+
+        monkeypatch.setattr(store_module, "_write_json", crash)
+        with pytest.raises(OSError):
+            store.commit()
+        monkeypatch.setattr(store_module, "_write_json", write_json)
+
+        # A reader can't tell the orphan from a commit in progress and leaves it
+        reader = ChunkStore.open(index_path, read_only=True)
+        assert len(reader) == 1
+        assert len([n for n in os.listdir(reader.path) if n.startswith("seg-")]) == 2
+        with pytest.raises(RuntimeError):
+            reader.commit()
+
+        reopened = ChunkStore.open(index_path)
+        assert len(reopened) == 1
+        reopened.append([self._chunk(2)], self._vectors(1))
+        reopened.commit()
+
+        final = ChunkStore.open(index_path)
+        assert len(final) == 2
+        assert final.get(1)["text"] == "סעיף 2 בפקודה"
+
+    def test_migrates_legacy_json_metadata(self, tmp_path):
+        import json
+        import faiss
+        from server.rag.index import is_id_mapped
+        from server.rag.store import ChunkStore
+
+        index_path = str(tmp_path / "index")
+        with open(f"{index_path}.meta.json", "w", encoding="utf-8") as f:
+            json.dump({"chunks": [self._chunk(0)], "id_map": {}}, f)
+        index = faiss.IndexFlatIP(8)
+        index.add(self._vectors(1))
+        faiss.write_index(index, f"{index_path}.faiss")
+
+        # Readers use the old files as they are; only the writer migrates them
+        reader = ChunkStore.open(index_path, read_only=True)
+        assert reader.get(0)["text"] == "סעיף 0 בפקודה"
+        assert reader.load_index().ntotal == 1
+        assert not os.path.exists(reader.path)
+
+        store = ChunkStore.open(index_path)
+        assert len(store) == 1
+        assert store.get(0)["text"] == "סעיף 0 בפקודה"
+        index = store.load_index()
+        assert index.ntotal == 1
+        assert is_id_mapped(index)
+
+
+class TestIncrementalIngest:
+    """Re-ingestion driven by file content hashes, with a fake model and parser."""
+
+    @pytest.fixture
+    def make_ingestor(self, tmp_path, monkeypatch):
+        import hashlib
+        import numpy as np
+        from server.rag import ingest
+
+        embedded = []
+
+        class FakeModel:
+            def embed(self, texts, batch_size=None):
+                for text in texts:
+                    embedded.append(text)
+                    seed = int(hashlib.sha256(text.encode()).hexdigest()[:8], 16)
+                    yield np.random.default_rng(seed).standard_normal(8)
+
+        def extract(self, pdf_path):
+            with open(pdf_path, encoding="utf-8") as f:
+                pages = f.read().split("\f")
+            source = os.path.basename(pdf_path)
+            return [{"text": t, "page": i, "source": source} for i, t in enumerate(pages, 1)]
+
+        from server.rag import retriever
+
+        monkeypatch.setattr(ingest, "get_embedding_model", lambda name: FakeModel())
+        monkeypatch.setattr(retriever, "get_embedding_model", lambda name: FakeModel())
+        monkeypatch.setattr(ingest, "get_embedding_dimension", lambda name: 8)
+        monkeypatch.setattr(ingest, "get_tokenizer", lambda name: None)
+        monkeypatch.setattr(ingest.PDFParser, "extract_text_from_pdf", extract)
+        # Chunks of three words; the pages below are three words long
+        settings = Settings(faiss_index_path=str(tmp_path / "index"), chunk_size=3, chunk_overlap=0)
+
+        def make():
+            ingestor = ingest.PDFIngestor(settings)
+            ingestor.embedded = embedded
+            return ingestor
+
+        make.settings = settings
+        return make
+
+    def _write(self, directory, name, pages):
+        with open(os.path.join(directory, name), "w", encoding="utf-8") as f:
+            f.write("\f".join(pages))
+
+    def _texts(self, ingestor):
+        store = ingestor.store
+        return sorted(store.get(int(r))["text"] for r in store.live_row_ids())
+
+    def test_skips_unchanged_and_replaces_edited_files(self, tmp_path, make_ingestor):
+        kb = tmp_path / "kb"
+        kb.mkdir()
+        self._write(kb, "a.pdf", ["חופשה שנתית מלאה", "ימי מחלה רגילים"])
+        self._write(kb, "b.pdf", ["שירות מילואים פעיל"])
+
+        ingestor = make_ingestor()
+        assert ingestor.ingest_directory(str(kb)) == {"a.pdf": 2, "b.pdf": 1}
+
+        # Edit one page of a.pdf and delete b.pdf
+        self._write(kb, "a.pdf", ["חופשה שנתית מלאה", "ימי מחלה מיוחדים"])
+        os.remove(kb / "b.pdf")
+        ingestor = make_ingestor()
+        ingestor.embedded.clear()
+        assert ingestor.ingest_directory(str(kb), prune=True) == {"a.pdf": 1}
+        assert ingestor.embedded == ["ימי מחלה מיוחדים"]
+        assert ingestor.rows_removed == 2  # the edited page and b.pdf
+        assert self._texts(ingestor) == ["חופשה שנתית מלאה", "ימי מחלה מיוחדים"]
+        assert ingestor.index.ntotal == 2
+        assert set(ingestor.store.files) == {"a.pdf"}
+
+        ingestor = make_ingestor()
+        ingestor.embedded.clear()
+        assert ingestor.ingest_directory(str(kb)) == {"a.pdf": 0}
+        assert ingestor.embedded == []
+        assert ingestor.last_ingest_stats["skipped"]
+
+        # Without prune, files ingested from another directory stay
+        other = tmp_path / "other"
+        other.mkdir()
+        self._write(other, "c.pdf", ["שירות מילואים פעיל"])
+        assert ingestor.ingest_directory(str(other)) == {"c.pdf": 1}
+        assert set(ingestor.store.files) == {"a.pdf", "c.pdf"}
+        assert ingestor.rows_removed == 0
+
+        # Every indexed vector id resolves to a live row
+        _, ids = ingestor.index.search(ingestor.store.live_vectors()[0], 2)
+        assert all(ingestor.store.get(int(i)) is not None for i in ids.ravel())
+
+    def test_settings_change_reingests_unchanged_files(self, tmp_path, make_ingestor):
+        from server.rag import ingest
+
+        kb = tmp_path / "kb"
+        kb.mkdir()
+        self._write(kb, "a.pdf", ["חופשה שנתית מלאה ימי מחלה רגילים"])
+        ingestor = make_ingestor()
+        assert ingestor.ingest_directory(str(kb)) == {"a.pdf": 2}
+
+        def reingest(**changes):
+            ingestor = ingest.PDFIngestor(make_ingestor.settings.model_copy(update=changes))
+            return ingestor, ingestor.ingest_directory(str(kb))
+
+        ingestor, results = reingest(chunk_size=6)
+        assert results == {"a.pdf": 1}
+        assert self._texts(ingestor) == ["חופשה שנתית מלאה ימי מחלה רגילים"]
+
+        # Same chunks, other model: every chunk is embedded again
+        ingestor, results = reingest(chunk_size=6, embedding_model="other-model")
+        assert results == {"a.pdf": 1}
+        assert ingestor.rows_removed == 1
+        assert len(ingestor.store) == 1
+
+        _, results = reingest(chunk_size=6, embedding_model="other-model")
+        assert results == {"a.pdf": 0}
+
+    def test_lexical_index_grows_with_segments(self, tmp_path, make_ingestor, monkeypatch):
+        import numpy as np
+        from server.rag import lexical
+
+        kb = tmp_path / "kb"
+        kb.mkdir()
+        self._write(kb, "a.pdf", ["זכאות לחופשה שנתית", "טופס 1212 לשחרור", "ימי מחלה בשירות"])
+        ingestor = make_ingestor()
+        ingestor.ingest_directory(str(kb))
+
+        tokenized = []
+        tokenize = lexical.tokenize
+        monkeypatch.setattr(lexical, "tokenize", lambda text: tokenized.append(text) or tokenize(text))
+        self._write(kb, "b.pdf", ["טופס 1313 לחופשה"])
+        ingestor.ingest_files([str(kb / "b.pdf")])
+        assert tokenized == ["טופס 1313 לחופשה"]
+
+        # Deleted rows drop out of the scores and statistics at once
+        self._write(kb, "a.pdf", ["זכאות לחופשה שנתית", "ימי מחלה בשירות"])
+        ingestor.ingest_files([str(kb / "a.pdf")])
+        store = ingestor.store
+        assert len(store.segments) > 1
+        row_ids = store.live_row_ids()
+        rebuilt = lexical.LexicalIndex.build(row_ids, [store.get(int(r))["text"] for r in row_ids])
+        segmented = store.load_lexical()
+        assert len(segmented) == len(rebuilt) == 3
+        for query in ("טופס לחופשה", "ימי חופשה", "1212"):
+            expected, found = rebuilt.search(query, 5), segmented.search(query, 5)
+            assert [h.row_id for h in found] == [h.row_id for h in expected]
+            np.testing.assert_allclose([h.score for h in found], [h.score for h in expected], rtol=1e-6)
+
+        ingestor.compact(force=True)
+        assert len(store.segments) == 1
+        assert [h.row_id for h in store.load_lexical().search("טופס", 5)] == [
+            h.row_id for h in rebuilt.search("טופס", 5)
+        ]
+
+    def test_embeds_in_batches_and_reports_throughput(self, tmp_path, make_ingestor):
+        import numpy as np
+
+        class BatchModel:
+            batch_sizes = []
+
+            def embed(self, texts, batch_size=None):
+                self.batch_sizes.append(batch_size)
+                for i, _ in enumerate(texts):
+                    yield np.full(8, i + 1.0)
+
+        kb = tmp_path / "kb"
+        kb.mkdir()
+        self._write(kb, "a.pdf", ["חופשה שנתית מלאה", "ימי מחלה רגילים", "שירות מילואים פעיל"])
+        ingestor = make_ingestor()
+        ingestor.embedding_model = BatchModel()
+
+        vectors = ingestor.embed_chunks(["א", "ב"])
+        assert BatchModel.batch_sizes == [make_ingestor.settings.embedding_batch_size]
+        assert vectors.dtype == np.float32
+        np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), 1.0, rtol=1e-6)
+        assert ingestor.embed_chunks([]).shape == (0, 8)
+
+        assert ingestor.ingest_files([str(kb / "a.pdf")]) == {"a.pdf": 3}
+        stats = ingestor.last_ingest_stats
+        assert (stats["chunks"], stats["removed"], stats["skipped"]) == (3, 0, False)
+        assert stats["seconds"] > 0
+        assert stats["chunks_per_second"] == pytest.approx(3 / stats["seconds"])
+
+        ingestor.ingest_files([str(kb / "a.pdf")])
+        assert ingestor.last_ingest_stats == ingestor._empty_stats(skipped=True)
+
+    def test_parallel_ingest_matches_sequential(self, tmp_path, make_ingestor, monkeypatch):
+        from concurrent.futures import ThreadPoolExecutor
+        from server.rag import ingest
+
+        # Spawned processes would not see this test's fakes; threads run the same pool path
+        pools = []
+
+        def executor(max_workers, mp_context):
+            pools.append(max_workers)
+            return ThreadPoolExecutor(max_workers)
+
+        monkeypatch.setattr(ingest, "ProcessPoolExecutor", executor)
+        kb = tmp_path / "kb"
+        kb.mkdir()
+        for i in range(5):
+            self._write(kb, f"{i}.pdf", [f"סעיף {i} בפקודה", f"נספח {i} להוראה", "טופס משותף לכולם"])
+        paths = [str(kb / f"{i}.pdf") for i in range(5)]
+
+        rows = {}
+        for jobs in (1, 2):
+            settings = make_ingestor.settings.model_copy(
+                update={"faiss_index_path": str(tmp_path / f"index-{jobs}")}
+            )
+            ingestor = ingest.PDFIngestor(settings)
+            assert ingestor.ingest_files(paths, jobs=jobs) == {f"{i}.pdf": 3 for i in range(5)}
+            store = ingestor.store
+            rows[jobs] = [(int(r), store.get(int(r))["id"]) for r in store.live_row_ids()]
+
+        assert pools == [2]
+        assert rows[1] == rows[2]
+        assert len(rows[1]) == 15
+
+    def test_hybrid_retrieval_shortcuts_on_exact_match(self, tmp_path, make_ingestor):
+        from server.rag.retriever import KnowledgeRetriever
+
+        kb = tmp_path / "kb"
+        kb.mkdir()
+        self._write(kb, "a.pdf", ["זכאות לחופשה שנתית", "טופס 1212 לשחרור", "ימי מחלה בשירות"])
+        ingestor = make_ingestor()
+        ingestor.ingest_directory(str(kb))
+        assert len(ingestor.store.load_lexical()) == 3
+
+        retriever = KnowledgeRetriever(make_ingestor.settings)
+        assert retriever.snapshot.lexical is not None
+
+        timings = {}
+        results = retriever.retrieve("טופס 1212", timings=timings)
+        assert results[0]["text"] == "טופס 1212 לשחרור"
+        assert results[0]["lexical_score"] == 1.0
+        assert "dense" not in timings and "embed" not in timings
+
+        timings = {}
+        results = retriever.retrieve("כמה ימי חופשה יש לי", timings=timings)
+        assert {"lexical", "embed", "dense", "fusion"} <= set(timings)
+        assert len(results) == 3
+        assert all(-1.0 <= r["score"] <= 1.0 for r in results)
+
+
+class TestIndexFactory:
+    def _vectors(self, n: int = 500, d: int = 16):
+        import faiss
+        import numpy as np
+
+        vectors = np.random.default_rng(0).standard_normal((n, d)).astype(np.float32)
+        faiss.normalize_L2(vectors)
+        return vectors
+
+    def test_ivf_is_trained_from_flat_stand_in(self):
+        from server.rag.index import create_index, evaluate_index, needs_rebuild, rebuild_index
+
+        import numpy as np
+
+        settings = Settings(faiss_index_type="ivf", faiss_ivf_nlist=8)
+        vectors, ids = self._vectors(), np.arange(1000, 1500)
+        index = create_index(settings, 16)
+        index.add_with_ids(vectors, ids)
+        assert needs_rebuild(settings, index)
+
+        index = rebuild_index(settings, 16, vectors, ids)
+        report = evaluate_index(index, vectors, ids, k=5, nprobe=8)
+        assert report["index_type"] == "ivf"
+        assert report["recall_at_k"] == 1.0  # probing every list is exact
+
+    def test_flat_index_has_perfect_recall(self):
+        import numpy as np
+        from server.rag.index import create_index, evaluate_index
+
+        vectors, ids = self._vectors(), np.arange(500)
+        index = create_index(Settings(), 16)
+        index.add_with_ids(vectors, ids)
+        assert evaluate_index(index, vectors, ids, k=5)["recall_at_k"] == 1.0
+
+    @pytest.mark.parametrize("kind", ["sq8", "pq"])
+    def test_quantized_index_is_smaller_and_reranked_exactly(self, kind):
+        import numpy as np
+        from server.rag.index import evaluate_index, rebuild_index
+
+        settings = Settings(faiss_index_type=kind, faiss_pq_m=16)
+        vectors, ids = self._vectors(n=1200, d=64), np.arange(1200)
+        index = rebuild_index(settings, 64, vectors, ids)
+        report = evaluate_index(index, vectors, ids, k=5, rerank_factor=4)
+
+        assert report["index_type"] == kind
+        assert report["bytes_per_vector"] * 3 < report["flat_bytes_per_vector"]
+        assert report["recall_at_k"] >= report["raw_recall_at_k"]
+        assert report["recall_at_k"] > 0.9
+
+    def test_quantized_waits_for_training_points(self):
+        import numpy as np
+        from server.rag.index import MIN_QUANTIZER_TRAIN_POINTS, create_index, needs_rebuild
+
+        settings = Settings(faiss_index_type="sq8")
+        index = create_index(settings, 16)
+        vectors = self._vectors(n=MIN_QUANTIZER_TRAIN_POINTS)
+        index.add_with_ids(vectors[:-1], np.arange(len(vectors) - 1))
+        assert not needs_rebuild(settings, index)
+        index.add_with_ids(vectors[-1:], np.array([len(vectors) - 1]))
+        assert needs_rebuild(settings, index)
+
+    def test_rerank_orders_by_exact_score(self):
+        import numpy as np
+        from server.rag.index import rerank
+
+        vectors = np.eye(3, dtype=np.float32)
+        scores, ids = rerank(np.array([[0.1, 0.9, 0.5]]), np.array([10, 11, 12]), vectors, 2)
+        assert ids.tolist() == [11, 12]
+        assert scores.tolist() == pytest.approx([0.9, 0.5])
+
+
+class TestLexicalIndex:
+    def test_tokenizer_folds_prefixes_finals_and_abbreviations(self):
+        from server.rag.lexical import tokenize
+
+        assert tokenize("ובחופשה") == [["ובחופשה", "בחופשה", "חופשה"]]
+        assert tokenize("שָׁלוֹם") == tokenize("שלומ")
+        assert tokenize('אכ"א') == [["אכא"]]
+        assert tokenize("35.0201") == [["35.0201"], ["35"], ["0201"]]
+
+    def test_exact_form_number_ranks_first(self):
+        import numpy as np
+        from server.rag.lexical import LexicalIndex
+
+        texts = [
+            "זכאות לחופשה שנתית של 18 ימים",
+            "טופס 1212 למילוי בקשת שחרור",
+            "הוראת קבע 35.0201 עוסקת בתשלומים",
+        ]
+        index = LexicalIndex.build(np.array([7, 8, 9]), texts)
+        hits = index.search("איפה טופס 1212?", k=3)
+        assert hits[0].row_id == 8
+        assert len(hits) == 1
+        assert index.search("בחופשה", k=3)[0].row_id == 7
+        assert index.search("35.0201", k=1)[0].coverage == 1.0
+
+    def test_common_words_do_not_count_as_coverage(self):
+        import numpy as np
+        from server.rag.lexical import LexicalIndex
+
+        texts = [f"מה יש בסעיף {i} של הפקודה" for i in range(40)] + ["טופס 1212 מה יש בו"]
+        index = LexicalIndex.build(np.arange(len(texts)), texts)
+
+        hits = index.search("מה יש?", k=5, max_term_share=0.05)
+        assert hits and all(hit.coverage == 0.0 for hit in hits)
+        assert index.search("מה יש?", k=1)[0].coverage == 1.0
+        hit = index.search("מה יש בטופס 1212?", k=1, max_term_share=0.05)[0]
+        assert (hit.row_id, hit.coverage) == (40, 1.0)
+
+
+class TestQueryEmbeddingCache:
+    def test_normalizes_case_and_spacing(self):
+        from server.rag.retriever import normalize_query
+
+        assert normalize_query("  Sick   LEAVE? ") == normalize_query("sick leave")
+        assert normalize_query("מהי חופשה שנתית?") == "מהי חופשה שנתית"
+
+    def test_evicts_least_recently_used(self):
+        import numpy as np
+        from server.rag.retriever import QueryEmbeddingCache
+
+        cache = QueryEmbeddingCache(max_size=2)
+        cache.put("a", np.zeros(1))
+        cache.put("b", np.zeros(1))
+        cache.get("a")
+        cache.put("c", np.zeros(1))
+
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        assert cache.stats()["hits"] == 2
+        assert cache.stats()["misses"] == 1
+
+
+class TestRetrieverSnapshots:
+    def _write_store(self, index_path: str, texts: list[str]):
+        import faiss
+        import numpy as np
+        from server.rag.store import ChunkStore
+
+        vectors = np.eye(4, dtype=np.float32)[: len(texts)]
+        store = ChunkStore.open(index_path)
+        store.clear()
+        row_ids = store.append(
+            [
+                {"id": f"{i:064x}", "text": t, "source": "doc.pdf", "page": 1, "chunk_index": i}
+                for i, t in enumerate(texts)
+            ],
+            vectors,
+        )
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(4))
+        index.add_with_ids(vectors, row_ids)
+        store.commit(index)
+
+    def test_reload_swaps_snapshot_without_touching_old_one(self, tmp_path, monkeypatch):
+        from unittest.mock import MagicMock
+        import numpy as np
+        from server.rag import retriever as retriever_module
+
+        model = MagicMock()
+        model.embed.side_effect = lambda texts: [np.array([1.0, 0.0, 0.0, 0.0])]
+        monkeypatch.setattr(retriever_module, "get_embedding_model", lambda name: model)
+        index_path = str(tmp_path / "index")
+        self._write_store(index_path, ["ישן"])
+        settings = Settings(faiss_index_path=index_path, retrieval_top_k=1)
+
+        retriever = retriever_module.KnowledgeRetriever(settings)
+        old = retriever.snapshot
+        self._write_store(index_path, ["חדש", "עוד"])
+        new = retriever.reload()
+
+        assert retriever.snapshot is new
+        assert new.version == old.version + 1
+        assert retriever.retrieve("q")[0]["text"] == "חדש"
+        # A request that started before the reload still sees its own data
+        assert retriever.retrieve("q", snapshot=old)[0]["text"] == "ישן"
+        assert len(old.store) == 1 and old.index.ntotal == 1
+
+
+class TestEmbeddingRegistry:
+    def test_loads_each_model_once_across_threads(self, monkeypatch):
+        import threading
+        import time
+        from server.rag import embeddings
+
+        loads = []
+
+        class SlowModel:
+            def __init__(self, name):
+                time.sleep(0.05)
+                loads.append(name)
+
+        monkeypatch.setattr(embeddings, "TextEmbedding", SlowModel)
+        monkeypatch.setattr(embeddings, "_models", {})
+
+        models = []
+        threads = [
+            threading.Thread(target=lambda: models.append(embeddings.get_embedding_model("m")))
+            for _ in range(8)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert loads == ["m"]
+        assert all(m is models[0] for m in models)
+
+    def test_tokenizer_comes_from_the_local_model_files(self, tmp_path, monkeypatch):
+        from types import SimpleNamespace
+
+        from tokenizers import Tokenizer
+        from tokenizers.models import WordLevel
+        from tokenizers.pre_tokenizers import Whitespace
+
+        from server.rag import embeddings
+
+        tokenizer = Tokenizer(WordLevel({"[UNK]": 0, "חופשה": 1}, unk_token="[UNK]"))
+        tokenizer.pre_tokenizer = Whitespace()
+        tokenizer.save(str(tmp_path / "tokenizer.json"))
+
+        def cached_model(name, lazy_load=False):
+            assert lazy_load  # no ONNX session just for the tokenizer
+            return SimpleNamespace(model=SimpleNamespace(_model_dir=str(tmp_path)))
+
+        monkeypatch.setattr(embeddings, "TextEmbedding", cached_model)
+        monkeypatch.setattr(embeddings, "_tokenizers", {})
+
+        loaded = embeddings.get_tokenizer("m")
+        assert loaded.encode("חופשה שנתית").ids == [1, 0]
+        assert embeddings.get_tokenizer("m") is loaded
+
+    def test_missing_tokenizer_fails_instead_of_counting_words(self, monkeypatch):
+        from server.rag import embeddings
+
+        def offline(name, lazy_load=False):
+            raise OSError("no network")
+
+        monkeypatch.setattr(embeddings, "TextEmbedding", offline)
+        monkeypatch.setattr(embeddings, "_tokenizers", {})
+
+        with pytest.raises(RuntimeError):
+            embeddings.get_tokenizer("m")
+
+
+class TestIngestJobManager:
+    class FakeIngestor:
+        def __init__(self, settings):
+            self.rows_removed = 0
+
+        def clear(self):
+            pass
+
+        def ingest_files(self, paths, on_file=None):
+            for path in paths:
+                on_file(os.path.basename(path), 3)
+
+        def ingest_directory(self, directory, on_file=None, prune=False):
+            self.rows_removed = 4 if prune else 0  # a deleted PDF's chunks
+
+        def compact(self):
+            return False
+
+    def _wait(self, manager, job):
+        import time
+
+        while manager.get(job.id).status in ("queued", "running"):
+            time.sleep(0.01)
+        return manager.get(job.id)
+
+    def test_job_reports_progress_and_reloads(self, monkeypatch):
+        from server.rag import ingest
+        from server.rag.jobs import IngestJobManager
+
+        monkeypatch.setattr(ingest, "PDFIngestor", self.FakeIngestor)
+        reloads = []
+        manager = IngestJobManager(Settings(), on_index_changed=lambda: reloads.append(1))
+
+        job = self._wait(manager, manager.submit(["kb/a.pdf", "kb/b.pdf"]))
+        manager.shutdown()
+
+        assert job.status == "completed"
+        assert job.files_done == 2
+        assert job.chunks_embedded == 6
+        assert job.results == {"a.pdf": 3, "b.pdf": 3}
+        assert reloads == [1]
+
+    def test_directory_job_removes_deleted_files_and_reloads(self, monkeypatch):
+        from server.rag import ingest
+        from server.rag.jobs import IngestJobManager
+
+        monkeypatch.setattr(ingest, "PDFIngestor", self.FakeIngestor)
+        reloads = []
+        manager = IngestJobManager(Settings(), on_index_changed=lambda: reloads.append(1))
+
+        job = self._wait(manager, manager.submit([], prune_directory="kb"))
+        manager.shutdown()
+
+        assert job.status == "completed"
+        assert (job.chunks_embedded, job.chunks_removed) == (0, 4)
+        assert reloads == [1]
 
-    def test_empty_text_returns_no_chunks(self):
-        from server.rag.ingest import PDFIngestor
+    def test_cancel_stops_after_current_file(self, monkeypatch):
+        from server.rag import ingest
+        from server.rag.jobs import IngestJobManager
 
-        class MockIngestor:
-            def __init__(self):
-                self.settings = Settings()
+        monkeypatch.setattr(ingest, "PDFIngestor", self.FakeIngestor)
+        manager = IngestJobManager(Settings())
+        job = manager.submit(["kb/a.pdf", "kb/b.pdf"])
+        job.cancel_requested = True
 
-            chunk_text = PDFIngestor.chunk_text
+        job = self._wait(manager, job)
+        manager.shutdown()
 
-        ingestor = MockIngestor()
-        chunks = ingestor.chunk_text("")
-        assert chunks == []
+        assert job.status == "cancelled"
+        assert job.files_done == 1